@@ -0,0 +1,27 @@
+--
+-- Indexes for the predicates and sort orders app.py uses on every request
+--
+
+-- Employees assigned to a location, listed by name (locUserHome, locationEmployees)
+CREATE INDEX IF NOT EXISTS employees_assignedto_name_idx ON public.employees USING btree (assignedto, name, email);
+
+-- Unassigned pool, picked in name order by request assignment (viewRequests, assignEmployees, locationEmployees)
+CREATE INDEX IF NOT EXISTS employees_unassigned_name_idx ON public.employees USING btree (name, email)
+    WHERE assignedto = 0;
+
+-- Full employee listings sorted by name
+CREATE INDEX IF NOT EXISTS employees_name_email_idx ON public.employees USING btree (name, email);
+
+-- Location account lookups by login email (locUserHome, newRequest, newLocation, locationInfo)
+CREATE INDEX IF NOT EXISTS locations_email_idx ON public.locations USING btree (email);
+
+-- Open requests of a location by submission date (locUserHome, newRequest)
+CREATE INDEX IF NOT EXISTS requests_open_id_datesubmit_idx ON public.requests USING btree (id, datesubmit)
+    WHERE status;
+
+-- Open request list (viewRequests); open requests are a small fraction of the request history
+CREATE INDEX IF NOT EXISTS requests_open_datesubmit_idx ON public.requests USING btree (datesubmit)
+    WHERE status;
+
+-- Request history of a location, also backs the "ID Constraint" foreign key on location delete
+CREATE INDEX IF NOT EXISTS requests_id_idx ON public.requests USING btree (id);
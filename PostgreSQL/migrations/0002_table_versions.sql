@@ -0,0 +1,40 @@
+--
+-- Per-table change counters, bumped by triggers on every write so the app can build ETags, Last-Modified
+-- headers and fragment cache keys without re-reading the tables (see httpcache.py)
+--
+
+CREATE TABLE IF NOT EXISTS public.table_versions (
+    name text PRIMARY KEY,
+    version bigint NOT NULL DEFAULT 0,
+    changed timestamp with time zone NOT NULL DEFAULT clock_timestamp()
+);
+
+INSERT INTO public.table_versions (name)
+    VALUES ('users'), ('employees'), ('locations'), ('requests')
+    ON CONFLICT (name) DO NOTHING;
+
+-- Statement level, so a bulk write bumps its table once however many rows it touches
+CREATE OR REPLACE FUNCTION public.bump_table_version() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+    UPDATE public.table_versions SET version = version + 1, changed = clock_timestamp() WHERE name = TG_TABLE_NAME;
+    RETURN NULL;
+END
+$$;
+
+DROP TRIGGER IF EXISTS users_version ON public.users;
+CREATE TRIGGER users_version AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON public.users
+    FOR EACH STATEMENT EXECUTE PROCEDURE public.bump_table_version();
+
+DROP TRIGGER IF EXISTS employees_version ON public.employees;
+CREATE TRIGGER employees_version AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON public.employees
+    FOR EACH STATEMENT EXECUTE PROCEDURE public.bump_table_version();
+
+DROP TRIGGER IF EXISTS locations_version ON public.locations;
+CREATE TRIGGER locations_version AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON public.locations
+    FOR EACH STATEMENT EXECUTE PROCEDURE public.bump_table_version();
+
+DROP TRIGGER IF EXISTS requests_version ON public.requests;
+CREATE TRIGGER requests_version AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON public.requests
+    FOR EACH STATEMENT EXECUTE PROCEDURE public.bump_table_version();
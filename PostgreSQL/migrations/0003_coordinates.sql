@@ -0,0 +1,56 @@
+--
+-- Coordinates for proximity based assignment: an optional home coordinate for employees, and a coordinate for
+-- locations geocoded from the offline geocodes table (loaded by geocode.py)
+--
+
+ALTER TABLE public.employees ADD COLUMN IF NOT EXISTS latitude double precision,
+                             ADD COLUMN IF NOT EXISTS longitude double precision;
+ALTER TABLE public.locations ADD COLUMN IF NOT EXISTS latitude double precision,
+                             ADD COLUMN IF NOT EXISTS longitude double precision;
+
+CREATE TABLE IF NOT EXISTS public.geocodes (
+    address character varying(100) PRIMARY KEY,
+    latitude double precision NOT NULL,
+    longitude double precision NOT NULL
+);
+
+-- Plane point used to rank by proximity with a GiST index (core KNN on points, no extensions needed)
+-- Equirectangular projection around 39N, the middle of the US address data: distances are exact north-south and
+-- within about 20% east-west across the continental US, plenty to rank nearby employees
+CREATE OR REPLACE FUNCTION public.geo_point(latitude double precision, longitude double precision) RETURNS point
+    LANGUAGE sql IMMUTABLE PARALLEL SAFE
+    AS $$ SELECT point(longitude * cos(radians(39)), latitude) $$;
+
+-- Great circle distance in kilometres (haversine), for display
+CREATE OR REPLACE FUNCTION public.geo_distance(lat1 double precision, lng1 double precision,
+                                               lat2 double precision, lng2 double precision)
+    RETURNS double precision
+    LANGUAGE sql IMMUTABLE PARALLEL SAFE
+    AS $$
+        SELECT 2 * 6371 * asin(sqrt(sin(radians(lat2 - lat1) / 2) ^ 2 +
+                                    cos(radians(lat1)) * cos(radians(lat2)) * sin(radians(lng2 - lng1) / 2) ^ 2))
+    $$;
+
+-- Locations take their coordinate from geocodes whenever they are created (without one) or their address changes
+CREATE OR REPLACE FUNCTION public.geocode_location() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+    IF TG_OP = 'INSERT' AND NEW.latitude IS NOT NULL THEN
+        RETURN NEW;
+    END IF;
+    IF TG_OP = 'UPDATE' AND NEW.address IS NOT DISTINCT FROM OLD.address THEN
+        RETURN NEW;
+    END IF;
+    SELECT g.latitude, g.longitude INTO NEW.latitude, NEW.longitude FROM public.geocodes g WHERE g.address = NEW.address;
+    RETURN NEW;
+END
+$$;
+
+DROP TRIGGER IF EXISTS locations_geocode ON public.locations;
+CREATE TRIGGER locations_geocode BEFORE INSERT OR UPDATE OF address ON public.locations
+    FOR EACH ROW EXECUTE PROCEDURE public.geocode_location();
+
+-- Nearest unassigned employees to a point (request fulfilment and locationEmployees, nearest first)
+CREATE INDEX IF NOT EXISTS employees_unassigned_home_idx ON public.employees
+    USING gist (public.geo_point(latitude, longitude)) WHERE assignedto = 0 AND latitude IS NOT NULL;
@@ -0,0 +1,28 @@
+--
+-- Background job queue for long running admin operations (bulk deletes, fulfilling every open request)
+-- Workers claim queued jobs with FOR UPDATE SKIP LOCKED and record progress as they go (see jobs.py)
+--
+
+CREATE TABLE IF NOT EXISTS public.jobs (
+    id serial PRIMARY KEY,
+    kind character varying(50) NOT NULL,
+    params jsonb NOT NULL DEFAULT '{}',
+    status character varying(10) NOT NULL DEFAULT 'queued',
+    progress integer NOT NULL DEFAULT 0,
+    total integer NOT NULL DEFAULT 0,
+    result jsonb,
+    error text,
+    owner character varying(50),
+    worker character varying(100),
+    attempts integer NOT NULL DEFAULT 0,
+    created timestamp with time zone NOT NULL DEFAULT now(),
+    started timestamp with time zone,
+    heartbeat timestamp with time zone,
+    finished timestamp with time zone
+);
+
+-- Queued jobs in submission order, the only rows workers scan when claiming
+CREATE INDEX IF NOT EXISTS jobs_queued_idx ON public.jobs USING btree (id) WHERE status = 'queued';
+
+-- Running jobs by heartbeat, for requeueing jobs whose worker died
+CREATE INDEX IF NOT EXISTS jobs_running_heartbeat_idx ON public.jobs USING btree (heartbeat) WHERE status = 'running';
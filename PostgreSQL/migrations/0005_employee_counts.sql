@@ -0,0 +1,72 @@
+--
+-- locations.numemployees maintained by the database: statement level triggers on employees read the rows each
+-- statement inserted, deleted or updated (transition tables) and apply one grouped correction per location,
+-- so app code never adjusts the count itself and it can't drift from the employees rows
+-- Run reconcile.py to recompute and verify every count
+--
+
+-- Applies the net change in employees per location of one statement. Affected locations are locked in id order
+-- first, so concurrent statements touching the same locations queue instead of deadlocking
+-- Sessions bulk loading in parallel (gendata) can set eas.employee_counts to off and reconcile once at the end
+CREATE OR REPLACE FUNCTION public.count_employees() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+    ids integer[];
+    deltas bigint[];
+BEGIN
+    IF current_setting('eas.employee_counts', true) = 'off' THEN
+        RETURN NULL;
+    END IF;
+
+    IF TG_OP = 'INSERT' THEN
+        SELECT array_agg(assignedto ORDER BY assignedto), array_agg(n ORDER BY assignedto) INTO ids, deltas
+            FROM (SELECT assignedto, count(*) AS n FROM new_rows WHERE assignedto <> 0 GROUP BY 1) d;
+    ELSIF TG_OP = 'DELETE' THEN
+        SELECT array_agg(assignedto ORDER BY assignedto), array_agg(n ORDER BY assignedto) INTO ids, deltas
+            FROM (SELECT assignedto, -count(*) AS n FROM old_rows WHERE assignedto <> 0 GROUP BY 1) d;
+    ELSE
+        -- Rows are matched by location rather than by email, since email changes cascade through here too
+        SELECT array_agg(assignedto ORDER BY assignedto), array_agg(n ORDER BY assignedto) INTO ids, deltas
+            FROM (SELECT assignedto, sum(delta) AS n
+                  FROM (SELECT assignedto, 1 AS delta FROM new_rows
+                        UNION ALL
+                        SELECT assignedto, -1 FROM old_rows) changes
+                  WHERE assignedto <> 0
+                  GROUP BY 1
+                  HAVING sum(delta) <> 0) d;
+    END IF;
+
+    IF ids IS NULL THEN
+        RETURN NULL;
+    END IF;
+
+    PERFORM 1 FROM public.locations WHERE id = ANY(ids) ORDER BY id FOR UPDATE;
+    UPDATE public.locations l SET numemployees = l.numemployees + d.delta, lastupdate = localtimestamp(0)
+        FROM unnest(ids, deltas) AS d(id, delta)
+        WHERE l.id = d.id;
+    RETURN NULL;
+END
+$$;
+
+DROP TRIGGER IF EXISTS employees_count_insert ON public.employees;
+CREATE TRIGGER employees_count_insert AFTER INSERT ON public.employees
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE public.count_employees();
+
+DROP TRIGGER IF EXISTS employees_count_update ON public.employees;
+CREATE TRIGGER employees_count_update AFTER UPDATE ON public.employees
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE public.count_employees();
+
+DROP TRIGGER IF EXISTS employees_count_delete ON public.employees;
+CREATE TRIGGER employees_count_delete AFTER DELETE ON public.employees
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE public.count_employees();
+
+-- Start from correct counts (deleteLocation used to leave them behind)
+UPDATE public.locations l SET numemployees = c.n
+    FROM (SELECT l2.id, count(e.email) AS n
+          FROM public.locations l2 LEFT JOIN public.employees e ON e.assignedto = l2.id
+          GROUP BY l2.id) c
+    WHERE l.id = c.id AND l.numemployees IS DISTINCT FROM c.n;
@@ -0,0 +1,28 @@
+--
+-- Indexes for the search endpoint (see search.py): matches are ranked exact name, name prefix, email/address
+-- prefix, then any word of the name starting with the query
+-- Prefix matches use text_pattern_ops btree indexes on the lowercased columns, read in index order so a search
+-- stops after limit rows. Word matches use a GIN full text index ('simple' config, no stemming) queried with
+-- prefix terms, all core PostgreSQL, no extensions needed
+--
+
+-- Employees by name and email prefix, and name words
+CREATE INDEX IF NOT EXISTS employees_name_prefix_idx ON public.employees USING btree (lower(name) text_pattern_ops);
+CREATE INDEX IF NOT EXISTS employees_email_prefix_idx ON public.employees USING btree (lower(email) text_pattern_ops);
+CREATE INDEX IF NOT EXISTS employees_name_words_idx ON public.employees USING gin (to_tsvector('simple', name));
+
+-- The unassigned pool the assignment typeahead searches is a tiny fraction of employees, so it gets its own
+-- small copies instead of filtering every assigned match out of the full indexes
+CREATE INDEX IF NOT EXISTS employees_unassigned_name_prefix_idx ON public.employees
+    USING btree (lower(name) text_pattern_ops) WHERE assignedto = 0;
+CREATE INDEX IF NOT EXISTS employees_unassigned_email_prefix_idx ON public.employees
+    USING btree (lower(email) text_pattern_ops) WHERE assignedto = 0;
+CREATE INDEX IF NOT EXISTS employees_unassigned_name_words_idx ON public.employees
+    USING gin (to_tsvector('simple', name)) WHERE assignedto = 0;
+
+-- Locations by name and address prefix, and name and address words
+CREATE INDEX IF NOT EXISTS locations_name_prefix_idx ON public.locations USING btree (lower(name) text_pattern_ops);
+CREATE INDEX IF NOT EXISTS locations_address_prefix_idx ON public.locations
+    USING btree (lower(address) text_pattern_ops);
+CREATE INDEX IF NOT EXISTS locations_words_idx ON public.locations
+    USING gin (to_tsvector('simple', name || ' ' || address));
@@ -0,0 +1,17 @@
+--
+-- Bearer tokens for the JSON API (see api.py). Only a SHA-256 hash of each token is stored, the token itself is
+-- shown once when it is created. A token acts as the user it belongs to, and goes away with the user
+--
+
+CREATE TABLE IF NOT EXISTS public.api_tokens (
+    id serial PRIMARY KEY,
+    tokenhash character(64) NOT NULL UNIQUE,
+    email character varying(100) NOT NULL REFERENCES public.users(email) ON UPDATE CASCADE ON DELETE CASCADE,
+    name character varying(100),
+    created timestamp with time zone NOT NULL DEFAULT now(),
+    expires timestamp with time zone,
+    lastused timestamp with time zone
+);
+
+-- Tokens of a user, for listing and for the cascade when the user is deleted
+CREATE INDEX IF NOT EXISTS api_tokens_email_idx ON public.api_tokens USING btree (email);
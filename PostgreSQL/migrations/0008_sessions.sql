@@ -0,0 +1,13 @@
+--
+-- Server side sessions (see sessions.py): the session cookie only carries the id, the data lives here so every
+-- app process shares it and sessions survive restarts
+--
+
+CREATE TABLE IF NOT EXISTS public.sessions (
+    id character varying(64) PRIMARY KEY,
+    data text NOT NULL,
+    expires timestamp with time zone NOT NULL
+);
+
+-- Expired sessions in expiry order, for the sweeper's batched deletes
+CREATE INDEX IF NOT EXISTS sessions_expires_idx ON public.sessions USING btree (expires);
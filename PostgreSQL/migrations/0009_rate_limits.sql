@@ -0,0 +1,13 @@
+--
+-- Rate limit counters shared by every app process (see ratelimit.py), one row per client and limit holding the
+-- hit counts of the current and previous window. Counters are disposable, so the table is unlogged (no WAL
+-- writes per hit, emptied if the server crashes) and only the key is indexed, so a hit is a HOT update in place
+--
+
+CREATE UNLOGGED TABLE IF NOT EXISTS public.ratelimits (
+    key character varying(255) PRIMARY KEY,
+    win bigint NOT NULL,
+    count integer NOT NULL,
+    previous integer NOT NULL,
+    expires double precision NOT NULL
+) WITH (fillfactor = 50);
@@ -0,0 +1,12 @@
+--
+-- Indexes for the keyset paginated employee listings (see pagination.py), which sort and compare employees without
+-- a name as name '' (coalesce(name, '')), so the listings keep reading pages in index order
+--
+
+-- Full employee listings sorted by name
+CREATE INDEX IF NOT EXISTS employees_sortname_email_idx ON public.employees
+    USING btree ((coalesce(name, '')), email);
+
+-- One location's employees (or the unassigned pool, assignedto = 0) sorted by name
+CREATE INDEX IF NOT EXISTS employees_assignedto_sortname_idx ON public.employees
+    USING btree (assignedto, (coalesce(name, '')), email);
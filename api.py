@@ -0,0 +1,584 @@
+# Import libraries
+import argparse
+import csv
+import hashlib
+import io
+import os
+import secrets
+import threading
+import time
+from datetime import date, datetime
+from functools import wraps
+
+import psycopg2
+import psycopg2.extras
+from psycopg2 import sql
+from flask import Blueprint, abort, g, jsonify, request, url_for
+from werkzeug.exceptions import HTTPException
+from dotenv import load_dotenv
+
+import assignment
+import bulk
+import cache
+import db
+import identity
+import jobs
+import pagination
+import passwords
+
+# Seconds a verified token is trusted without looking it up again (revoked tokens keep working in other processes
+# for up to this long), and the most items one batch call may carry
+load_dotenv()
+APITOKENTTL = float(os.getenv('APITOKENTTL', 60))
+APIMAXBATCH = int(os.getenv('APIMAXBATCH', 10000))
+
+# Version 1 of the JSON API, registered on the app by app.py
+# Every route authenticates with an "Authorization: Bearer <token>" header (tokens are created with
+# 'python api.py create EMAIL'), there are no sessions, forms, redirects or templates
+blueprint = Blueprint('api', __name__, url_prefix='/api/v1')
+
+# token hash -> (expiry, email)
+tokens = {}
+tokensLock = threading.Lock()
+
+
+# Tokens are looked up by their SHA-256, so the DB never holds a usable token
+def hashToken(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+# Token Email
+# Returns the email of the user a token belongs to, None if the token is unknown, revoked or expired
+# Verified tokens are cached for APITOKENTTL seconds, so hot loops don't look their token up on every call
+def tokenEmail(token):
+    tokenHash = hashToken(token)
+    with tokensLock:
+        entry = tokens.get(tokenHash)
+    if entry is not None and entry[0] > time.monotonic():
+        return entry[1]
+
+    conn = db.getConn()
+    cur = conn.cursor()
+    cur.execute("""update api_tokens set lastused = now()
+                   where tokenhash = %s and (expires is null or expires > now())
+                   returning email""", [tokenHash])
+    row = cur.fetchone()
+    conn.commit()
+    cur.close()
+    if row is None:
+        return None
+
+    with tokensLock:
+        tokens[tokenHash] = (time.monotonic() + APITOKENTTL, row[0])
+    return row[0]
+
+
+# Token Required
+# Decorator authenticating the bearer token and checking its user is one of usertypes (1 admin, 2 employee,
+# 3 location user). The user's identity (see identity.py) is left in g.apiUser
+def tokenRequired(*usertypes):
+    def decorator(f):
+        @wraps(f)
+        def wrap(*args, **kwargs):
+            scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+            email = tokenEmail(token.strip()) if scheme.lower() == 'bearer' and token.strip() else None
+            user = identity.get(email, db.getConn) if email else None
+            if user is None:
+                abort(401, 'Missing or invalid API token')
+            if user['usertype'] not in usertypes:
+                abort(403, 'Not allowed for this account type')
+            g.apiUser = user
+            return f(*args, **kwargs)
+
+        return wrap
+
+    return decorator
+
+
+# Errors are returned as {"error": message} with the matching status code, never as HTML
+@blueprint.errorhandler(HTTPException)
+def httpError(e):
+    return jsonify(error=e.description), e.code
+
+
+@blueprint.errorhandler(passwords.HashBusy)
+def hashBusy(e):
+    return jsonify(error='Server busy, please try again in a moment'), 503
+
+
+# JSON body of the request, aborting with 400 unless it is an object
+def body():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        abort(400, 'Request body must be a JSON object')
+    return data
+
+
+# The list under key in the request body, aborting with 400 unless it is a non empty list of at most
+# APIMAXBATCH items (or any size, with unlimited)
+def batch(data, key, unlimited=False):
+    items = data.get(key)
+    if not isinstance(items, list) or not items:
+        abort(400, '{} must be a non empty list'.format(key))
+    if len(items) > APIMAXBATCH and not unlimited:
+        abort(400, 'At most {} {} per call'.format(APIMAXBATCH, key))
+    return items
+
+
+# Integer ids from a list, aborting with 400 on anything else
+def integers(items, key):
+    try:
+        return [int(item) for item in items]
+    except (TypeError, ValueError):
+        abort(400, '{} must be integers'.format(key))
+
+
+# Rows as plain dicts, dates in ISO 8601
+def rowsJson(rows):
+    return [{key: value.isoformat() if isinstance(value, (date, datetime)) else value for key, value in row.items()}
+            for row in rows]
+
+
+# Queues a bulk job, for deletes too large to run within one call, and closes cur. Returns the 202 response pointing
+# at its status
+def queued(cur, kind, params, total):
+    id = jobs.enqueue(cur, kind, params, total, g.apiUser['email'])
+    db.getConn().commit()
+    cur.close()
+    return jsonify(job=id, status=url_for('api.job', id=id)), 202
+
+
+###########################################
+############## EMPLOYEES ##################
+###########################################
+
+
+# List Employees
+# One keyset paginated page of employees, with the same sort, dir, q, size, after and before arguments as the
+# HTML listings (see pagination.py). ?assignedto= restricts it to one location (0 for unassigned)
+@blueprint.route('/employees', methods=['GET'])
+@tokenRequired(1)
+def listEmployees():
+    where, params = sql.SQL("true"), []
+    if request.args.get('assignedto') is not None:
+        where, params = sql.SQL("assignedto = %s"), integers([request.args['assignedto']], 'assignedto')
+
+    cur = db.getConn().cursor(cursor_factory=psycopg2.extras.DictCursor)
+    page = pagination.keysetPage(cur, 'employees', where, params, request.args)
+    cur.close()
+    return jsonify(employees=rowsJson(page.rows), next=page.nextCursor, prev=page.prevCursor)
+
+
+# Get Employee
+@blueprint.route('/employees/<string:email>', methods=['GET'])
+@tokenRequired(1)
+def getEmployee(email):
+    cur = db.getConn().cursor(cursor_factory=psycopg2.extras.DictCursor)
+    cur.execute("select * from employees where email = %s", [email])
+    row = cur.fetchone()
+    cur.close()
+    if row is None:
+        abort(404, 'Employee not found')
+    return jsonify(rowsJson([row])[0])
+
+
+# Create Employees
+# Body: {"password": "...", "employees": [{"email": ..., "name": ..., "assignedto": ...}, ...]}
+# Loaded like a CSV import (see bulk.importEmployees): one transaction, every account gets password (hashed
+# once), and invalid items are skipped and reported by their index in the list
+@blueprint.route('/employees', methods=['POST'])
+@tokenRequired(1)
+def createEmployees():
+    data = body()
+    items = batch(data, 'employees')
+    password = data.get('password')
+    if not isinstance(password, str) or not password:
+        abort(400, 'password is required')
+
+    csvFile = io.StringIO()
+    writer = csv.writer(csvFile)
+    writer.writerow(['email', 'name', 'assignedto'])
+    for item in items:
+        if not isinstance(item, dict):
+            abort(400, 'employees must be objects')
+        writer.writerow([item.get('email') or '', item.get('name') or '', item.get('assignedto') or 0])
+    csvFile.seek(0)
+
+    conn = db.getConn()
+    cur = conn.cursor()
+    currentTime = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    try:
+        created, skipped, errors = bulk.importEmployees(cur, csvFile, passwords.hash(password), currentTime)
+    except (ValueError, psycopg2.DataError) as e:
+        conn.rollback()
+        cur.close()
+        abort(400, str(e).strip())
+    conn.commit()
+    cur.close()
+    cache.invalidate('locations')
+
+    # Import errors count the header as line 1, so item i is line i + 2
+    return jsonify(created=created, skipped=skipped,
+                   errors=[{'index': line - 2, 'email': email, 'error': reason} for line, email, reason in errors]), 201
+
+
+# Delete Employees
+# Body: {"emails": [...]}. Deletes the employees with their accounts in one transaction, or queues a background job
+# (202, see jobs.py) when there are more than JOBBATCH of them
+@blueprint.route('/employees', methods=['DELETE'])
+@tokenRequired(1)
+def deleteEmployees():
+    emails = [str(email) for email in batch(body(), 'emails', unlimited=True)]
+    conn = db.getConn()
+    cur = conn.cursor()
+    if len(emails) > jobs.JOBBATCH:
+        return queued(cur, 'deleteEmployees', {'emails': emails}, len(emails))
+
+    deleted = assignment.deleteEmployees(cur, emails)
+    conn.commit()
+    cur.close()
+    identity.invalidate(*deleted)
+    cache.invalidate('locations')
+    return jsonify(deleted=deleted)
+
+
+###########################################
+############## LOCATIONS ##################
+###########################################
+
+
+# List Locations
+# Locations in id order, size at a time (see pagination.pageArgs); ?after= is the last id of the previous page
+@blueprint.route('/locations', methods=['GET'])
+@tokenRequired(1)
+def listLocations():
+    size = pagination.pageArgs(request.args)[3]
+    after = integers([request.args.get('after', 0)], 'after')[0]
+
+    cur = db.getConn().cursor(cursor_factory=psycopg2.extras.DictCursor)
+    cur.execute("select * from locations where id > %s order by id limit %s", (after, size + 1))
+    rows = cur.fetchall()
+    cur.close()
+    return jsonify(locations=rowsJson(rows[:size]), next=rows[size - 1]['id'] if len(rows) > size else None)
+
+
+# Get Location
+@blueprint.route('/locations/<int:id>', methods=['GET'])
+@tokenRequired(1)
+def getLocation(id):
+    row = cache.location(id, db.getConn)
+    if row is None:
+        abort(404, 'Location not found')
+    return jsonify(rowsJson([row])[0])
+
+
+# Create Locations
+# Body: {"password": "...", "locations": [{"email": ..., "name": ..., "address": ...}, ...]}
+# Every location gets a location user account with password (hashed once). Items with a missing field, or an
+# email already in use (or repeated in the list), are skipped and reported by their index in the list
+@blueprint.route('/locations', methods=['POST'])
+@tokenRequired(1)
+def createLocations():
+    data = body()
+    items = batch(data, 'locations')
+    password = data.get('password')
+    if not isinstance(password, str) or not password:
+        abort(400, 'password is required')
+
+    conn = db.getConn()
+    cur = conn.cursor()
+    emails = [str(item.get('email') or '').strip() if isinstance(item, dict) else '' for item in items]
+    cur.execute("select email from users where email = any(%s)", [emails])
+    taken = {row[0] for row in cur.fetchall()}
+
+    errors, rows, seen = [], [], set()
+    for index, (item, email) in enumerate(zip(items, emails)):
+        if not email or not isinstance(item, dict) or not item.get('name') or not item.get('address'):
+            errors.append({'index': index, 'email': email, 'error': 'email, name and address are required'})
+        elif len(email) > 100 or len(str(item['name'])) > 100 or len(str(item['address'])) > 100:
+            errors.append({'index': index, 'email': email, 'error': 'fields are limited to 100 characters'})
+        elif email in taken or email in seen:
+            errors.append({'index': index, 'email': email, 'error': 'email already in use'})
+        else:
+            seen.add(email)
+            rows.append((email, str(item['name']), str(item['address'])))
+
+    created = []
+    if rows:
+        currentTime = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        passwordHash = passwords.hash(password)
+        psycopg2.extras.execute_values(cur, "insert into users(email, password, usertype) values %s",
+                                       [(email, passwordHash, 3) for email, name, address in rows],
+                                       page_size=len(rows))
+        created = psycopg2.extras.execute_values(
+            cur, "insert into locations(email, name, address, lastupdate) values %s returning id, email",
+            [(email, name, address, currentTime) for email, name, address in rows], page_size=len(rows),
+            fetch=True)
+    conn.commit()
+    cur.close()
+    cache.invalidate('locations')
+
+    return jsonify(created=[{'id': id, 'email': email} for id, email in created], errors=errors), 201
+
+
+# Delete Locations
+# Body: {"ids": [...]}. Deletes the locations with their requests and accounts, unassigning their employees, in one
+# transaction, or queues a background job (202, see jobs.py) when there are more than JOBBATCH of them
+@blueprint.route('/locations', methods=['DELETE'])
+@tokenRequired(1)
+def deleteLocations():
+    ids = integers(batch(body(), 'ids', unlimited=True), 'ids')
+    conn = db.getConn()
+    cur = conn.cursor()
+    if len(ids) > jobs.JOBBATCH:
+        return queued(cur, 'deleteLocations', {'ids': ids}, len(ids))
+
+    currentTime = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    deleted, unassigned = assignment.deleteLocations(cur, ids, currentTime)
+    conn.commit()
+    cur.close()
+    for id in deleted:
+        identity.invalidateLocation(id)
+    cache.invalidate('locations')
+    return jsonify(deleted=deleted, unassigned=unassigned)
+
+
+###########################################
+############### REQUESTS ##################
+###########################################
+
+
+# List Requests
+# Requests in reqnum order, size at a time; ?status= is open (default), closed or all and ?after= is the last
+# reqnum of the previous page. Location users only see their own location's requests
+@blueprint.route('/requests', methods=['GET'])
+@tokenRequired(1, 3)
+def listRequests():
+    size = pagination.pageArgs(request.args)[3]
+    after = integers([request.args.get('after', 0)], 'after')[0]
+    status = request.args.get('status', 'open')
+    if status not in ('open', 'closed', 'all'):
+        abort(400, 'status must be open, closed or all')
+
+    conditions, params = [sql.SQL("reqnum > %s")], [after]
+    if status != 'all':
+        conditions.append(sql.SQL("status = %s"))
+        params.append(status == 'open')
+    if g.apiUser['usertype'] == 3:
+        conditions.append(sql.SQL("id = %s"))
+        params.append(g.apiUser['locationid'])
+
+    cur = db.getConn().cursor(cursor_factory=psycopg2.extras.DictCursor)
+    cur.execute(sql.SQL("select * from requests where {} order by reqnum limit %s").format(
+        sql.SQL(' and ').join(conditions)), params + [size + 1])
+    rows = cur.fetchall()
+    cur.close()
+    return jsonify(requests=rowsJson(rows[:size]), next=rows[size - 1]['reqnum'] if len(rows) > size else None)
+
+
+# Create Requests
+# Body: {"requests": [{"location": id, "quantity": n, "date": "YYYY-MM-DD"}, ...]}
+# Location users may leave location out, their requests are always for their own location. Items with a quantity
+# below 1, a date before today or an unknown location are skipped and reported by their index in the list
+@blueprint.route('/requests', methods=['POST'])
+@tokenRequired(1, 3)
+def createRequests():
+    items = batch(body(), 'requests')
+    today = datetime.now().date()
+    user = g.apiUser
+
+    errors, rows = [], []
+    for index, item in enumerate(items):
+        try:
+            location = user['locationid'] if user['usertype'] == 3 else int(item['location'])
+            quantity = int(item['quantity'])
+            dateRequested = datetime.strptime(str(item['date']), '%Y-%m-%d').date()
+        except (KeyError, TypeError, ValueError):
+            errors.append({'index': index, 'error': 'location, quantity and date (YYYY-MM-DD) are required'})
+            continue
+        if quantity < 1:
+            errors.append({'index': index, 'error': 'quantity must be at least 1'})
+        elif dateRequested < today:
+            errors.append({'index': index, 'error': 'date is in the past'})
+        else:
+            rows.append((index, location, quantity, dateRequested))
+
+    # The location name is copied onto each request, as newRequest does, and unknown locations drop out of the join
+    created = []
+    conn = db.getConn()
+    cur = conn.cursor()
+    if rows:
+        created = psycopg2.extras.execute_values(
+            cur, """insert into requests(quantity, datereq, datesubmit, name, id)
+                    select v.quantity, v.datereq, v.datesubmit, l.name, l.id
+                    from (values %s) v(item, id, quantity, datereq, datesubmit) join locations l on l.id = v.id
+                    order by v.item
+                    returning reqnum, id""",
+            [(index, location, quantity, dateRequested, today)
+             for index, location, quantity, dateRequested in rows],
+            template="(%s, %s, %s, %s::date, %s::date)", page_size=len(rows), fetch=True)
+        found = {id for reqnum, id in created}
+        errors += [{'index': index, 'error': 'location does not exist'}
+                   for index, location, quantity, dateRequested in rows if location not in found]
+    conn.commit()
+    cur.close()
+
+    return jsonify(created=[{'reqnum': reqnum, 'location': id} for reqnum, id in created],
+                   errors=sorted(errors, key=lambda e: e['index'])), 201
+
+
+# Assign Requests
+# Body: {"reqnums": [...], "nearest": false}. Fulfils each open request like the assign button of viewRequests
+# (see assignment.assignRequest), all in one transaction. Requests that don't exist or are closed are skipped
+@blueprint.route('/requests/assign', methods=['POST'])
+@tokenRequired(1)
+def assignRequests():
+    data = body()
+    reqnums = integers(batch(data, 'reqnums'), 'reqnums')
+    nearest = bool(data.get('nearest'))
+
+    conn = db.getConn()
+    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    currentTime = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    assigned, skipped, moved = {}, [], []
+    for reqnum in reqnums:
+        req, emails = assignment.assignRequest(cur, reqnum, currentTime, nearest)
+        if req is None:
+            skipped.append(reqnum)
+        else:
+            assigned[str(reqnum)] = emails
+            moved += emails
+    conn.commit()
+    cur.close()
+    identity.invalidate(*moved)
+    cache.invalidate('locations')
+    return jsonify(assigned=assigned, skipped=skipped)
+
+
+# Fulfil All Requests
+# Queues the fulfil all pass of viewRequests (see jobs.fulfilAll), 202 with the job's status URL
+@blueprint.route('/requests/fulfil', methods=['POST'])
+@tokenRequired(1)
+def fulfilRequests():
+    conn = db.getConn()
+    cur = conn.cursor()
+    return queued(cur, 'fulfilAll', {}, 1)
+
+
+###########################################
+############## ASSIGNMENTS ################
+###########################################
+
+
+# Assign Employees
+# Body: {"location": id, "emails": [...]}. Moves the employees to the location in one statement (see
+# assignment.moveEmployees), employees already there are left alone
+@blueprint.route('/assignments', methods=['POST'])
+@tokenRequired(1)
+def assignEmployees():
+    data = body()
+    emails = [str(email) for email in batch(data, 'emails')]
+    location = integers([data.get('location')], 'location')[0]
+    if cache.location(location, db.getConn) is None:
+        abort(404, 'Location not found')
+
+    conn = db.getConn()
+    cur = conn.cursor()
+    currentTime = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    added = assignment.moveEmployees(cur, location, emails, [], currentTime)[0]
+    conn.commit()
+    cur.close()
+    identity.invalidate(*emails)
+    cache.invalidate('locations')
+    return jsonify(assigned=added)
+
+
+# Unassign Employees
+# Body: {"emails": [...]}. Unassigns the employees from wherever they are, in one statement
+@blueprint.route('/assignments', methods=['DELETE'])
+@tokenRequired(1)
+def unassignEmployees():
+    emails = [str(email) for email in batch(body(), 'emails')]
+    conn = db.getConn()
+    cur = conn.cursor()
+    currentTime = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    removed = assignment.unassignEmployees(cur, emails, currentTime)
+    conn.commit()
+    cur.close()
+    identity.invalidate(*emails)
+    cache.invalidate('locations')
+    return jsonify(unassigned=removed)
+
+
+###########################################
+################# JOBS ####################
+###########################################
+
+
+# Job Status
+# Progress of a background job queued by a delete or fulfil call: status (queued, running, done or failed),
+# items done out of total, and the result message or error once finished
+@blueprint.route('/jobs/<int:id>', methods=['GET'])
+@tokenRequired(1)
+def job(id):
+    cur = db.getConn().cursor(cursor_factory=psycopg2.extras.DictCursor)
+    row = jobs.status(cur, id)
+    cur.close()
+    if row is None:
+        abort(404, 'Job not found')
+    return jsonify(id=row['id'], kind=row['kind'], status=row['status'], progress=row['progress'],
+                   total=row['total'], message=(row['result'] or {}).get('message'), error=row['error'])
+
+
+###########################################
+################ TOKENS ###################
+###########################################
+
+# Token management runs from the command line against the DB, a token is only ever shown when it is created
+
+
+# Creates a token for email, returns it
+def createToken(cur, email, name=None, days=None):
+    token = secrets.token_urlsafe(32)
+    cur.execute("""insert into api_tokens(tokenhash, email, name, expires)
+                   values (%s, %s, %s, now() + %s * interval '1 day')""", (hashToken(token), email, name, days))
+    return token
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage JSON API tokens')
+    commands = parser.add_subparsers(dest='command', required=True)
+    create = commands.add_parser('create', help='create a token for a user and print it')
+    create.add_argument('email')
+    create.add_argument('--name', help='what the token is for')
+    create.add_argument('--days', type=float, help='days until the token expires (default never)')
+    revoke = commands.add_parser('revoke', help='revoke a token by id')
+    revoke.add_argument('id', type=int)
+    commands.add_parser('list', help='list tokens')
+    args = parser.parse_args()
+
+    conn = db.getPool().getconn()
+    cur = conn.cursor()
+    try:
+        if args.command == 'create':
+            cur.execute("select 1 from users where email = %s", [args.email])
+            if cur.fetchone() is None:
+                raise SystemExit('No user {}'.format(args.email))
+            print(createToken(cur, args.email, args.name, args.days))
+        elif args.command == 'revoke':
+            cur.execute("delete from api_tokens where id = %s", [args.id])
+            print('Revoked {} token(s)'.format(cur.rowcount))
+        else:
+            cur.execute("select id, email, name, created, expires, lastused from api_tokens order by id")
+            for row in cur.fetchall():
+                print('{:>5}  {:<40} {:<20} created {:%Y-%m-%d}  expires {}  last used {}'.format(
+                    row[0], row[1], row[2] or '', row[3], row[4] or 'never', row[5] or 'never'))
+        conn.commit()
+    finally:
+        cur.close()
+        db.getPool().putconn(conn)
+        db.getPool().closeall()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,32 +1,70 @@
 # Import libraries
+import hmac
 import os
 from datetime import datetime
 from functools import wraps
 
 import psycopg2
 import psycopg2.extras
-from flask import Flask, render_template, flash, redirect, url_for, session, request
+from psycopg2 import sql
+from flask import Flask, Response, abort, jsonify, render_template, stream_template, flash, redirect, url_for, session, request
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
-from passlib.hash import sha256_crypt
 from wtforms import Form, StringField, validators, SelectField, PasswordField
 from wtforms.validators import InputRequired, EqualTo
 from dotenv import load_dotenv
+from markupsafe import Markup
+
+import api
+import assignment
+import bulk
+import cache
+import db
+import httpcache
+import identity
+import jobs
+import metrics
+import pagination
+import passwords
+import ratelimit
+import search
+import sessions
 
 # Flask instance
 app = Flask(__name__)
 
 # Initialize some environmental variables
 load_dotenv()
-DBNAME = os.getenv('DBNAME')
-DBUSER = os.getenv('DBUSER')
-DBPASS = os.getenv('DBPASS')
 
-# Initialize PostgreSQL
-conn = psycopg2.connect(dbname=DBNAME, user=DBUSER, password=DBPASS)
+# Sessions are kept server side (see sessions.py), shared by every app process and kept across restarts, the
+# cookie only carries a random id. Static files and the token authenticated API (see below) get no session
+# The secret key isn't used for sessions, it is only read from the env so anything else signing data agrees
+# across processes
+app.secret_key = os.getenv('SECRETKEY') or os.urandom(32)
+app.session_interface = sessions.ServerSessionInterface(skip=(app.static_url_path + '/', '/api/'))
 
-# Initialize Flask Limiter
-limiter = Limiter(app, key_func=get_remote_address)
+# Initialize PostgreSQL connection pool, each request checks out its own connection (see db.py)
+db.initApp(app)
+
+# Initialize per request timing metrics (see metrics.py), exposed at /metrics
+metrics.initApp(app)
+METRICSTOKEN = os.getenv('METRICSTOKEN')
+
+# Initialize Flask Limiter. Counters are kept where LIMITURL points (see ratelimit.py), by default the ratelimits
+# table, so the login limit holds for a client across every app process instead of multiplying with their number
+limiter = Limiter(app, key_func=get_remote_address, storage_uri=ratelimit.LIMITURL, strategy=ratelimit.LIMITSTRATEGY)
+
+# JSON API (see api.py), authenticated per call with bearer tokens, so it skips the rate limiter
+app.register_blueprint(api.blueprint)
+limiter.exempt(api.blueprint)
+
+
+# Password hashing is refused when the hash queue is full (see passwords.py), the user is asked to try again
+@app.errorhandler(passwords.HashBusy)
+def hashBusy(e):
+    app.logger.warning('Password hashing busy: %s', e)
+    flash('Server busy, please try again in a moment', 'warning')
+    return redirect(request.path, 303)
 
 
 @app.route('/')
@@ -44,6 +82,8 @@ def index():
 # Will direct user to adminHome if account entered is usertype 1. Otherwise, will redirect to employeeHome
 # If account non-existent, password mismatch, or fields empty, will redirect to self (login.html)
 # Currently no limit on password entry attempts
+# Hashes are verified in the password worker pool, and rehashed if the hash settings changed (see passwords.py)
+# The same query resolves the account's location/placement, which is cached for the home pages (see identity.py)
 @app.route('/login', methods=['GET', 'POST'])
 @limiter.limit("1/second; 30/hour")
 def login():
@@ -58,22 +98,29 @@ def login():
             return render_template('login.html')
 
         # Checks if any entry with the provided email exists
-        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        cur.execute("SELECT * FROM users WHERE email = %s", [usernameCandidate])
-
-        if cur.rowcount > 0:
-            data = cur.fetchone()
-            cur.close()
+        data = identity.fetch(db.getConn(), usernameCandidate)
 
+        if data is not None:
             # Pull data from DB
             password = data['password']
             usertype = data['usertype']
 
-            if sha256_crypt.verify(passwordCandidate, password):
-                # Update current session information
+            valid, newHash = passwords.verify(passwordCandidate, password)
+            if valid:
+                # Stored hash uses outdated scheme/rounds, replace it now that the password is known
+                if newHash:
+                    conn = db.getConn()
+                    cur = conn.cursor()
+                    cur.execute("update users set password = %s where email = %s", (newHash, data['email']))
+                    conn.commit()
+                    cur.close()
+
+                # Update current session information, under a new session id
+                session.regenerate()
                 session['logged_in'] = True
                 session['username'] = data['email']
                 session['user_type'] = usertype
+                identity.remember(data['email'], identity.fromRow(data))
 
                 # Redirect to correct home page
                 flash('You are now logged in', 'success')
@@ -159,7 +206,9 @@ def isLoggedAdmin(f):
 @app.route('/logout')
 @isLoggedIn
 def logout():
+    identity.invalidate(session.get('username'))
     session.clear()
+    session.regenerate()
     flash('You are now logged out', 'success')
     return redirect(url_for('login'))
 
@@ -181,29 +230,23 @@ def adminHome():
 # If user is using administrative account (admin account)
 # they will likely not have a corresponding employees entry
 # and this routine will simply flash an error
+# Placement comes from the identity cache, so a cached page load does no queries and a miss does one
 @app.route('/employeeHome')
 @isLoggedIn
 def employeeHome():
-    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    username = session['username']
+    user = identity.get(session['username'], db.getConn)
 
     # Check that account exists in employees
-    cur.execute("select assignedTo, lastUpdate from employees where email=%s", [username])
-    if cur.rowcount > 0:
-        row = cur.fetchone()
-
+    if user is not None and user['assignedto'] is not None:
         # Provides name of location if employee is assigned
-        if row['assignedto'] == 0:
+        if user['assignedto'] == 0:
             location = "Unassigned"
         else:
-            cur.execute("select name from locations where id = %s", [row['assignedto']])
-            location = cur.fetchone()['name']
+            location = user['assignedname']
 
-        cur.close()
-        return render_template('employeeHome.html', valid=True, employee=row, location=location)
+        return render_template('employeeHome.html', valid=True, employee=user, location=location)
 
     # If placement account does not exist, throw error
-    cur.close()
     flash('Error fetching placement information', "warning")
     return render_template('employeeHome.html', valid=False)
 
@@ -213,26 +256,38 @@ def employeeHome():
 # Will display current number of employees and allow the user to submit requests to admin users
 # If user is using admin account, they will not have a corresponding location entry
 # and this routine will simply flash an error
+# The location id comes from the identity cache, the location, its employees and its open requests are then
+# fetched with one query
 @app.route('/locUserHome')
 @isLoggedLocUser
 def locUserHome():
-    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    username = session['username']
+    user = identity.get(session['username'], db.getConn)
 
     # Check that account has associated location entry (checking the user is not admin)
-    cur.execute("select * from locations where email=%s", [username])
-    if cur.rowcount > 0:
-        # Get users and requests associated with location
+    if user is not None and user['locationid'] is not None:
+        conn = db.getConn()
+        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+
+        # Get users and requests associated with location, timestamps are formatted the way str(datetime) would
+        cur.execute("""select l.*,
+                              coalesce((select json_agg(e order by e.name) from (
+                                  select name, email, to_char(lastupdate, 'YYYY-MM-DD HH24:MI:SS') as lastupdate
+                                  from employees where assignedto = l.id) e), '[]') as employees,
+                              coalesce((select json_agg(r order by r.datesubmit) from (
+                                  select name, quantity, datereq, datesubmit
+                                  from requests where id = l.id and status = true) r), '[]') as requests
+                       from locations l where l.id = %s""", [user['locationid']])
         loc = cur.fetchone()
-        cur.execute("select * from employees where assignedTo = %s order by name asc", [loc['id']])
-        emps = cur.fetchall()
-        cur.execute("select * from requests where id = %s and status = true order by datesubmit asc", [loc['id']])
-        reqs = cur.fetchall()
         cur.close()
-        return render_template('locUserHome.html', valid=True, location=loc, employees=emps, requests=reqs)
+
+        if loc is not None:
+            return render_template('locUserHome.html', valid=True, location=loc, employees=loc['employees'],
+                                   requests=loc['requests'])
+
+        # Location was deleted since the identity was cached
+        identity.invalidate(session['username'])
 
     # If location account does not exist, throw error
-    cur.close()
     flash('Error fetching location information', "warning")
     return render_template('locUserHome.html', valid=False)
 
@@ -244,24 +299,46 @@ def locUserHome():
 
 # View Employees
 # Function redirects to page presenting list of all employees
+# List is keyset paginated, sorted and filtered server side (see pagination.py)
+# With ?all=1 the full list is streamed to the client instead, for exporting
+# Responses carry an ETag/Last-Modified from the table versions, unchanged tables get a 304 and pages are
+# served from the fragment cache (see httpcache.py)
 @app.route('/viewEmployees')
 @isLoggedAdmin
 def viewEmployees():
-    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    cur.execute("select * from employees where email in (select email from users where usertype=2)")
+    stamp = httpcache.PageStamp(('employees', 'users'), db.getConn)
+    if stamp.fresh():
+        return stamp.notModified()
 
-    # Test if employees exist in DB, if not, exit prematurely
-    if cur.rowcount > 0:
-        rows = cur.fetchall()
+    if request.args.get('all'):
+        rows = db.streamQuery("select * from employees where email in (select email from users where usertype=2) "
+                              "order by name asc, email asc")
+        if rows is not None:
+            app.logger.info('Streaming employees')
+            return stamp.finish(Response(stream_template('viewEmployees.html', employees=rows, page=None)))
+
+        flash('No employees found', 'info')
+        return render_template('adminHome.html')
 
+    # Renders the employee table, empty if there are no employees (and no filter)
+    def renderTable():
+        cur = db.getConn().cursor(cursor_factory=psycopg2.extras.DictCursor)
+        page = pagination.keysetPage(cur, 'employees',
+                                     sql.SQL("email in (select email from users where usertype=2)"), [], request.args)
+        cur.close()
+
+        if page.rows or request.args:
+            return render_template('includes/_employeesTable.html', employees=page.rows, page=page)
+        return ''
+
+    table = stamp.fragment(renderTable)
+
+    # Test if employees exist in DB (or match the filter), if not, exit prematurely
+    if table:
         # Debugging, might flood log if left on when live
         app.logger.info('Fetched employees')
-        # for row in rows:
-        #    app.logger.info(row['email'])
 
-        # Closing statements
-        cur.close()
-        return render_template('viewEmployees.html', employees=rows)
+        return stamp.finish(render_template('viewEmployees.html', table=table))
 
     else:
         flash('No employees found', 'info')
@@ -270,24 +347,41 @@ def viewEmployees():
 
 # View Locations
 # Function redirects to page presenting list of all locations
+# The rendered list is cached per locations table version and validated with ETags (see httpcache.py)
+# Lists too long to cache are read from a server side cursor and the page is streamed, so memory use doesn't
+# grow with the table
 @app.route('/viewLocations')
 @isLoggedAdmin
 def viewLocations():
-    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    cur.execute("select * from locations order by id asc")
-
-    # Test if locations exist in DB, if not, exit prematurely
-    if cur.rowcount > 0:
+    stamp = httpcache.PageStamp(('locations',), db.getConn)
+    if stamp.fresh():
+        return stamp.notModified()
+
+    # Renders the location table, empty if there are no locations and None if there are too many to cache
+    def renderTable():
+        cur = db.getConn().cursor(cursor_factory=psycopg2.extras.DictCursor)
+        cur.execute("select * from locations order by id asc limit %s", [cache.CACHEMAXROWS + 1])
         rows = cur.fetchall()
+        cur.close()
 
+        if len(rows) > cache.CACHEMAXROWS:
+            return None
+        return render_template('includes/_locationsTable.html', locations=rows) if rows else ''
+
+    table = stamp.fragment(renderTable)
+    rows = db.streamQuery("select * from locations order by id asc") if table is None else None
+
+    # Test if locations exist in DB, if not, exit prematurely
+    if table:
         # Debugging, might flood log if left on when live
         app.logger.info('Fetched locations')
-        for row in rows:
-            app.logger.info(str(row['id']) + ' ' + row['name'])
 
-        # Closing statements
-        cur.close()
-        return render_template('viewLocations.html', locations=rows)
+        return stamp.finish(render_template('viewLocations.html', table=table))
+
+    elif rows is not None:
+        app.logger.info('Streaming locations')
+
+        return stamp.finish(Response(stream_template('viewLocations.html', locations=rows)))
 
     else:
         flash('No locations found', 'info')
@@ -299,52 +393,54 @@ def viewLocations():
 @app.route('/viewRequests', methods=['GET', 'POST'])
 @isLoggedAdmin
 def viewRequests():
+    conn = db.getConn()
     cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
 
     if request.method == 'POST':
         app.logger.info("In POST")
 
-        close = 0
         # When requests assign button is clicked, the quantity of employees requested are reassigned to the
         # requester's location If quantity can not be reached, all unassigned employees are reassigned to the
         # requester's location. Assignment order is based on employee name, sorted lexicographically
-        if request.form.get('assign'):
-            reqnum = request.form.get('assign')
-
-            # Fetch the info of the request from the DB
-            cur.execute("select quantity, id, name from requests where reqnum = %s", [reqnum])
-            if cur.rowcount < 1:
-                flash('Error fetching request info", "error')
+        # Assignment and closing the request happen in one set-based transaction (see assignment.py)
+        # The assign nearest button picks the employees living closest to the location first instead
+        if request.form.get('assign') or request.form.get('assignNearest'):
+            try:
+                reqnum = int(request.form.get('assign') or request.form.get('assignNearest'))
+            except ValueError:
+                flash('Invalid request number', 'danger')
                 return redirect(url_for('viewRequests'))
-            req = cur.fetchone()
-
-            # Get number of employees
-            cur.execute("select assignedto from employees where assignedto = 0")
-            numEmp = cur.rowcount
+            nearest = bool(request.form.get('assignNearest'))
+            currentTime = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
-            # Determine if requested number of employees greater than available number of employees
-            maxNum = numEmp if numEmp < req['quantity'] else req['quantity']
-
-            # Get maxNum number of users from unassigned pool
-            cur.execute("select email from employees where assignedto = 0 order by name asc")
-            employees = cur.fetchmany(maxNum)
+            req, emails = assignment.assignRequest(cur, reqnum, currentTime, nearest)
+            if req is None:
+                conn.rollback()
+                flash('Request not found or already closed', 'warning')
+                return redirect(url_for('viewRequests'))
+            conn.commit()
+            identity.invalidate(*emails)
+            cache.invalidate('locations')
 
-            # Reassign employees
-            for emp in employees:
-                cur.execute("update employees set assignedto = %s where email = %s", (req['id'], emp[0]))
-            cur.execute("update locations set numemployees = numemployees + %s where id = %s", (maxNum, req['id']))
+            flash("Reassigned {} employees to {}-{}".format(len(emails), req['id'], req['name']), "info")
 
-            flash("Reassigned {} employees to {}-{}".format(maxNum, req['id'], req['name']), "info")
+        # When the fulfil all button is clicked, every open request is fulfilled in one pass, earliest requested
+        # date first and sharing proportionally when there aren't enough unassigned employees (see assignment.py)
+        # Runs as a background job, the admin is sent to its status page
+        elif request.form.get('fulfilAll'):
+            id = jobs.enqueue(cur, 'fulfilAll', {}, 1, session['username'])
             conn.commit()
+            cur.close()
+            return redirect(url_for('jobStatus', id=id))
 
-            close = reqnum
         # When the open or close buttons are clicked, the requests status is updated to true or false respectively
-        # Requests are automatically closed after pressing the assign button
-        if request.form.get('invert') or close:
-            # Determine request number
-            reqnum = close
-            if request.form.get('invert'):
-                reqnum = request.form.get('invert')
+        # Requests are automatically closed by the assign button above
+        elif request.form.get('invert'):
+            try:
+                reqnum = int(request.form.get('invert'))
+            except ValueError:
+                flash('Invalid request number', 'danger')
+                return redirect(url_for('viewRequests'))
 
             # Get the current status of request based on reqnum
             cur.execute("select status from requests where reqnum = %s", [reqnum])
@@ -360,15 +456,30 @@ def viewRequests():
         cur.close()
         return redirect(url_for('viewRequests'))
     else:
-        cur.execute("select * from requests where status = true")
-        rows = cur.fetchall()
+        # Rendered tables are cached per requests table version and validated with ETags (see httpcache.py)
+        cur.close()
+        stamp = httpcache.PageStamp(('requests',), db.getConn)
+        if stamp.fresh():
+            return stamp.notModified()
+
+        # Renders the open and closed request tables, empty if there are no requests
+        def renderTables():
+            cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+            cur.execute("select * from requests where status = true")
+            rows = cur.fetchall()
+
+            cur.execute("select * from requests where status = false")
+            orows = cur.fetchall()
+            cur.close()
 
-        cur.execute("select * from requests where status = false")
-        orows = cur.fetchall()
+            if rows or orows:
+                return render_template('includes/_requestsTables.html', orequests=rows, crequests=orows)
+            return ''
 
-        if rows or orows:
-            cur.close()
-            return render_template('viewRequests.html', orequests=rows, crequests=orows)
+        table = stamp.fragment(renderTables)
+
+        if table:
+            return stamp.finish(render_template('viewRequests.html', table=table))
         else:
             flash('No requests found', 'info')
             return render_template('adminHome.html')
@@ -390,6 +501,7 @@ def viewRequests():
 @app.route('/deleteEmployee', methods=['GET', 'POST'])
 @isLoggedAdmin
 def deleteEmployee():
+    conn = db.getConn()
     cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
 
     # Submitting employee(s) to be deleted
@@ -400,40 +512,28 @@ def deleteEmployee():
         # Gets form information from deleteEmployee.html
         delete = request.form.getlist('empDel')
 
-        # Track number of employees deleted
-        numDel = 0
-
         # Deletes all employees in delete list, so long as confirm was selected
+        # Runs as a background job (see jobs.deleteEmployees), the flash links to its status page
         if delete:
-            # Get assignedto, if assignedto > 0 lower from location's numEmployee count, then drop employee
-            # users and employees
-            for email in delete:
-                cur.execute("select assignedto from employees where email= %s", [email])
-                row = cur.fetchone()
-
-                if row['assignedto'] > 0:
-                    cur.execute("update locations set numemployees = numemployees - 1 where id= %s",
-                                [row['assignedto']])
-
-                # Query will cascade and delete employees entry as well
-                cur.execute("delete from users where email = %s", [email])
-                conn.commit()
-                numDel += 1
+            id = jobs.enqueue(cur, 'deleteEmployees', {'emails': delete}, len(delete), session['username'])
+            conn.commit()
+            cur.close()
+            flashJob(id, 'Deleting {} employees'.format(len(delete)))
+            return redirect(url_for('deleteEmployee'))
 
         cur.close()
-        flash('Deleted {} employees'.format(numDel), 'info')
+        flash('No employees selected', 'info')
         return redirect(url_for('deleteEmployee'))
 
     # Get request
     else:
-        # Grabs all employee info
-        cur.execute("select * from employees")
+        # Grabs one page of employee info
+        page = pagination.keysetPage(cur, 'employees', sql.SQL("true"), [], request.args)
+        cur.close()
 
-        # Only displays if employees exist in DB
-        if cur.rowcount > 0:
-            row = cur.fetchall()
-            cur.close()
-            return render_template('deleteEmployee.html', employees=row)
+        # Only displays if employees exist in DB (or match the filter)
+        if page.rows or request.args:
+            return render_template('deleteEmployee.html', employees=page.rows, page=page)
         else:
             # If the location doesn't exist, user sent back to adminHome.html
             flash('No users found', 'info')
@@ -447,6 +547,7 @@ def deleteEmployee():
 @app.route('/deleteLocation', methods=['GET', 'POST'])
 @isLoggedAdmin
 def deleteLocation():
+    conn = db.getConn()
     cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
 
     # Submitting location(s) to be deleted
@@ -457,36 +558,36 @@ def deleteLocation():
         # Gets form information from deleteLocation.html
         delete = request.form.getlist('locDel')
 
-        # Track number of locations deleted
-        numDel = 0
-
         # Deletes all locations in delete list, so long as confirm was selected
+        # Runs as a background job (see jobs.deleteLocations), the flash links to its status page
         if delete:
-            for id in delete:
-                cur.execute("select email from locations where id = %s", [id])
-                email = cur.fetchone()['email']
-
-                cur.execute("update employees set assignedto = 0 where assignedto = %s", [id])
-
-                # Query will cascade and delete locations entry as well
-                cur.execute("delete from users where email = %s", [email])
-                conn.commit()
-                numDel += 1
+            try:
+                ids = [int(id) for id in delete]
+            except ValueError:
+                cur.close()
+                flash('Invalid location selected', 'danger')
+                return redirect(url_for('deleteLocation'))
+            id = jobs.enqueue(cur, 'deleteLocations', {'ids': ids}, len(ids), session['username'])
+            conn.commit()
+            cur.close()
+            flashJob(id, 'Deleting {} location(s)'.format(len(ids)))
+            return redirect(url_for('deleteLocation'))
 
         cur.close()
-        flash('Deleted {} location(s)'.format(numDel), 'info')
+        flash('No locations selected', 'info')
         return redirect(url_for('deleteLocation'))
 
     # Get request
     else:
-        # Grabs all employee info
-        cur.execute("select * from locations order by id asc")
+        # Grabs all location info, cached or streamed from a server side cursor if there are too many to cache
+        cur.close()
+        rows = cache.locations(db.getConn)
+        if rows is None:
+            rows = db.streamQuery("select * from locations order by id asc")
 
         # Only displays if locations exist in DB
-        if cur.rowcount > 0:
-            row = cur.fetchall()
-            cur.close()
-            return render_template('deleteLocation.html', locations=row)
+        if rows:
+            return Response(stream_template('deleteLocation.html', locations=rows))
         else:
             # If the location doesn't exist, user sent back to adminHome.html
             flash('No locations found', 'info')
@@ -530,10 +631,13 @@ class NewLocationForm(Form):
 def newEmployee():
     form = NewEmployeeForm(request.form)
 
-    # Fetch all locations from DB for assignment dropdown in form
+    # Fetch all locations for assignment dropdown in form, from the locations cache when there aren't too many
+    conn = db.getConn()
     cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    cur.execute("select * from locations order by id asc")
-    rows = cur.fetchall()
+    rows = cache.locations(db.getConn)
+    if rows is None:
+        cur.execute("select * from locations order by id asc")
+        rows = cur.fetchall()
 
     if request.method == 'POST' and form.validate():
         app.logger.info('In POST')
@@ -556,19 +660,16 @@ def newEmployee():
 
         # Add new user to DB for logging info
         cur.execute("insert into users(email, password, usertype) values(%s, %s, %s)",
-                    (email, sha256_crypt.hash(password), usertype))
+                    (email, passwords.hash(password), usertype))
 
         # Add new user to DB for placement info, only if user is an employee
         if usertype == '2':
             cur.execute('insert into employees values(%s, %s, %s, %s)',
                         (email, name, assignedto, currentTime))
 
-            # If new user assigned to location (assignedto != 0), update locations numemployees column
-            if assignedto != 0:
-                cur.execute("update locations set numemployees = numemployees + 1 where id = %s", [assignedto])
-
         conn.commit()
         cur.close()
+        cache.invalidate('locations')
 
         flash('New User has been added to the database', 'success')
 
@@ -596,6 +697,7 @@ def newLocation():
         email = form.email.data
         password = form.password.data
 
+        conn = db.getConn()
         cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
 
         # Check location account doesn't already exist
@@ -609,11 +711,12 @@ def newLocation():
 
         # Create user corresponding to the new location
         cur.execute("insert into users(email, password, usertype) values(%s, %s, 3)",
-                    (email, sha256_crypt.hash(password)))
+                    (email, passwords.hash(password)))
         # Insert location
         cur.execute("insert into locations(address, name, email, lastupdate) values(%s, %s, %s, %s)",
                     (address, name, email, currentTime))
         conn.commit()
+        cache.invalidate('locations')
 
         cur.close()
 
@@ -657,19 +760,19 @@ def newRequest():
             flash('Invalid date specified', 'warning')
             return render_template('newRequest.html')
 
-        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-
         # Get ID of location associated with user account
-        cur.execute("select id, name from locations where email = %s", [session['username']])
-        loc = cur.fetchone()
+        user = identity.get(session['username'], db.getConn)
 
-        if not loc:
+        if user is None or user['locationid'] is None:
             flash('Error fetching location information', 'error')
             return render_template('newRequest.html')
 
+        conn = db.getConn()
+        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+
         # Add request to DB request table
-        cur.execute("insert into requests(quantity, datereq, datesubmit, name, id) values(%s, %s, %s, %s)",
-                    (numEmployees, dateRequested, currentDate, loc['name'], loc['id']))
+        cur.execute("insert into requests(quantity, datereq, datesubmit, name, id) values(%s, %s, %s, %s, %s)",
+                    (numEmployees, dateRequested, currentDate, user['locationname'], user['locationid']))
         conn.commit()
 
         cur.close()
@@ -687,27 +790,31 @@ def newRequest():
 
 # Assign Employees to Locations
 # Redirects to assignEmployees.html, Won't redirect if there are no locations
-# Allows user to choose a location to edit the assigned employees of
+# Allows user to choose a location to edit the assigned employees of, both lists can be searched (see searchTable)
 @app.route('/assignEmployees')
 @isLoggedAdmin
 def assignEmployees():
+    conn = db.getConn()
     cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    cur.execute("select * from locations order by ID asc")
+    rows = cache.locations(db.getConn)
+    if rows is None:
+        cur.execute("select * from locations order by ID asc")
+        rows = cur.fetchall()
 
     # Test if locations exist in DB, if not, exit prematurely
-    if cur.rowcount > 0:
-        rows = cur.fetchall()
-        cur.execute("select name, email, assignedto from employees where assignedto = 0")
+    if rows:
+        # Only the first page of unassigned employees is listed, the rest are found with the search box
+        cur.execute("select name, email, assignedto from employees where assignedto = 0 order by name, email "
+                    "limit %s", [pagination.PAGESIZE + 1])
         urows = cur.fetchall()
 
         # Logging
         app.logger.info('Fetched locations and unassigned employees')
-        for row in rows:
-            app.logger.info(row['name'])
 
         # Closing statements
         cur.close()
-        return render_template('assignEmployees.html', locations=rows, employees=urows)
+        return render_template('assignEmployees.html', locations=rows, employees=urows[:pagination.PAGESIZE],
+                               more=len(urows) > pagination.PAGESIZE)
 
     else:
         flash('No locations found', 'info')
@@ -717,9 +824,11 @@ def assignEmployees():
 # Location Employees
 # Function redirects to page detailing information on a specific location, as specified in the path
 # Also lists the employees assigned to the location
+# Unassigned employees are listed by name, or with ?nearest=1 by distance from the location
 @app.route('/locationEmployees/<int:id>', methods=['GET', 'POST'])
 @isLoggedAdmin
 def locationEmployees(id):
+    conn = db.getConn()
     cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
 
     # Submitting employee information to be assigned
@@ -733,42 +842,36 @@ def locationEmployees(id):
 
         currentTime = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
-        # Removes selected employees from location, lowers num employees column for each employee removed
-        if emailRemove:
-            for email in emailRemove:
-                cur.execute("update employees set assignedto = 0, lastupdate = %s where email = %s",
-                            (currentTime, email))
-                cur.execute("update locations set numemployees = numemployees - 1, lastupdate = %s where id = %s",
-                            (currentTime, id))
-                conn.commit()
-
-        # Assign employees to new location, increase num employees column for each employee assigned
-        if emailAdd:
-            for email in emailAdd:
-                cur.execute("update employees set assignedto = %s, lastupdate = %s where email = %s",
-                            (id, currentTime, email))
-                cur.execute("update locations set numemployees = numemployees + 1, lastupdate = %s where id = %s",
-                            (currentTime, id))
-                conn.commit()
+        # Removes selected employees from location and assigns the selected unassigned employees to it
+        # Done as one transaction with bulk updates, num employees columns are corrected from the rows changed
+        if emailAdd or emailRemove:
+            assignment.moveEmployees(cur, id, emailAdd, emailRemove, currentTime)
+            conn.commit()
+            identity.invalidate(*emailAdd, *emailRemove)
+            cache.invalidate('locations')
+        cur.close()
 
         # Will reach at end of POST request, redirects to URL as GET request
         return redirect(url_for('locationEmployees', id=id))
 
     # Get request
     else:
-        # Grabs location info and employee info (assigned to this location and unassigned)
-        cur.execute("select * from locations where id = %s", [id])
-        result = cur.rowcount
-        row = cur.fetchone()
-        cur.execute("select * from employees where assignedto = %s", [id])
+        # Grabs location info (cached) and employee info (assigned to this location and unassigned)
+        row = cache.location(id, db.getConn)
+        cur.execute("select * from employees where assignedto = %s order by name asc", [id])
         prows = cur.fetchall()
-        cur.execute("select * from employees where assignedto = 0")
-        urows = cur.fetchall()
+        if row is not None and request.args.get('nearest'):
+            page = None
+            urows = assignment.nearestUnassigned(cur, row, pagination.pageArgs(request.args)[3])
+        else:
+            page = pagination.keysetPage(cur, 'employees', sql.SQL("assignedto = 0"), [], request.args)
+            urows = page.rows
         cur.close()
 
         # locationEmployees.html depends on the location existing in the DB
-        if result > 0:
-            return render_template('locationEmployees.html', location=row, assigned=prows, unassigned=urows)
+        if row is not None:
+            return render_template('locationEmployees.html', location=row, assigned=prows, unassigned=urows,
+                                   page=page)
         else:
             # If the location doesn't exist, user sent back to assignEmployees.html
             return redirect(url_for('assignEmployees'))
@@ -779,6 +882,7 @@ def locationEmployees(id):
 @app.route('/employeeInfo/<string:email>', methods=['GET', 'POST'])
 @isLoggedAdmin
 def employeeInfo(email):
+    conn = db.getConn()
     cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
     cur.execute("select * from employees where email = %s", [email])
     emp = cur.fetchone()
@@ -811,6 +915,7 @@ def employeeInfo(email):
             cur.execute("update employees set name = %s where email = %s", (name, email))
 
             conn.commit()
+            identity.invalidate(emp['email'], email)
 
         cur.close()
         return redirect(url_for('viewEmployees'))
@@ -834,15 +939,16 @@ def employeeInfo(email):
 @app.route('/locationInfo/<int:id>', methods=['GET', 'POST'])
 @isLoggedAdmin
 def locationInfo(id):
-    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    cur.execute("select * from locations where id = %s", [id])
-    loc = cur.fetchone()
-
     # Submitting employee information to be assigned
     if request.method == 'POST':
 
         app.logger.info('In POST')
 
+        conn = db.getConn()
+        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        cur.execute("select * from locations where id = %s", [id])
+        loc = cur.fetchone()
+
         # Get updated data from form
         email = request.form['email']
         name = request.form['name']
@@ -868,23 +974,161 @@ def locationInfo(id):
             cur.execute("update locations set name = %s, address = %s where email = %s", (name, address, email))
 
             conn.commit()
+            identity.invalidateLocation(id)
+            cache.invalidate('locations')
 
         cur.close()
         return redirect(url_for('viewLocations'))
 
     # Get request
     else:
-        # Grabs info of selected location
-        if cur.rowcount > 0:
-            cur.close()
+        # Grabs info of selected location, from the locations cache
+        loc = cache.location(id, db.getConn)
+        if loc is not None:
             return render_template('locationInfo.html', location=loc)
         else:
-            cur.close()
             # If the location doesn't exist, user sent back to viewLocations.html
             flash("Error getting location info", "error")
             return render_template('viewLocations.html')
 
 
+###########################################
+################ SEARCH ###################
+###########################################
+
+
+# Search
+# JSON search for the typeaheads: employees by name or email, or locations by name or address, best matches
+# first (see search.py). ?q= is the query, ?limit= the number of results and ?unassigned=1 only searches
+# unassigned employees
+@app.route('/search/<string:table>')
+@isLoggedAdmin
+def searchTable(table):
+    if table not in search.TABLES:
+        abort(404)
+    try:
+        limit = int(request.args.get('limit', search.SEARCHLIMIT))
+    except ValueError:
+        limit = search.SEARCHLIMIT
+    q = request.args.get('q', '')
+
+    cur = db.getConn().cursor(cursor_factory=psycopg2.extras.DictCursor)
+    if table == 'employees':
+        rows = search.searchEmployees(cur, q, limit, unassigned=bool(request.args.get('unassigned')))
+    else:
+        rows = search.searchLocations(cur, q, limit)
+    cur.close()
+    return jsonify(results=rows)
+
+
+###########################################
+########### BACKGROUND JOBS ###############
+###########################################
+
+# Page each job kind's status page links back to
+JOBPAGES = {'deleteEmployees': 'deleteEmployee', 'deleteLocations': 'deleteLocation', 'fulfilAll': 'viewRequests'}
+
+# Job lookup shared by the status page and endpoint, aborts with 404 if the job doesn't exist
+def getJob(id):
+    cur = db.getConn().cursor(cursor_factory=psycopg2.extras.DictCursor)
+    job = jobs.status(cur, id)
+    cur.close()
+    if job is None:
+        abort(404)
+    return job
+
+
+# Flashes that a job was queued, linking to its status page
+def flashJob(id, message):
+    link = url_for('jobStatus', id=id)
+    flash(Markup('{} in the background, <a href="{}">see its progress</a>').format(message, link), 'info')
+
+
+# Job Status
+# Page showing a background job's progress, polls jobStatusJson until the job finishes
+@app.route('/job/<int:id>')
+@isLoggedAdmin
+def jobStatus(id):
+    job = getJob(id)
+    return render_template('job.html', job=job, back=url_for(JOBPAGES.get(job['kind'], 'adminHome')))
+
+
+# Job Status JSON
+# Progress of a background job: status (queued, running, done or failed), items done out of total, and the
+# result message or error once finished
+@app.route('/job/<int:id>/status')
+@isLoggedAdmin
+def jobStatusJson(id):
+    job = getJob(id)
+    return jsonify(id=job['id'], kind=job['kind'], status=job['status'], progress=job['progress'],
+                   total=job['total'], message=(job['result'] or {}).get('message'), error=job['error'])
+
+
+###########################################
+############## BULK DATA ##################
+###########################################
+
+
+# Export Table
+# Streams a whole table (employees, locations or requests) to the client as CSV or JSON lines using
+# COPY ... TO STDOUT, so exports of any size start immediately and use constant memory
+@app.route('/export/<string:table>')
+@isLoggedAdmin
+def exportTable(table):
+    fmt = request.args.get('format', 'csv')
+
+    if table not in bulk.EXPORTS or fmt not in bulk.FORMATS:
+        flash('Unknown export', 'warning')
+        return redirect(url_for('importEmployees'))
+
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    filename = '{}.{}'.format(table, 'csv' if fmt == 'csv' else 'jsonl')
+    return Response(bulk.exportTable(table, fmt), mimetype=mimetype,
+                    headers={'Content-Disposition': 'attachment; filename=' + filename})
+
+
+# Import Employees
+# Allows admin to create many employees at once from a CSV file (email, name and optionally assignedto columns)
+# The file is loaded with COPY and merged in one transaction, rows that fail validation are skipped and reported
+# All imported accounts get the password entered in the form, hashed once
+@app.route('/importEmployees', methods=['GET', 'POST'])
+@isLoggedAdmin
+def importEmployees():
+    if request.method == 'POST':
+        app.logger.info('In POST')
+
+        csvFile = request.files.get('file')
+        password = request.form.get('password')
+
+        # Disallow empty field entries
+        if not csvFile or not csvFile.filename or not password:
+            flash('Please fill all fields', 'warning')
+            return render_template('importEmployees.html', exports=bulk.EXPORTS)
+
+        conn = db.getConn()
+        cur = conn.cursor()
+        currentTime = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+        try:
+            imported, skipped, errors = bulk.importEmployees(cur, csvFile.stream, passwords.hash(password), currentTime)
+        except (ValueError, psycopg2.DataError) as e:
+            conn.rollback()
+            cur.close()
+            flash('Import failed: {}'.format(str(e).strip()), 'warning')
+            return render_template('importEmployees.html', exports=bulk.EXPORTS)
+
+        conn.commit()
+        cur.close()
+        cache.invalidate('locations')
+
+        flash('Imported {} employees, skipped {} rows'.format(imported, skipped),
+              'success' if not skipped else 'warning')
+        return render_template('importEmployees.html', exports=bulk.EXPORTS, errors=errors, skipped=skipped)
+
+    else:
+        return render_template('importEmployees.html', exports=bulk.EXPORTS)
+
+
 # Update Password
 # Updates a user's password, old password has to match hashed version stored in DB
 # New password is subject to form validators
@@ -893,6 +1137,7 @@ def locationInfo(id):
 def updatePassword():
     if request.method == 'POST':
         app.logger.info('In POST')
+        conn = db.getConn()
         cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
 
         passwordCandidate = request.form['currentPassword']
@@ -912,9 +1157,9 @@ def updatePassword():
             return render_template('updatePassword.html')
 
         # Verify that entered password is equivalent to DB password
-        if sha256_crypt.verify(passwordCandidate, dbPass['password']):
+        if passwords.verify(passwordCandidate, dbPass['password'])[0]:
             # Update DB with new hash
-            passw = sha256_crypt.hash(newPassword)
+            passw = passwords.hash(newPassword)
             cur.execute("update users set password = %s where email=%s", (passw, session['username']))
 
             conn.commit()
@@ -929,9 +1174,59 @@ def updatePassword():
         return render_template('updatePassword.html')
 
 
+# Metrics
+# Per route request, DB and render timings in the Prometheus text format
+# Available to admin sessions, or to scrapers sending "Authorization: Bearer <METRICSTOKEN>" if a token is set
+@app.route('/metrics')
+def metricsPage():
+    authorization = request.headers.get('Authorization', '')
+    tokenValid = METRICSTOKEN and hmac.compare_digest(authorization, 'Bearer ' + METRICSTOKEN)
+    if not tokenValid and not (session.get('logged_in') and session.get('user_type') == 1):
+        abort(403)
+
+    return Response(metrics.prometheusText(), mimetype='text/plain; version=0.0.4')
+
+
+# Warm Up
+# Compiles every template and loads the locations list into the cache, so the first requests after a (re)start
+# don't pay for it. A preloading server (serve.py) calls it once before forking, its workers inherit the results
+def warm():
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+    with app.app_context():
+        cache.locations(db.getConn)
+
+
+# Starts this process's background threads: the jobs workers (JOBWORKERS, see jobs.py), and the sweepers deleting
+# expired sessions and rate limit counters every SESSIONSWEEP / LIMITSWEEP seconds
+def startBackground():
+    jobs.startWorkers()
+    sessions.startSweeper(app.session_interface.store)
+    ratelimit.startSweeper(limiter.storage)
+
+
+# Application Factory
+# Entry point for production WSGI servers, called once per worker process:
+#     gunicorn --workers 4 --threads 8 'app:create_app()'
+#     waitress-serve --threads 8 --call app:create_app
+# Run gunicorn without --preload so each worker warms up and starts its background threads itself (serve.py is
+# the preloading launcher). DB pools are opened by each process on first use (see db.py)
+# SECRETKEY must be set for every worker to sign with the same key. Sessions and rate limits are shared through
+# Postgres. The caches are per process unless CACHEURL is set, other workers see a write once their cached
+# entries expire (CACHETTL, IDENTITYTTL)
+def create_app(background=True):
+    if not os.getenv('SECRETKEY'):
+        app.logger.warning('SECRETKEY is not set, every worker process signs with its own random key')
+    warm()
+    if background:
+        startBackground()
+    return app
+
+
+# Development server, one process
 def main():
-    app.secret_key = os.urandom(12)
     app.debug = False
+    startBackground()
     app.run()
 
 if __name__ == '__main__':
@@ -0,0 +1,216 @@
+# Assign Request
+# Fulfils a single open request as one set-based statement: up to quantity unassigned employees, chosen in
+# lexicographic name order, are reassigned to the requesting location and the request is closed
+# With nearest, employees living closest to the location are chosen first (see nearestUnassigned), and only the
+# quantity left over once those with a home coordinate run out is filled in name order
+# Rows already locked by a concurrent assignment are skipped (FOR UPDATE SKIP LOCKED), and the request row
+# itself is locked, so two admins fulfilling requests at the same time never hand out the same employee
+# or fulfil the same request twice
+# Does not commit, the caller owns the transaction
+# Returns (request row, list of reassigned emails), or (None, []) if the request does not exist or is closed
+def assignRequest(cur, reqnum, currentTime, nearest=False):
+    # A missing or negative quantity assigns nobody, the request is just closed
+    cur.execute("""select reqnum, greatest(coalesce(quantity, 0), 0) as quantity, id, name, status
+                   from requests where reqnum = %s for update""", [reqnum])
+    req = cur.fetchone()
+    if req is None or not req['status']:
+        return None, []
+
+    params = {'id': req['id'], 'time': currentTime, 'quantity': req['quantity']}
+    emails = []
+    if nearest:
+        cur.execute("select latitude, longitude from locations where id = %s", [req['id']])
+        loc = cur.fetchone()
+        if loc is not None and loc['latitude'] is not None:
+            params.update(lat=loc['latitude'], lng=loc['longitude'])
+            cur.execute("""update employees set assignedto = %(id)s, lastupdate = %(time)s
+                           where email in (select email from employees where assignedto = 0 and latitude is not null
+                                           order by geo_point(latitude, longitude) <-> geo_point(%(lat)s, %(lng)s)
+                                           limit %(quantity)s for update skip locked)
+                           returning email""", params)
+            emails = [row[0] for row in cur.fetchall()]
+            params['quantity'] -= len(emails)
+
+    if params['quantity'] > 0:
+        cur.execute("""update employees set assignedto = %(id)s, lastupdate = %(time)s
+                       where email in (select email from employees where assignedto = 0
+                                       order by name asc limit %(quantity)s for update skip locked)
+                       returning email""", params)
+        emails += [row[0] for row in cur.fetchall()]
+
+    cur.execute("update requests set status = false where reqnum = %s", [reqnum])
+
+    return req, emails
+
+
+# Nearest Unassigned
+# Returns up to limit unassigned employees closest to location (a row with latitude and longitude), nearest first,
+# each with its distance in km. Ranked through the GiST index on geo_point (nearest neighbour search, so the cost
+# doesn't grow with the number of employees). Employees without a home coordinate aren't ranked
+def nearestUnassigned(cur, location, limit):
+    if location['latitude'] is None:
+        return []
+    cur.execute("""select *, geo_distance(latitude, longitude, %(lat)s, %(lng)s) as distance from employees
+                   where assignedto = 0 and latitude is not null
+                   order by geo_point(latitude, longitude) <-> geo_point(%(lat)s, %(lng)s)
+                   limit %(limit)s""",
+                {'lat': location['latitude'], 'lng': location['longitude'], 'limit': limit})
+    return cur.fetchall()
+
+
+# Move Employees
+# Assigns addEmails to location id and unassigns removeEmails from it, in two bulk statements
+# Employees already at the location aren't touched again, and employees not at the location aren't removed
+# Employee counts follow from the rows changed (see PostgreSQL/migrations/0005_employee_counts.sql)
+# Does not commit, the caller owns the transaction
+# Returns (number assigned, number removed)
+def moveEmployees(cur, id, addEmails, removeEmails, currentTime):
+    removed = 0
+    if removeEmails:
+        cur.execute("""update employees set assignedto = 0, lastupdate = %s
+                       where email = any(%s) and assignedto = %s""",
+                    (currentTime, list(removeEmails), id))
+        removed = cur.rowcount
+
+    added = 0
+    if addEmails:
+        cur.execute("""update employees set assignedto = %s, lastupdate = %s
+                       where email = any(%s) and assignedto <> %s""",
+                    (id, currentTime, list(addEmails), id))
+        added = cur.rowcount
+
+    return added, removed
+
+
+# Unassign Employees
+# Unassigns emails from whichever location they are at, in one statement
+# Does not commit, the caller owns the transaction
+# Returns the number unassigned
+def unassignEmployees(cur, emails, currentTime):
+    cur.execute("""update employees set assignedto = 0, lastupdate = %s
+                   where email = any(%s) and assignedto <> 0""",
+                (currentTime, list(emails)))
+    return cur.rowcount
+
+
+# Delete Employees
+# Drops the employees rows of emails, then their users rows, in two statements. Emails that aren't employees are
+# ignored
+# Does not commit, the caller owns the transaction
+# Returns the list of emails deleted
+def deleteEmployees(cur, emails):
+    cur.execute("delete from employees where email = any(%s) returning email", [list(emails)])
+    deleted = [row[0] for row in cur.fetchall()]
+    if deleted:
+        cur.execute("delete from users where email = any(%s)", [deleted])
+    return deleted
+
+
+# Delete Locations
+# Unassigns the employees of the locations in ids, then drops the locations with their requests and user accounts,
+# one statement each. The locations and requests foreign keys don't cascade, so the order matters
+# Does not commit, the caller owns the transaction
+# Returns (list of location ids deleted, number of employees unassigned)
+def deleteLocations(cur, ids, currentTime):
+    ids = [int(id) for id in ids]
+    cur.execute("update employees set assignedto = 0, lastupdate = %s where assignedto = any(%s)",
+                (currentTime, ids))
+    unassigned = cur.rowcount
+
+    cur.execute("delete from requests where id = any(%s)", [ids])
+    cur.execute("delete from locations where id = any(%s) returning id, email", [ids])
+    rows = cur.fetchall()
+    if rows:
+        cur.execute("delete from users where email = any(%s)", [[row[1] for row in rows]])
+    return [row[0] for row in rows], unassigned
+
+
+# Allocate
+# Works out how many of supply unassigned employees each open request gets, without touching the DB
+# Requests are served in priority order: earliest datereq first (undated last), then earliest datesubmit, then
+# reqnum. Requests sharing a datereq are served together, and when the supply left can't cover such a group
+# it is shared in proportion to their quantities (largest remainder, ties to the higher priority request)
+# and later groups get nothing
+# requests is a list of (reqnum, quantity, datereq, datesubmit)
+# Returns [(reqnum, quantity, allocated)] in priority order
+def allocate(requests, supply):
+    ordered = sorted(requests, key=lambda r: (r[2] is None, r[2] or 0, r[3] is None, r[3] or 0, r[0]))
+
+    allocation = []
+    start = 0
+    while start < len(ordered):
+        # Requests [start, end) share a datereq
+        end = start
+        while end < len(ordered) and ordered[end][2] == ordered[start][2]:
+            end += 1
+        group = [(r[0], max(r[1] or 0, 0)) for r in ordered[start:end]]
+        demand = sum(quantity for reqnum, quantity in group)
+
+        if demand <= supply:
+            allocation += [(reqnum, quantity, quantity) for reqnum, quantity in group]
+            supply -= demand
+        else:
+            # Integer shares of quantity * supply / demand, the leftover employees go to the largest remainders
+            shares = [divmod(quantity * supply, demand) for reqnum, quantity in group]
+            leftover = supply - sum(share for share, remainder in shares)
+            bonus = set(sorted(range(len(group)), key=lambda i: -shares[i][1])[:leftover])
+            allocation += [(reqnum, quantity, shares[i][0] + (i in bonus))
+                           for i, (reqnum, quantity) in enumerate(group)]
+            supply = 0
+        start = end
+
+    return allocation
+
+
+# Fulfil All
+# Fulfils every open request in one pass: the open requests and the start of the name ordered unassigned pool (as
+# many employees as they ask for in total) are loaded once, allocate() decides how many employees each request
+# gets, and the pool is handed out in priority order
+# Requests given their full quantity are closed. Requests given part of it stay open with the quantity still
+# outstanding, so a later pass (once employees free up) can finish them
+# Open requests are locked and already locked employees skipped, like assignRequest
+# Does not commit, the caller owns the transaction
+# Returns (requests closed, requests partially fulfilled, list of reassigned emails)
+def fulfilAll(cur, currentTime):
+    cur.execute("""select reqnum, quantity, datereq, datesubmit, id from requests
+                   where status = true order by reqnum for update""")
+    requests = cur.fetchall()
+    if not requests:
+        return 0, 0, []
+    locations = {row[0]: row[4] for row in requests}
+
+    # Only as many employees as the open requests ask for are locked and loaded, not the whole unassigned pool
+    demand = sum(max(row[1] or 0, 0) for row in requests)
+    pool = []
+    if demand:
+        cur.execute("""select email from employees where assignedto = 0
+                       order by name asc, email asc limit %s for update skip locked""", [demand])
+        pool = [row[0] for row in cur.fetchall()]
+
+    emails, ids = [], []
+    closed, partial = [], []
+    for reqnum, quantity, allocated in allocate([tuple(row[:4]) for row in requests], len(pool)):
+        if allocated:
+            id = locations[reqnum]
+            emails += pool[len(emails):len(emails) + allocated]
+            ids += [id] * allocated
+
+        if allocated >= quantity:
+            closed.append(reqnum)
+        elif allocated:
+            partial.append((reqnum, quantity - allocated))
+
+    if emails:
+        cur.execute("""update employees set assignedto = a.id, lastupdate = %s
+                       from unnest(%s::text[], %s::int[]) as a(email, id)
+                       where employees.email = a.email""",
+                    (currentTime, emails, ids))
+    if closed:
+        cur.execute("update requests set status = false where reqnum = any(%s)", [closed])
+    if partial:
+        cur.execute("""update requests set quantity = r.quantity
+                       from unnest(%s::int[], %s::int[]) as r(reqnum, quantity)
+                       where requests.reqnum = r.reqnum""",
+                    ([reqnum for reqnum, quantity in partial], [quantity for reqnum, quantity in partial]))
+
+    return len(closed), len(partial), emails
@@ -0,0 +1,114 @@
+# JSON API benchmark
+# Creates N employees, assigns them to a location and unassigns them again, once the way integration scripts had
+# to before the API (one HTML form POST per employee per step) and once with the batch calls of the JSON API
+# Reports calls, statements and time per step, through the Flask test client so only the app's own cost is measured
+#
+# Usage: python benchmark/apibench.py [--employees 100]
+# Creates temporary bench employees and an API token (deleted afterwards), requires a populated DB
+import argparse
+import os
+import sys
+import time
+
+# Allow running from the project root or from inside benchmark/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import api
+import assignment
+import db
+import metrics
+import passwords
+from app import app, limiter
+from loadtest import sessionCookie
+
+PASSWORD = 'apibench'
+EMAIL = 'apibench{}-{}@bench.invalid'
+
+
+# Deletes the bench employees and token
+def cleanup(emails, tokenEmail):
+    conn = db.getPool().getconn()
+    try:
+        cur = conn.cursor()
+        assignment.deleteEmployees(cur, emails)
+        cur.execute("delete from api_tokens where email = %s and name = 'apibench'", [tokenEmail])
+        conn.commit()
+        cur.close()
+    finally:
+        db.getPool().putconn(conn)
+
+
+# Runs send() for each item, returns (calls, statements, seconds)
+def timeCalls(items, send):
+    with metrics.lock:
+        metrics.routes.clear()
+    start = time.perf_counter()
+    for item in items:
+        response = send(item)
+        if response.status_code >= 400:
+            raise SystemExit('{} {}'.format(response.status_code, response.get_data(as_text=True)[:200]))
+    elapsed = time.perf_counter() - start
+    with metrics.lock:
+        statements = sum(r.queries.sum for r in metrics.routes.values())
+    return len(items), int(statements), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='HTML forms vs JSON API batch calls')
+    parser.add_argument('--employees', type=int, default=100)
+    args = parser.parse_args()
+
+    limiter.enabled = False
+    admin = 'root@admin.com'
+
+    conn = db.getPool().getconn()
+    cur = conn.cursor()
+    cur.execute("select id from locations order by id limit 1")
+    row = cur.fetchone()
+    if row is None:
+        sys.exit('No locations in DB, seed it first')
+    location = row[0]
+    token = api.createToken(cur, admin, 'apibench')
+    conn.commit()
+    cur.close()
+    db.getPool().putconn(conn)
+
+    forms = app.test_client()
+    forms.set_cookie('session', sessionCookie(admin, 1))
+    client = app.test_client()
+    headers = {'Authorization': 'Bearer ' + token}
+
+    formEmails = [EMAIL.format('form', i) for i in range(args.employees)]
+    apiEmails = [EMAIL.format('api', i) for i in range(args.employees)]
+    results = []
+    try:
+        results.append(('create', 'forms', timeCalls(formEmails, lambda email: forms.post('/newEmployee', data={
+            'email': email, 'name': 'Api Bench', 'password': PASSWORD, 'verify': PASSWORD,
+            'usertype': '2', 'assignedto': '0'}))))
+        results.append(('create', 'api', timeCalls([apiEmails], lambda emails: client.post(
+            '/api/v1/employees', headers=headers, json={
+                'password': PASSWORD, 'employees': [{'email': email, 'name': 'Api Bench'} for email in emails]}))))
+
+        results.append(('assign', 'forms', timeCalls(formEmails, lambda email: forms.post(
+            '/locationEmployees/{}'.format(location), data={'empAdd': email}))))
+        results.append(('assign', 'api', timeCalls([apiEmails], lambda emails: client.post(
+            '/api/v1/assignments', headers=headers, json={'location': location, 'emails': emails}))))
+
+        results.append(('unassign', 'forms', timeCalls(formEmails, lambda email: forms.post(
+            '/locationEmployees/{}'.format(location), data={'empRemove': email}))))
+        results.append(('unassign', 'api', timeCalls([apiEmails], lambda emails: client.delete(
+            '/api/v1/assignments', headers=headers, json={'emails': emails}))))
+    finally:
+        cleanup(formEmails + apiEmails, admin)
+        passwords.shutdown()
+
+    print('{} employees'.format(args.employees))
+    print('{:<10} {:<6} {:>7} {:>11} {:>10} {:>16}'.format('step', 'via', 'calls', 'statements', 'total ms',
+                                                            'ms per employee'))
+    for step, via, (calls, statements, elapsed) in results:
+        print('{:<10} {:<6} {:>7} {:>11} {:>10.1f} {:>16.3f}'.format(
+            step, via, calls, statements, elapsed * 1000, elapsed * 1000 / args.employees))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+# Assignment benchmark
+# Compares the legacy per-row request assignment (one UPDATE per employee) against the set-based
+# assignment.assignRequest at a configurable number of unassigned employees, then times the fulfil all pass
+# (assignment.fulfilAll) over many open requests, and its in-memory allocation step on its own
+# Everything runs inside one transaction that is rolled back at the end, so the DB is left untouched
+#
+# Usage: python benchmark/assignbench.py [--employees 10000] [--quantity 500] [--requests 1000] [--repeat 5]
+#        python benchmark/assignbench.py --employees 100000 --requests 10000 --skip-legacy
+# Requires the schema from setup.py and at least one location
+import argparse
+import io
+import os
+import random
+import sys
+import time
+from datetime import datetime
+
+# Allow running from the project root or from inside benchmark/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import psycopg2.extras
+
+import assignment
+import db
+
+
+# Legacy Assign
+# The assignment path viewRequests used before the set-based rewrite, kept here only as the baseline
+def legacyAssign(cur, reqnum):
+    cur.execute("select quantity, id, name from requests where reqnum = %s", [reqnum])
+    req = cur.fetchone()
+
+    cur.execute("select assignedto from employees where assignedto = 0")
+    numEmp = cur.rowcount
+    maxNum = numEmp if numEmp < req['quantity'] else req['quantity']
+
+    cur.execute("select email from employees where assignedto = 0 order by name asc")
+    employees = cur.fetchmany(maxNum)
+    for emp in employees:
+        cur.execute("update employees set assignedto = %s where email = %s", (req['id'], emp[0]))
+    cur.execute("update locations set numemployees = numemployees + %s where id = %s", (maxNum, req['id']))
+    cur.execute("update requests set status = false where reqnum = %s", [reqnum])
+    return maxNum
+
+
+# Inserts num unassigned employees (and their users rows) using COPY, all sharing one dummy password hash
+def seedEmployees(cur, num):
+    currentTime = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    users = io.StringIO()
+    employees = io.StringIO()
+    for i in range(num):
+        email = 'bench{:07d}@bench.invalid'.format(i)
+        users.write('{}\tx\t2\n'.format(email))
+        employees.write('{}\tBench {:07d}\t0\t{}\n'.format(email, num - i, currentTime))
+    users.seek(0)
+    employees.seek(0)
+    cur.copy_from(users, 'users', columns=('email', 'password', 'usertype'))
+    cur.copy_from(employees, 'employees', columns=('email', 'name', 'assignedto', 'lastupdate'))
+
+
+# Inserts num open requests spread over the locations, with quantities adding up to about twice the employees
+# so the allocation has to share, and requested dates over the next 30 days
+def seedRequests(cur, num, locations, employees):
+    rng = random.Random(1)
+    rows = io.StringIO()
+    for i in range(num):
+        loc = locations[i % len(locations)]
+        quantity = rng.randint(1, max(1, 4 * employees // max(num, 1)))
+        rows.write('{}\tcurrent_date\t{}\t{}\n'.format(quantity, loc['name'], loc['id']))
+    rows.seek(0)
+    cur.execute("create temporary table bench_requests (quantity int, datereq text, name text, id int) on commit drop")
+    cur.copy_from(rows, 'bench_requests')
+    cur.execute("""insert into requests(quantity, datereq, datesubmit, name, id)
+                   select quantity, current_date + (random() * 30)::int, current_date, name, id from bench_requests""")
+
+
+# Times fn(cur) repeat times, rolling back to a savepoint after each run. Returns the list of timings
+def timeRuns(cur, fn, repeat):
+    timings = []
+    for i in range(repeat):
+        cur.execute("savepoint run")
+        start = time.perf_counter()
+        fn(cur)
+        timings.append(time.perf_counter() - start)
+        cur.execute("rollback to savepoint run")
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Per-row vs set-based request assignment')
+    parser.add_argument('--employees', type=int, default=10000, help='unassigned employees to seed')
+    parser.add_argument('--quantity', type=int, default=500, help='employees requested')
+    parser.add_argument('--requests', type=int, default=1000, help='open requests for the fulfil all pass')
+    parser.add_argument('--skip-legacy', action='store_true', help="don't run the per-row baseline (slow past 10k)")
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    conn = db.getPool().getconn()
+    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    try:
+        cur.execute("select id, name from locations order by id asc")
+        locations = cur.fetchall()
+        if not locations:
+            sys.exit('No locations in DB, run setup.py first')
+        loc = locations[0]
+
+        seedEmployees(cur, args.employees)
+        cur.execute("insert into requests(quantity, datereq, datesubmit, name, id) "
+                    "values(%s, current_date, current_date, %s, %s) returning reqnum",
+                    (args.quantity, loc['name'], loc['id']))
+        reqnum = cur.fetchone()[0]
+        cur.execute("analyze employees")
+
+        currentTime = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        results = {}
+        if not args.skip_legacy:
+            results['per-row'] = timeRuns(cur, lambda c: legacyAssign(c, reqnum), args.repeat)
+        results['set-based'] = timeRuns(cur, lambda c: assignment.assignRequest(c, reqnum, currentTime), args.repeat)
+
+        # Fulfil all, end to end and the allocation compute alone
+        seedRequests(cur, args.requests, locations, args.employees)
+        cur.execute("analyze requests")
+        results['fulfil-all'] = timeRuns(cur, lambda c: assignment.fulfilAll(c, currentTime), args.repeat)
+
+        cur.execute("select reqnum, quantity, datereq, datesubmit from requests where status = true")
+        requests = [tuple(row) for row in cur.fetchall()]
+        allocations = []
+        for i in range(args.repeat):
+            start = time.perf_counter()
+            assignment.allocate(requests, args.employees)
+            allocations.append(time.perf_counter() - start)
+        results['allocate'] = allocations
+
+        print('{} unassigned employees, request for {}, {} open requests for fulfil all'.format(
+            args.employees, args.quantity, len(requests)))
+        print('{:<10} {:>10} {:>10} {:>10}'.format('path', 'best ms', 'mean ms', 'worst ms'))
+        for name, timings in results.items():
+            print('{:<10} {:>10.2f} {:>10.2f} {:>10.2f}'.format(
+                name, min(timings) * 1000, sum(timings) / len(timings) * 1000, max(timings) * 1000))
+    finally:
+        conn.rollback()
+        cur.close()
+        db.getPool().putconn(conn)
+        db.getPool().closeall()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+# Delete benchmark
+# Compares the legacy per-item deletes of deleteEmployee/deleteLocation (several statements per email or id)
+# against the set-based assignment.deleteEmployees and assignment.deleteLocations, reporting time and statements
+# Everything runs inside one transaction that is rolled back at the end, so the DB is left untouched. The legacy
+# paths committed after every item, which isn't possible here, and without those commits every statement's
+# table_versions bump piles up in the one transaction and slows the next, so they only delete the first --legacy
+# items (per-item cost is what matters for them)
+#
+# Usage: python benchmark/deletebench.py [--employees 10000] [--locations 10000] [--legacy 1000] [--repeat 3]
+# Requires the schema from setup.py
+import argparse
+import io
+import os
+import sys
+import time
+from datetime import datetime
+
+# Allow running from the project root or from inside benchmark/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import psycopg2.extras
+
+import assignment
+import db
+
+
+# Counts the statements executed through it
+class CountingCursor(psycopg2.extras.DictCursor):
+    statements = 0
+
+    def execute(self, query, vars=None):
+        CountingCursor.statements += 1
+        return super().execute(query, vars)
+
+
+# Legacy Delete Employees
+# The per-email path deleteEmployee used before the set-based rewrite, kept here only as the baseline
+def legacyDeleteEmployees(cur, emails):
+    for email in emails:
+        cur.execute("select assignedto from employees where email= %s", [email])
+        row = cur.fetchone()
+
+        if row['assignedto'] > 0:
+            cur.execute("update locations set numemployees = numemployees - 1 where id= %s", [row['assignedto']])
+
+        cur.execute("delete from users where email = %s", [email])
+    return len(emails)
+
+
+# Legacy Delete Locations
+# The per-id path deleteLocation used before the set-based rewrite (with the requests and locations deletes
+# it needed to get past the non-cascading foreign keys)
+def legacyDeleteLocations(cur, ids):
+    for id in ids:
+        cur.execute("select email from locations where id = %s", [id])
+        email = cur.fetchone()['email']
+
+        cur.execute("update employees set assignedto = 0 where assignedto = %s", [id])
+        cur.execute("delete from requests where id = %s", [id])
+        cur.execute("delete from locations where id = %s", [id])
+        cur.execute("delete from users where email = %s", [email])
+    return len(ids)
+
+
+# Inserts num bench locations and num employees spread over them (every 10th unassigned), using COPY
+# Returns (employee emails, location ids)
+def seed(cur, employees, locations):
+    currentTime = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    users = io.StringIO()
+    for i in range(locations):
+        users.write('benchloc{:07d}@bench.invalid\tx\t3\n'.format(i))
+    for i in range(employees):
+        users.write('benchdel{:07d}@bench.invalid\tx\t2\n'.format(i))
+    users.seek(0)
+    cur.copy_from(users, 'users', columns=('email', 'password', 'usertype'))
+
+    cur.execute("""insert into locations(address, name, email, numemployees, lastupdate)
+                   select i || ' Bench St', 'Bench ' || i, 'benchloc' || lpad(i::text, 7, '0') || '@bench.invalid',
+                          0, now()
+                   from generate_series(0, %s - 1) i
+                   returning id""", [locations])
+    ids = sorted(row[0] for row in cur.fetchall())
+
+    rows = io.StringIO()
+    emails = []
+    for i in range(employees):
+        email = 'benchdel{:07d}@bench.invalid'.format(i)
+        emails.append(email)
+        assignedto = 0 if i % 10 == 0 or not ids else ids[i % len(ids)]
+        rows.write('{}\tBench {:07d}\t{}\t{}\n'.format(email, i, assignedto, currentTime))
+    rows.seek(0)
+    cur.copy_from(rows, 'employees', columns=('email', 'name', 'assignedto', 'lastupdate'))
+
+    cur.execute("analyze users")
+    cur.execute("analyze employees")
+    cur.execute("analyze locations")
+    return emails, ids
+
+
+# Times fn(cur) repeat times, rolling back to a savepoint after each run
+# Returns (list of timings, statements per run)
+def timeRuns(cur, fn, repeat):
+    timings = []
+    for i in range(repeat):
+        cur.execute("savepoint run")
+        CountingCursor.statements = 0
+        start = time.perf_counter()
+        fn(cur)
+        timings.append(time.perf_counter() - start)
+        statements = CountingCursor.statements
+        cur.execute("rollback to savepoint run")
+    return timings, statements
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Per-item vs set-based bulk deletes')
+    parser.add_argument('--employees', type=int, default=10000, help='employees to seed and delete')
+    parser.add_argument('--locations', type=int, default=10000, help='locations to seed and delete')
+    parser.add_argument('--legacy', type=int, default=1000, help='items deleted by the per-item baselines')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    conn = db.getPool().getconn()
+    cur = conn.cursor(cursor_factory=CountingCursor)
+    try:
+        print('Seeding {} employees, {} locations...'.format(args.employees, args.locations))
+        emails, ids = seed(cur, args.employees, args.locations)
+        currentTime = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+        legacyEmails = emails[:args.legacy]
+        legacyIds = ids[:args.legacy]
+        results = [
+            ('employees per-item', len(legacyEmails),
+             timeRuns(cur, lambda c: legacyDeleteEmployees(c, legacyEmails), args.repeat)),
+            ('employees set-based', len(emails),
+             timeRuns(cur, lambda c: assignment.deleteEmployees(c, emails), args.repeat)),
+            ('locations per-item', len(legacyIds),
+             timeRuns(cur, lambda c: legacyDeleteLocations(c, legacyIds), args.repeat)),
+            ('locations set-based', len(ids),
+             timeRuns(cur, lambda c: assignment.deleteLocations(c, ids, currentTime), args.repeat)),
+        ]
+
+        print('{:<20} {:>7} {:>11} {:>10} {:>10} {:>10} {:>12}'.format(
+            'path', 'items', 'statements', 'best ms', 'mean ms', 'worst ms', 'ms per item'))
+        for name, items, (timings, statements) in results:
+            print('{:<20} {:>7} {:>11} {:>10.2f} {:>10.2f} {:>10.2f} {:>12.4f}'.format(
+                name, items, statements, min(timings) * 1000, sum(timings) / len(timings) * 1000,
+                max(timings) * 1000, min(timings) * 1000 / max(items, 1)))
+    finally:
+        conn.rollback()
+        cur.close()
+        db.getPool().putconn(conn)
+        db.getPool().closeall()
+
+
+if __name__ == '__main__':
+    main()
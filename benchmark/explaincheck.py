@@ -0,0 +1,132 @@
+# EXPLAIN regression check
+# Seeds a large synthetic dataset inside a transaction (rolled back at the end), then EXPLAINs the queries each
+# route issues and fails if any of them sequentially scans a table it should reach through an index
+#
+# Usage: python benchmark/explaincheck.py [--employees 1000000] [--locations 10000] [--requests 100000]
+# Requires the schema from setup.py with migrations applied (python migrate.py)
+import argparse
+import json
+import os
+import sys
+
+# Allow running from the project root or from inside benchmark/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import db
+
+# (route, query) pairs checked against the seeded data
+# Parameters are filled from sample rows picked after seeding
+QUERIES = [
+    ('employeeHome', "select assignedTo, lastUpdate from employees where email=%(employee)s"),
+    ('employeeHome', "select name from locations where id = %(location)s"),
+    ('locUserHome', "select * from locations where email=%(locationEmail)s"),
+    ('locUserHome', "select * from employees where assignedTo = %(location)s order by name asc"),
+    ('locUserHome', "select * from requests where id = %(location)s and status = true order by datesubmit asc"),
+    ('viewRequests', "select * from requests where status = true"),
+    ('viewRequests', "select email from employees where assignedto = 0 order by name asc limit 500"),
+    ('locationEmployees', "select * from employees where assignedto = %(location)s"),
+    ('locationEmployees', "select * from locations where id = %(location)s"),
+    ('newLocation', "select * from locations where email = %(locationEmail)s"),
+    ('newRequest', "select id, name from locations where email = %(locationEmail)s"),
+    ('employeeInfo', "select * from employees where email = %(employee)s"),
+    ('locationEmployees', "select * from employees where assignedto = 0 and latitude is not null "
+                          "order by geo_point(latitude, longitude) <-> geo_point(%(lat)s, %(lng)s) limit 500"),
+]
+
+
+# Seeds the synthetic dataset with set-based inserts. Roughly 1 in (locations + 1) employees is unassigned,
+# matching gendata's distribution, and 5% of requests are open
+# Homes and locations are scattered over the contiguous US
+def seed(cur, employees, locations, requests):
+    cur.execute("""insert into users(email, password, usertype)
+                   select 'explainloc' || i || '@check.invalid', 'x', 3 from generate_series(1, %s) i""",
+                [locations])
+    cur.execute("""insert into locations(address, name, email, numemployees, lastupdate, latitude, longitude)
+                   select i || ' Check St', 'Check Location ' || i, 'explainloc' || i || '@check.invalid', 0, now(),
+                          25 + random() * 24, -124 + random() * 57
+                   from generate_series(1, %s) i""", [locations])
+    cur.execute("select min(id), max(id) from locations where email like 'explainloc%%'")
+    low, high = cur.fetchone()
+
+    cur.execute("""insert into users(email, password, usertype)
+                   select 'explainemp' || i || '@check.invalid', 'x', 2 from generate_series(1, %s) i""",
+                [employees])
+    cur.execute("""insert into employees(email, name, assignedto, lastupdate, latitude, longitude)
+                   select 'explainemp' || i || '@check.invalid', md5(i::text),
+                          case when random() < 1.0 / (%(n)s + 1) then 0
+                               else %(low)s + floor(random() * %(n)s)::int end,
+                          now(), 25 + random() * 24, -124 + random() * 57
+                   from generate_series(1, %(employees)s) i""",
+                {'n': high - low + 1, 'low': low, 'employees': employees})
+
+    cur.execute("""insert into requests(quantity, datereq, datesubmit, name, id, status)
+                   select 1 + floor(random() * 20)::int, current_date, current_date - (i %% 365),
+                          'Check Location', %(low)s + floor(random() * %(n)s)::int, random() < 0.05
+                   from generate_series(1, %(requests)s) i""",
+                {'n': high - low + 1, 'low': low, 'requests': requests})
+
+    cur.execute("analyze users")
+    cur.execute("analyze employees")
+    cur.execute("analyze locations")
+    cur.execute("analyze requests")
+    return low
+
+
+# Returns sample parameters for QUERIES
+def sampleParams(cur, location):
+    cur.execute("select email from employees where email like 'explainemp%%' limit 1")
+    employee = cur.fetchone()[0]
+    cur.execute("select email, latitude, longitude from locations where id = %s", [location])
+    locationEmail, lat, lng = cur.fetchone()
+    return {'employee': employee, 'location': location, 'locationEmail': locationEmail, 'lat': lat, 'lng': lng}
+
+
+# Walks a JSON plan and yields every node
+def nodes(plan):
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from nodes(child)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Verify route queries use indexes at scale')
+    parser.add_argument('--employees', type=int, default=1000000)
+    parser.add_argument('--locations', type=int, default=10000)
+    parser.add_argument('--requests', type=int, default=100000)
+    args = parser.parse_args()
+
+    conn = db.getPool().getconn()
+    cur = conn.cursor()
+    failures = 0
+    try:
+        print('Seeding {} employees, {} locations, {} requests...'.format(
+            args.employees, args.locations, args.requests))
+        location = seed(cur, args.employees, args.locations, args.requests)
+        params = sampleParams(cur, location)
+
+        for route, query in QUERIES:
+            cur.execute("explain (format json) " + query, params)
+            plan = cur.fetchone()[0]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            scans = [n for n in nodes(plan[0]['Plan']) if n['Node Type'] == 'Seq Scan']
+
+            status = 'FAIL' if scans else 'ok'
+            failures += bool(scans)
+            used = sorted({n['Index Name'] for n in nodes(plan[0]['Plan']) if 'Index Name' in n})
+            print('{:<5} {:<18} {}'.format(status, route, query))
+            print('      {}'.format(', '.join(used) if used else
+                                   'seq scan on ' + ', '.join(n['Relation Name'] for n in scans)))
+    finally:
+        conn.rollback()
+        cur.close()
+        db.getPool().putconn(conn)
+        db.getPool().closeall()
+
+    if failures:
+        sys.exit('{} queries fell back to sequential scans'.format(failures))
+    print('All queries use indexes')
+
+
+if __name__ == '__main__':
+    main()
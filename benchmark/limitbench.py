@@ -0,0 +1,108 @@
+# Rate limiter benchmark
+# Measures what the login rate limiter costs per request with each counter storage given (memory:// per process,
+# postgres:// the shared ratelimits table, a redis:// URL if Redis is available), through the Flask test client on a
+# bare app so only the limiter's own cost is timed: a limited route against the same route unlimited
+# Then checks the limit holds when the app is scaled out: N processes hit one client's 30/hour login limit at once,
+# shared storage lets 30 through in total, per process storage 30 per process
+#
+# Usage: python benchmark/limitbench.py [--storages memory:// postgres://] [--requests 2000] [--processes 4]
+# Requires the ratelimits table (run migrate.py first), counters it writes there are deleted afterwards
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+
+# Allow running from the project root or from inside benchmark/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from flask import Flask
+from flask_limiter import Limiter
+from flask_limiter.util import get_remote_address
+from limits import parse
+from limits.storage import storage_from_string
+from limits.strategies import STRATEGIES
+
+import ratelimit
+
+LOGINLIMIT = '30/hour'
+
+
+# Bare app with one route under a limit high enough never to trip, and the same route without one
+def benchApp(storage):
+    bench = Flask(__name__)
+    limiter = Limiter(bench, key_func=get_remote_address, storage_uri=storage, strategy=ratelimit.LIMITSTRATEGY,
+                      key_prefix='limitbench')
+
+    @bench.route('/limited')
+    @limiter.limit('1000000/hour')
+    def limited():
+        return 'ok'
+
+    @bench.route('/open')
+    def unlimited():
+        return 'ok'
+
+    return bench, limiter
+
+
+# Mean microseconds per GET of path over n requests, each from its own client address so every request creates a
+# counter like a burst of distinct clients would
+def timeRoute(client, path, n):
+    start = time.perf_counter()
+    for i in range(n):
+        response = client.get(path, environ_base={'REMOTE_ADDR': '10.{}.{}.{}'.format(i >> 16, (i >> 8) & 255,
+                                                                                        i & 255)})
+        if response.status_code != 200:
+            raise SystemExit('{} returned {}'.format(path, response.status_code))
+    return (time.perf_counter() - start) * 1e6 / n
+
+
+# One process of the scale out check: tries hits against one client's login limit, returns how many got through
+def hitLogin(storage, hits):
+    limiter = STRATEGIES[ratelimit.LIMITSTRATEGY](storage_from_string(storage))
+    item = parse(LOGINLIMIT)
+    return sum(limiter.hit(item, 'limitbench', '127.0.0.1', 'login') for _ in range(hits))
+
+
+# Deletes the counters written to the ratelimits table, the app's own are left alone. Memory counters go with
+# their process and Redis ones expire by themselves
+def clear(storage):
+    if storage.startswith('postgres:'):
+        ratelimit.PostgresStorage().run("delete from ratelimits where key like 'LIMITER/limitbench/%%'", [])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rate limiter overhead and scale out benchmark')
+    parser.add_argument('--storages', nargs='+', default=['memory://', 'postgres://'])
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--processes', type=int, default=4)
+    args = parser.parse_args()
+
+    print('strategy {}, {} requests per route'.format(ratelimit.LIMITSTRATEGY, args.requests))
+    print('{:<16} {:>12} {:>12} {:>14}'.format('storage', 'open us', 'limited us', 'overhead us'))
+    for storage in args.storages:
+        bench, limiter = benchApp(storage)
+        client = bench.test_client()
+        timeRoute(client, '/open', 100)
+        timeRoute(client, '/limited', 100)
+        unlimited = timeRoute(client, '/open', args.requests)
+        limited = timeRoute(client, '/limited', args.requests)
+        clear(storage)
+        print('{:<16} {:>12.0f} {:>12.0f} {:>14.0f}'.format(storage, unlimited, limited, limited - unlimited))
+
+    # Fresh interpreters (spawn), the way separate app processes have their own limiter and connections
+    hits = 50
+    print()
+    print('{} processes x {} login attempts from one client, limit {}'.format(args.processes, hits, LOGINLIMIT))
+    print('{:<16} {:>10} {:>10}'.format('storage', 'allowed', 'expected'))
+    context = multiprocessing.get_context('spawn')
+    for storage in args.storages:
+        with context.Pool(args.processes) as pool:
+            allowed = sum(pool.starmap(hitLogin, [(storage, hits)] * args.processes))
+        clear(storage)
+        print('{:<16} {:>10} {:>10}'.format(storage, allowed, parse(LOGINLIMIT).amount))
+
+
+if __name__ == '__main__':
+    main()
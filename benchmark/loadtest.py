@@ -0,0 +1,144 @@
+# Load test for app.py
+# Serves the app from a multi-threaded WSGI server in this process and drives routes with N concurrent clients
+# Reports requests/second and latency per route and concurrency level
+#
+# Usage: python benchmark/loadtest.py [--clients 1 8 32] [--duration 10] [--routes /viewEmployees /employeeHome]
+# Requires a populated DB (run setup.py first)
+import argparse
+import os
+import sys
+import threading
+import time
+import urllib.request
+from http.cookiejar import CookieJar
+
+# Allow running from the project root or from inside benchmark/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import psycopg2.extras
+from werkzeug.serving import make_server, WSGIRequestHandler
+
+import db
+from app import app
+
+# Which session each route needs to be visited with
+ROUTEUSERS = {
+    '/viewEmployees': 'admin',
+    '/employeeHome': 'employee',
+}
+
+
+# Creates a logged in session for the given user without going through /login, returns its cookie value
+# (login is rate limited to 1/second and would dominate the measurement)
+def sessionCookie(email, usertype):
+    return app.session_interface.create({'logged_in': True, 'username': email, 'user_type': usertype})
+
+
+# Picks an employee account to browse /employeeHome with
+def employeeEmail():
+    conn = db.getPool().getconn()
+    try:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        cur.execute("select email from employees order by email asc limit 1")
+        row = cur.fetchone()
+        cur.close()
+    finally:
+        db.getPool().putconn(conn)
+    if not row:
+        sys.exit('No employees in DB, run setup.py first')
+    return row['email']
+
+
+# Request handler that skips per request access logging, which would otherwise dominate the output
+class QuietHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+# Starts the app on an ephemeral port in a daemon thread, returns (server, base url)
+def startServer():
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, 'http://127.0.0.1:{}'.format(server.server_port)
+
+
+# Worker loop for one client, appends each request latency to its own list until the deadline passes
+def client(url, cookie, deadline, latencies, errors):
+    request = urllib.request.Request(url, headers={'Cookie': 'session=' + cookie})
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(CookieJar()))
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        try:
+            with opener.open(request) as response:
+                response.read()
+        except Exception:
+            errors.append(1)
+            continue
+        latencies.append(time.perf_counter() - start)
+
+
+# Returns the pth percentile of an already sorted list
+def percentile(values, p):
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+# Runs one route at one concurrency level and returns a result dict
+def run(url, cookie, clients, duration):
+    deadline = time.monotonic() + duration
+    latencies = [[] for i in range(clients)]
+    errors = []
+    threads = [threading.Thread(target=client, args=(url, cookie, deadline, latencies[i], errors))
+               for i in range(clients)]
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    merged = sorted(l for perClient in latencies for l in perClient)
+    return {
+        'clients': clients,
+        'requests': len(merged),
+        'errors': len(errors),
+        'rps': len(merged) / elapsed if elapsed else 0.0,
+        'p50': percentile(merged, 50) * 1000,
+        'p95': percentile(merged, 95) * 1000,
+        'p99': percentile(merged, 99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Concurrent load test of app.py routes')
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--duration', type=float, default=10, help='seconds per route and concurrency level')
+    parser.add_argument('--routes', nargs='+', default=list(ROUTEUSERS))
+    args = parser.parse_args()
+
+    cookies = {
+        'admin': sessionCookie('root@admin.com', 1),
+        'employee': sessionCookie(employeeEmail(), 2),
+    }
+
+    server, base = startServer()
+    print('{:<20} {:>8} {:>9} {:>7} {:>10} {:>9} {:>9} {:>9}'.format(
+        'route', 'clients', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms'))
+    try:
+        for route in args.routes:
+            cookie = cookies[ROUTEUSERS.get(route, 'admin')]
+            for clients in args.clients:
+                result = run(base + route, cookie, clients, args.duration)
+                print('{:<20} {clients:>8} {requests:>9} {errors:>7} {rps:>10.1f} {p50:>9.2f} {p95:>9.2f} '
+                      '{p99:>9.2f}'.format(route, **result))
+    finally:
+        server.shutdown()
+        db.getPool().closeall()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+# Login throughput benchmark
+# Drives /login with N concurrent clients while one bystander client browses /viewEmployees, once with password
+# hashing on the request threads (--workers 0) and once per worker pool size given
+# Reports logins/second and login latency, and the bystander's latency, which shows how much a burst of logins
+# slows every other route down
+#
+# Usage: python benchmark/loginbench.py [--clients 1 8 32] [--workers 0 2] [--duration 10]
+# Creates temporary bench accounts (deleted afterwards), requires the DB schema (run setup.py first)
+import argparse
+import os
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+# Allow running from the project root or from inside benchmark/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import db
+import metrics
+import passwords
+from app import limiter
+from loadtest import percentile, sessionCookie, startServer
+
+ACCOUNTS = 64
+PASSWORD = 'loginbench'
+EMAIL = 'loginbench{}@bench.local'
+
+
+# Creates the bench accounts, all sharing one hash made with the current settings
+def createAccounts():
+    hashed = passwords.context.hash(PASSWORD)
+    conn = db.getPool().getconn()
+    try:
+        cur = conn.cursor()
+        cur.execute("delete from users where email like 'loginbench%%@bench.local'")
+        cur.executemany("insert into users(email, password, usertype) values(%s, %s, 2)",
+                        [(EMAIL.format(i), hashed) for i in range(ACCOUNTS)])
+        conn.commit()
+        cur.close()
+    finally:
+        db.getPool().putconn(conn)
+
+
+def dropAccounts():
+    conn = db.getPool().getconn()
+    try:
+        cur = conn.cursor()
+        cur.execute("delete from users where email like 'loginbench%%@bench.local'")
+        conn.commit()
+        cur.close()
+    finally:
+        db.getPool().putconn(conn)
+
+
+# Login redirects are not followed, the redirect itself is the successful response
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+# Posts logins until the deadline, rotating through the bench accounts
+def loginClient(base, index, deadline, latencies, errors):
+    opener = urllib.request.build_opener(NoRedirect)
+    i = index
+    while time.monotonic() < deadline:
+        data = urllib.parse.urlencode({'email': EMAIL.format(i % ACCOUNTS), 'password': PASSWORD}).encode()
+        i += 1
+        start = time.perf_counter()
+        try:
+            with opener.open(base + '/login', data) as response:
+                response.read()
+        except urllib.error.HTTPError as e:
+            if e.code != 302:
+                errors.append(e.code)
+                continue
+        except Exception:
+            errors.append(None)
+            continue
+        latencies.append(time.perf_counter() - start)
+
+
+# Browses an unrelated page until the deadline
+def bystander(base, cookie, deadline, latencies):
+    request = urllib.request.Request(base + '/viewEmployees', headers={'Cookie': 'session=' + cookie})
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request) as response:
+                response.read()
+        except Exception:
+            continue
+        latencies.append(time.perf_counter() - start)
+
+
+def run(base, cookie, clients, duration):
+    deadline = time.monotonic() + duration
+    logins = [[] for i in range(clients)]
+    browsing = []
+    errors = []
+    threads = [threading.Thread(target=loginClient, args=(base, i, deadline, logins[i], errors))
+               for i in range(clients)]
+    threads.append(threading.Thread(target=bystander, args=(base, cookie, deadline, browsing)))
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    merged = sorted(l for perClient in logins for l in perClient)
+    browsing.sort()
+    return {
+        'clients': clients,
+        'logins': len(merged),
+        'errors': len(errors),
+        'rate': len(merged) / elapsed if elapsed else 0.0,
+        'p50': percentile(merged, 50) * 1000,
+        'p99': percentile(merged, 99) * 1000,
+        'other50': percentile(browsing, 50) * 1000,
+        'other99': percentile(browsing, 99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Concurrent login throughput benchmark')
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, passwords.HASHWORKERS or 1],
+                        help='hash worker processes, 0 hashes on the request threads')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per configuration')
+    args = parser.parse_args()
+
+    # The login limiter would cap every configuration at 1 login/second, and every login would hit the slow log
+    limiter.enabled = False
+    metrics.SLOWREQUEST = 0
+    cookie = sessionCookie('root@admin.com', 1)
+
+    createAccounts()
+    server, base = startServer()
+    print('{:<8} {:>8} {:>8} {:>7} {:>10} {:>9} {:>9} {:>11} {:>11}'.format(
+        'workers', 'clients', 'logins', 'errors', 'logins/s', 'p50 ms', 'p99 ms', 'other p50', 'other p99'))
+    try:
+        for workers in args.workers:
+            passwords.shutdown()
+            passwords.HASHWORKERS = workers
+            for clients in args.clients:
+                result = run(base, cookie, clients, args.duration)
+                print('{:<8} {clients:>8} {logins:>8} {errors:>7} {rate:>10.1f} {p50:>9.2f} {p99:>9.2f} '
+                      '{other50:>11.2f} {other99:>11.2f}'.format(workers, **result))
+    finally:
+        server.shutdown()
+        passwords.shutdown()
+        dropAccounts()
+        db.getPool().closeall()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,453 @@
+# Benchmark suite
+# Seeds the DB with gendata at each requested scale, then drives every route in app.py (GET pages and the form
+# POSTs) with N concurrent clients, through Flask's test client, through a multi-threaded WSGI server in this
+# process, and through the production launcher (serve.py) at each worker count. Reports requests/second, latency
+# percentiles and SQL statements per request (not observable in serve.py's processes), plus the launcher's startup
+# time, and saves everything as JSON so runs on different commits can be compared (--compare)
+#
+# Usage: python benchmark/suite.py [--scales 1k 100k 1m] [--modes testclient server serve] [--clients 1 8]
+#                                  [--duration 5] [--routes viewEmployees assign] [--read-only] [--skip-seed]
+#                                  [--serve-workers 1 4] [--serve-threads 8]
+#                                  [--output results.json] [--compare baseline.json]
+# Seeding REPLACES the DB contents (gendata clears every table). POST routes add rows (employees, locations,
+# requests, jobs), use --read-only to only run the GET routes against an existing DB with --skip-seed
+import argparse
+import itertools
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import date, datetime
+
+# Allow running from the project root or from inside benchmark/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import psycopg2.extras
+
+import cache
+import db
+import identity
+import metrics
+import passwords
+import serve
+from app import app, limiter
+from gendata import gendata
+from loadtest import percentile, sessionCookie, startServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Named scales, (employees, locations). Any other scale can be given as EMPLOYEES:LOCATIONS
+SCALES = {
+    '1k': (1000, 100),
+    '100k': (100000, 10000),
+    '1m': (1000000, 10000),
+}
+MODES = ('testclient', 'server', 'serve')
+
+# serve.py's login route is rate limited (its processes don't share this one's disabled limiter), it isn't driven
+SERVESKIP = ('login',)
+
+# Every route driven: (name, method, user, path, form data). path and data are called with the run's Context
+# for each request, so POSTs get fresh emails, open requests, etc.
+ROUTES = [
+    ('login', 'POST', None, lambda c: '/login',
+     lambda c: {'email': c.employee, 'password': gendata.DEFAULTPASSWORD}),
+    ('adminHome', 'GET', 'admin', lambda c: '/adminHome', None),
+    ('employeeHome', 'GET', 'employee', lambda c: '/employeeHome', None),
+    ('locUserHome', 'GET', 'location', lambda c: '/locUserHome', None),
+    ('viewEmployees', 'GET', 'admin', lambda c: '/viewEmployees', None),
+    ('viewLocations', 'GET', 'admin', lambda c: '/viewLocations', None),
+    ('viewRequests', 'GET', 'admin', lambda c: '/viewRequests', None),
+    ('deleteEmployee', 'GET', 'admin', lambda c: '/deleteEmployee', None),
+    ('deleteLocation', 'GET', 'admin', lambda c: '/deleteLocation', None),
+    ('newEmployee', 'GET', 'admin', lambda c: '/newEmployee', None),
+    ('newLocation', 'GET', 'admin', lambda c: '/newLocation', None),
+    ('newRequest', 'GET', 'location', lambda c: '/newRequest', None),
+    ('assignEmployees', 'GET', 'admin', lambda c: '/assignEmployees', None),
+    ('locationEmployees', 'GET', 'admin', lambda c: '/locationEmployees/{}'.format(c.location), None),
+    ('locationEmployees nearest', 'GET', 'admin',
+     lambda c: '/locationEmployees/{}?nearest=1'.format(c.location), None),
+    ('search employees', 'GET', 'admin', lambda c: '/search/employees?q=jo', None),
+    ('search unassigned', 'GET', 'admin', lambda c: '/search/employees?q=jo&unassigned=1', None),
+    ('search locations', 'GET', 'admin', lambda c: '/search/locations?q=st', None),
+    ('employeeInfo', 'GET', 'admin', lambda c: '/employeeInfo/{}'.format(c.employee), None),
+    ('locationInfo', 'GET', 'admin', lambda c: '/locationInfo/{}'.format(c.location), None),
+    ('newEmployee POST', 'POST', 'admin', lambda c: '/newEmployee',
+     lambda c: c.newAccount({'name': 'Suite Employee', 'usertype': '2', 'assignedto': '0'})),
+    ('newLocation POST', 'POST', 'admin', lambda c: '/newLocation',
+     lambda c: c.newAccount({'name': 'Suite Location', 'address': '1 Suite Street'})),
+    ('newRequest POST', 'POST', 'location', lambda c: '/newRequest',
+     lambda c: {'numEmployees': '1', 'date': date.today().isoformat()}),
+    ('viewRequests assign', 'POST', 'admin', lambda c: '/viewRequests', lambda c: {'assign': c.openRequest()}),
+    ('viewRequests assign nearest', 'POST', 'admin', lambda c: '/viewRequests',
+     lambda c: {'assignNearest': c.openRequest()}),
+    ('locationEmployees POST', 'POST', 'admin', lambda c: '/locationEmployees/{}'.format(c.location),
+     lambda c: c.moveEmployee()),
+    ('employeeInfo POST', 'POST', 'admin', lambda c: '/employeeInfo/{}'.format(c.employee),
+     lambda c: {'email': '', 'name': ''}),
+    ('locationInfo POST', 'POST', 'admin', lambda c: '/locationInfo/{}'.format(c.location),
+     lambda c: {'email': '', 'name': '', 'address': ''}),
+    ('deleteEmployee POST', 'POST', 'admin', lambda c: '/deleteEmployee',
+     lambda c: {'empDel': 'nobody@suite.invalid'}),
+]
+
+
+# Context
+# Accounts and rows the routes are driven with, picked after seeding, plus thread safe sources of the
+# unique values POSTs need
+class Context:
+    def __init__(self):
+        conn = db.getPool().getconn()
+        try:
+            cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+            cur.execute("select email from employees where assignedto <> 0 order by email limit 1")
+            row = cur.fetchone()
+            if row is None:
+                sys.exit('No assigned employees in DB, seed it first')
+            self.employee = row['email']
+            # The location with the most employees, so its pages show a full list
+            cur.execute("select id, email from locations order by numemployees desc, id asc limit 1")
+            row = cur.fetchone()
+            self.location, self.locationEmail = row['id'], row['email']
+            cur.execute("select email from employees where assignedto = 0 order by email limit 1")
+            row = cur.fetchone()
+            self.mover = row['email'] if row else self.employee
+            cur.close()
+        finally:
+            db.getPool().putconn(conn)
+
+        self.lock = threading.Lock()
+        self.counter = itertools.count()
+        self.requests = []
+        self.moves = itertools.count()
+        self.cookies = {
+            'admin': sessionCookie('root@admin.com', 1),
+            'employee': sessionCookie(self.employee, 2),
+            'location': sessionCookie(self.locationEmail, 3),
+        }
+
+    # Form data for a new account with a unique email
+    def newAccount(self, data):
+        password = gendata.DEFAULTPASSWORD
+        email = 'suite{}-{}@bench.invalid'.format(os.getpid(), next(self.counter))
+        return dict(data, email=email, password=password, verify=password)
+
+    # Returns the reqnum of an open request for one employee, creating them 500 at a time
+    def openRequest(self):
+        with self.lock:
+            if not self.requests:
+                conn = db.getPool().getconn()
+                try:
+                    cur = conn.cursor()
+                    cur.execute("""insert into requests(quantity, datereq, datesubmit, name, id)
+                                   select 1, current_date, current_date, 'Suite', %s from generate_series(1, 500)
+                                   returning reqnum""", [self.location])
+                    self.requests = [row[0] for row in cur.fetchall()]
+                    conn.commit()
+                    cur.close()
+                finally:
+                    db.getPool().putconn(conn)
+            return str(self.requests.pop())
+
+    # Alternately adds one employee to the location and removes them again
+    def moveEmployee(self):
+        return {'empAdd' if next(self.moves) % 2 == 0 else 'empRemove': self.mover}
+
+
+# Sends one request through a Flask test client, returns True on success (any status below 400)
+def testClientRequest(client, method, path, data):
+    response = client.open(path, method=method, data=data)
+    response.close()
+    return response.status_code < 400
+
+
+# Redirects are not followed, the redirect itself is the POST's response
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+# Sends one request to the running server, returns True on success (any status below 400)
+def serverRequest(opener, url, cookie, method, data):
+    body = urllib.parse.urlencode(data, doseq=True).encode() if data is not None else None
+    request = urllib.request.Request(url, data=body, method=method)
+    if cookie:
+        request.add_header('Cookie', 'session=' + cookie)
+    try:
+        with opener.open(request) as response:
+            response.read()
+    except urllib.error.HTTPError as e:
+        e.close()
+        return e.code < 400
+    return True
+
+
+# Drives one route until the deadline, appending each request's latency (form data is built beforehand and
+# isn't timed)
+def client(mode, base, route, context, deadline, latencies, errors):
+    name, method, user, path, data = route
+    cookie = context.cookies[user] if user else None
+    if mode == 'testclient':
+        testClient = app.test_client()
+        if cookie:
+            testClient.set_cookie('session', cookie)
+        send = lambda p, d: testClientRequest(testClient, method, p, d)
+    else:
+        opener = urllib.request.build_opener(NoRedirect)
+        send = lambda p, d: serverRequest(opener, base + p, cookie, method, d)
+
+    while time.monotonic() < deadline:
+        requestPath = path(context)
+        requestData = data(context) if data else None
+        start = time.perf_counter()
+        try:
+            ok = send(requestPath, requestData)
+        except Exception:
+            ok = False
+        if ok:
+            latencies.append(time.perf_counter() - start)
+        else:
+            errors.append(name)
+
+
+# Runs one route at one concurrency level, returns a result dict
+# Statements per request come from the app's own per route metrics, reset before each run
+def run(mode, base, route, context, clients, duration):
+    with metrics.lock:
+        metrics.routes.clear()
+
+    deadline = time.monotonic() + duration
+    latencies = [[] for i in range(clients)]
+    errors = []
+    threads = [threading.Thread(target=client, args=(mode, base, route, context, deadline, latencies[i], errors))
+               for i in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    with metrics.lock:
+        queries = sum(r.queries.sum for r in metrics.routes.values())
+        observed = sum(r.queries.count for r in metrics.routes.values())
+
+    merged = sorted(l for perClient in latencies for l in perClient)
+    return {
+        'route': route[0],
+        'mode': mode,
+        'clients': clients,
+        'requests': len(merged),
+        'errors': len(errors),
+        'rps': len(merged) / elapsed if elapsed else 0.0,
+        'p50': percentile(merged, 50) * 1000,
+        'p95': percentile(merged, 95) * 1000,
+        'p99': percentile(merged, 99) * 1000,
+        'queries': queries / observed if observed else 0.0,
+    }
+
+
+# Parses a scale name or EMPLOYEES:LOCATIONS
+def parseScale(scale):
+    if scale in SCALES:
+        return SCALES[scale]
+    employees, locations = scale.split(':')
+    return int(employees), int(locations)
+
+
+# Replaces the DB contents with gendata at the given scale, and drops every cached value from the old data
+def seed(employees, locations, seedValue, workers):
+    start = time.perf_counter()
+    gendata.populate(employees, locations, seedValue, 1, workers)
+    conn = db.getPool().getconn()
+    try:
+        conn.autocommit = True
+        cur = conn.cursor()
+        cur.execute("analyze")
+        cur.close()
+        conn.autocommit = False
+    finally:
+        db.getPool().putconn(conn)
+    cache.getBackend().clear()
+    identity.clear()
+    return time.perf_counter() - start
+
+
+# Starts serve.py on a free port, returns (process, base url, seconds from launch until it answered a request)
+# Its own background process is left out, like for the other modes
+def startLauncher(workers, threads):
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    base = 'http://127.0.0.1:{}'.format(port)
+    opener = urllib.request.build_opener(NoRedirect)
+
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT, 'serve.py'), '--port', str(port),
+                                '--workers', str(workers), '--threads', str(threads), '--no-background'],
+                               cwd=ROOT, stdout=subprocess.DEVNULL)
+    while True:
+        if process.poll() is not None:
+            sys.exit('serve.py exited with status {}'.format(process.returncode))
+        try:
+            with opener.open(base + '/', timeout=1) as response:
+                response.read()
+            break
+        except urllib.error.HTTPError as e:
+            e.close()
+            break
+        except (urllib.error.URLError, OSError):
+            time.sleep(0.01)
+    return process, base, time.perf_counter() - start
+
+
+def stopLauncher(process):
+    process.terminate()
+    process.wait()
+
+
+def gitCommit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+# Prints the change in throughput and p95 latency of every result also present in the baseline file
+def compare(report, path):
+    with open(path, 'r') as f:
+        baseline = json.load(f)
+    key = lambda r: (r['scale'], r['mode'], r['route'], r['clients'])
+    old = {key(r): r for r in baseline['results']}
+
+    print('\nCompared with {} (commit {})'.format(path, baseline.get('commit')))
+    print('{:<6} {:<10} {:<30} {:>7} {:>10} {:>10}'.format('scale', 'mode', 'route', 'clients', 'req/s', 'p95'))
+    for result in report['results']:
+        before = old.get(key(result))
+        if before is None or not before['rps'] or not before['p95']:
+            continue
+        print('{scale:<6} {mode:<10} {route:<30} {clients:>7} {:>+9.1f}% {:>+9.1f}%'.format(
+            (result['rps'] / before['rps'] - 1) * 100, (result['p95'] / before['p95'] - 1) * 100, **result))
+
+    key = lambda r: (r['scale'], r['workers'], r['threads'])
+    old = {key(r): r for r in baseline.get('startup', [])}
+    for result in report['startup']:
+        before = old.get(key(result))
+        if before is not None:
+            print('{scale:<6} serve.py {workers} workers x {threads} threads startup {:>+9.1f}%'.format(
+                (result['seconds'] / before['seconds'] - 1) * 100, **result))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Seed, drive and time every app.py route')
+    parser.add_argument('--scales', nargs='+', default=['1k'],
+                        help='1k, 100k, 1m or EMPLOYEES:LOCATIONS (default 1k)')
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=list(MODES))
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 8])
+    parser.add_argument('--duration', type=float, default=5, help='seconds per route, mode and concurrency')
+    parser.add_argument('--routes', nargs='+', help='only routes whose name contains one of these')
+    parser.add_argument('--read-only', action='store_true', help='only GET routes')
+    parser.add_argument('--skip-seed', action='store_true', help='use the DB as it is (one scale only)')
+    parser.add_argument('--seed', type=int, default=1, help='gendata seed')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='gendata worker processes')
+    parser.add_argument('--serve-workers', type=int, nargs='+', default=sorted({1, serve.SERVEWORKERS}),
+                        help='serve.py worker processes, one run each')
+    parser.add_argument('--serve-threads', type=int, default=serve.SERVETHREADS, help='serve.py threads per worker')
+    parser.add_argument('--output', help='JSON results file (default benchmark/results/<commit>-<time>.json)')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+    args = parser.parse_args()
+
+    routes = [r for r in ROUTES if not (args.read_only and r[1] != 'GET')
+              and (not args.routes or any(part in r[0] for part in args.routes))]
+    scales = args.scales[:1] if args.skip_seed else args.scales
+
+    # The login limiter would cap login at 1/second, and the slow request log would flood the output
+    limiter.enabled = False
+    metrics.SLOWREQUEST = 0
+
+    commit = gitCommit()
+    output = args.output or os.path.join(ROOT, 'benchmark', 'results', '{}-{}.json'.format(
+        commit or 'unknown', datetime.now().strftime('%Y%m%d%H%M%S')))
+    report = {
+        'commit': commit,
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'args': vars(args),
+        'seeding': {},
+        'startup': [],
+        'results': [],
+    }
+
+    server, base = startServer()
+    launchers = []
+    try:
+        for scale in scales:
+            employees, locations = parseScale(scale)
+            if not args.skip_seed:
+                print('Seeding {} employees, {} locations...'.format(employees, locations))
+                report['seeding'][scale] = seed(employees, locations, args.seed, args.workers)
+            context = Context()
+
+            print('\n{} ({} employees, {} locations)'.format(scale, employees, locations))
+
+            # serve.py is launched after seeding so the caches it warms hold this scale's data. A short unmeasured
+            # burst then opens every worker's DB connections, so its routes are timed in steady state
+            bases = [(mode, base) for mode in args.modes if mode != 'serve']
+            if 'serve' in args.modes:
+                for workers in args.serve_workers:
+                    process, launcherBase, seconds = startLauncher(workers, args.serve_threads)
+                    launchers.append(process)
+                    report['startup'].append({'scale': scale, 'workers': workers, 'threads': args.serve_threads,
+                                              'seconds': seconds})
+                    print('serve.py {} workers x {} threads answered {:.2f}s after launch'.format(
+                        workers, args.serve_threads, seconds))
+                    mode = 'serve{}x{}'.format(workers, args.serve_threads)
+                    warmRoute = next(r for r in ROUTES if r[0] == 'adminHome')
+                    run(mode, launcherBase, warmRoute, context, workers * args.serve_threads, 1)
+                    bases.append((mode, launcherBase))
+
+            print('{:<10} {:<30} {:>7} {:>8} {:>6} {:>9} {:>8} {:>8} {:>8} {:>8}'.format(
+                'mode', 'route', 'clients', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms',
+                'queries'))
+            # All modes run back to back for each route, so they see the same data (POST routes add rows)
+            for route in routes:
+                for mode, modeBase in bases:
+                    if mode.startswith('serve') and route[0] in SERVESKIP:
+                        continue
+                    for clients in args.clients:
+                        result = run(mode, modeBase, route, context, clients, args.duration)
+                        result.update(scale=scale, employees=employees, locations=locations)
+                        report['results'].append(result)
+                        print('{mode:<10} {route:<30} {clients:>7} {requests:>8} {errors:>6} {rps:>9.1f} '
+                              '{p50:>8.2f} {p95:>8.2f} {p99:>8.2f} {queries:>8.1f}'.format(**result))
+
+            while launchers:
+                stopLauncher(launchers.pop())
+    finally:
+        for process in launchers:
+            stopLauncher(process)
+        server.shutdown()
+        passwords.shutdown()
+        db.getPool().closeall()
+
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=1)
+    print('\nSaved results to {}'.format(output))
+
+    if args.compare:
+        compare(report, args.compare)
+
+
+if __name__ == '__main__':
+    main()
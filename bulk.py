@@ -0,0 +1,175 @@
+# Import libraries
+import csv
+import io
+import queue
+import threading
+
+from psycopg2 import sql
+
+import db
+
+# Tables that may be exported, and the columns exported for each (users is never exported, it holds hashes)
+EXPORTS = {
+    'employees': ('email', 'name', 'assignedto', 'lastupdate'),
+    'locations': ('id', 'name', 'address', 'email', 'numemployees', 'lastupdate'),
+    'requests': ('reqnum', 'id', 'name', 'quantity', 'datereq', 'datesubmit', 'status'),
+}
+FORMATS = ('csv', 'json')
+
+# Maximum number of COPY chunks buffered between the DB and a slow client
+EXPORTBUFFER = 64
+
+# Maximum number of per-row errors reported back by an import
+MAXERRORS = 1000
+
+
+# Export Query
+# Builds the COPY ... TO STDOUT statement for a table. CSV is written with a header row, JSON as one object per
+# line; the unusual quote/delimiter characters keep COPY from re-escaping the JSON text
+def exportQuery(table, fmt):
+    columns = sql.SQL(', ').join(sql.Identifier(c) for c in EXPORTS[table])
+    order = sql.Identifier(EXPORTS[table][0])
+    if fmt == 'csv':
+        return sql.SQL("copy (select {} from {} order by {}) to stdout with (format csv, header)").format(
+            columns, sql.Identifier(table), order)
+    return sql.SQL("copy (select row_to_json(t) from (select {} from {} order by {}) t) to stdout "
+                   "with (format csv, quote e'\\x01', delimiter e'\\x02')").format(
+        columns, sql.Identifier(table), order)
+
+
+# Queue Writer
+# File-like object handed to copy_expert; each chunk COPY writes is passed to the response through a bounded
+# queue, so a slow client applies back pressure to the DB instead of the export piling up in memory
+class QueueWriter(io.RawIOBase):
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.cancelled = threading.Event()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        while True:
+            if self.cancelled.is_set():
+                raise IOError('Export cancelled by client')
+            try:
+                self.chunks.put(bytes(data), timeout=1)
+                return len(data)
+            except queue.Full:
+                continue
+
+
+# Export Table
+# Returns a generator over the COPY output of table in fmt. COPY runs in a background thread on its own pooled
+# connection; closing the generator early (client disconnect) cancels the COPY
+def exportTable(table, fmt):
+    query = exportQuery(table, fmt)
+    chunks = queue.Queue(EXPORTBUFFER)
+    writer = QueueWriter(chunks)
+    done = object()
+    failure = []
+
+    def copy():
+        connPool = db.getPool()
+        conn = connPool.getconn()
+        broken = False
+        try:
+            cur = conn.cursor()
+            cur.copy_expert(query, writer)
+            cur.close()
+        except Exception as e:
+            broken = isinstance(e, db.BROKEN)
+            failure.append(e)
+        finally:
+            connPool.putconn(conn, broken=broken)
+            # Unblock the consumer, dropping the end marker if it has already gone away
+            while not writer.cancelled.is_set():
+                try:
+                    chunks.put(done, timeout=1)
+                    break
+                except queue.Full:
+                    continue
+
+    thread = threading.Thread(target=copy, daemon=True)
+    thread.start()
+
+    def generate():
+        try:
+            while True:
+                chunk = chunks.get()
+                if chunk is done:
+                    break
+                yield chunk
+            if failure:
+                raise failure[0]
+        finally:
+            writer.cancelled.set()
+
+    return generate()
+
+
+# Import Employees
+# Bulk loads employees from a CSV file (header row with email, name and optionally assignedto) in one transaction
+# Rows are COPY'd into a temporary staging table as text, validated with set-based queries, and the valid rows
+# merged into users and employees. Every imported account gets passwordHash, which the caller hashes once
+# Does not commit, the caller owns the transaction
+# Returns (number imported, number of rows skipped, list of (line, email, reason) errors, the first MAXERRORS of them)
+def importEmployees(cur, csvFile, passwordHash, currentTime):
+    cur.execute("""create temporary table import_employees (
+                       line serial,
+                       email text,
+                       name text,
+                       assignedto text,
+                       location integer,
+                       error text
+                   ) on commit drop""")
+
+    # Header row decides which of the optional columns are present
+    header = csvFile.readline()
+    if isinstance(header, bytes):
+        header = header.decode('utf-8-sig')
+    columns = [c.strip().lower() for c in next(csv.reader([header]), [])]
+    if 'email' not in columns or 'name' not in columns or not set(columns) <= {'email', 'name', 'assignedto'}:
+        raise ValueError('CSV header must contain email and name, and optionally assignedto')
+
+    copy = sql.SQL("copy import_employees ({}) from stdin with (format csv)").format(
+        sql.SQL(', ').join(sql.Identifier(c) for c in columns))
+    cur.copy_expert(copy, csvFile)
+
+    # Line numbers count the header as line 1, like a spreadsheet would. A blank assignedto means unassigned
+    # Emails keep their casing, logins and lookups match them exactly
+    cur.execute("""update import_employees set line = line + 1, email = trim(email), name = trim(name),
+                   location = case when coalesce(trim(assignedto), '') = '' then 0
+                                   when trim(assignedto) ~ '^[0-9]{1,9}$' then trim(assignedto)::int end""")
+
+    # Validation, first error found for a row wins
+    checks = [
+        ("email is null or email = ''", 'missing email'),
+        ("email !~ '^[^@\\s]+@[^@\\s]+$'", 'invalid email'),
+        ("length(email) > 100", 'email longer than 100 characters'),
+        ("name is null or name = ''", 'missing name'),
+        ("length(name) > 100", 'name longer than 100 characters'),
+        ("location is null", 'assignedto is not a location id'),
+        ("location <> 0 and not exists (select 1 from locations l where l.id = location)", 'location does not exist'),
+        ("exists (select 1 from users u where u.email = import_employees.email)", 'email already in use'),
+        ("exists (select 1 from import_employees d where d.email = import_employees.email and d.line < "
+         "import_employees.line)", 'duplicate email in file'),
+    ]
+    for condition, reason in checks:
+        cur.execute(sql.SQL("update import_employees set error = %s where error is null and ({})").format(
+            sql.SQL(condition)), [reason])
+
+    cur.execute("select line, email, error from import_employees where error is not null order by line limit %s",
+                [MAXERRORS])
+    errors = [tuple(row) for row in cur.fetchall()]
+    cur.execute("select count(*) from import_employees where error is not null")
+    skipped = cur.fetchone()[0]
+
+    cur.execute("""insert into users(email, password, usertype)
+                   select email, %s, 2 from import_employees where error is null""", [passwordHash])
+    imported = cur.rowcount
+    cur.execute("""insert into employees(email, name, assignedto, lastupdate)
+                   select email, name, location, %s from import_employees where error is null""",
+                [currentTime])
+
+    return imported, skipped, errors
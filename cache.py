@@ -0,0 +1,182 @@
+# Import libraries
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+import psycopg2.extras
+from dotenv import load_dotenv
+
+import metrics
+
+# Seconds cached values live, entries kept by the in-process backend, and an optional shared backend URL
+# (redis://host:port/db) so every worker process sees the same entries and invalidations
+# Listings longer than CACHEMAXROWS are not cached, the pages stream them from the DB instead
+load_dotenv()
+CACHETTL = float(os.getenv('CACHETTL', 60))
+CACHESIZE = int(os.getenv('CACHESIZE', 1024))
+CACHEURL = os.getenv('CACHEURL') or None
+CACHEMAXROWS = int(os.getenv('CACHEMAXROWS', 5000))
+
+
+# Memory Backend
+# In-process LRU cache with a TTL per entry. Table versions are kept apart from the entries so they are never
+# evicted, an evicted version would restart at 0 and could bring back stale entries
+class MemoryBackend:
+    def __init__(self, size=CACHESIZE):
+        self.size = size
+        self.entries = OrderedDict()
+        self.versions = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def version(self, name):
+        with self.lock:
+            return self.versions.get(name, 0)
+
+    def bump(self, name):
+        with self.lock:
+            self.versions[name] = self.versions.get(name, 0) + 1
+            return self.versions[name]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.versions.clear()
+
+
+# Redis Backend
+# Shared backend for multi-worker deployments, values are pickled and versions are plain INCR counters
+# Every key starts with prefix, so the Redis database can be shared with sessions and rate limit counters and
+# clear() only deletes the cache's own keys
+# redis is an optional dependency, only needed when CACHEURL is set
+class RedisBackend:
+    def __init__(self, url, prefix='cache:'):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return pickle.loads(value) if value is not None else None
+
+    def set(self, key, value, ttl):
+        self.client.set(self.prefix + key, pickle.dumps(value), ex=max(1, int(ttl)))
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def version(self, name):
+        return int(self.client.get(self.prefix + 'version:' + name) or 0)
+
+    def bump(self, name):
+        return self.client.incr(self.prefix + 'version:' + name)
+
+    def clear(self):
+        keys = []
+        for key in self.client.scan_iter(match=self.prefix + '*', count=1000):
+            keys.append(key)
+            if len(keys) >= 1000:
+                self.client.delete(*keys)
+                keys = []
+        if keys:
+            self.client.delete(*keys)
+
+
+# Backend is created on first use
+backend = None
+backendLock = threading.Lock()
+
+
+def getBackend():
+    global backend
+    if backend is None:
+        with backendLock:
+            if backend is None:
+                backend = RedisBackend(CACHEURL) if CACHEURL else MemoryBackend()
+    return backend
+
+
+# Table versions
+# Every cached value is keyed by the version of the table it was read from, so bumping the version after a write
+# commits invalidates all of them at once. A reader that raced the write stores its result under the old
+# version, which nobody reads any more
+def version(table):
+    return getBackend().version(table)
+
+
+def invalidate(*tables):
+    for table in tables:
+        getBackend().bump(table)
+
+
+# Cached
+# Read-through lookup: returns the value cached for key under table's current version, calling loader() and
+# caching its result on a miss. Hits and misses are counted per table in the metrics
+# keep, if given, decides whether a loaded value is worth storing (e.g. to skip very large values)
+def cached(table, key, loader, ttl=CACHETTL, keep=None):
+    cacheBackend = getBackend()
+    fullKey = '{}:{}:{}'.format(table, cacheBackend.version(table), key)
+
+    value = cacheBackend.get(fullKey)
+    if value is not None:
+        metrics.increment('eas_cache_requests_total', (('table', table), ('result', 'hit')))
+        return value
+
+    metrics.increment('eas_cache_requests_total', (('table', table), ('result', 'miss')))
+    value = loader()
+    if keep is None or keep(value):
+        cacheBackend.set(fullKey, value, ttl)
+    return value
+
+
+# Location lookups
+# getConn is only called on a miss. Rows are cached as plain dicts so every backend can store them
+def locationsQuery(getConn, query, params):
+    cur = getConn().cursor(cursor_factory=psycopg2.extras.DictCursor)
+    cur.execute(query, params)
+    rows = [dict(row) for row in cur.fetchall()]
+    cur.close()
+    return rows
+
+
+# All locations ordered by id, or None when there are more than CACHEMAXROWS of them
+def locations(getConn):
+    def load():
+        rows = locationsQuery(getConn, "select * from locations order by id asc limit %s", [CACHEMAXROWS + 1])
+        return rows if len(rows) <= CACHEMAXROWS else False
+
+    rows = cached('locations', 'all', load)
+    return rows if rows is not False else None
+
+
+# One location by id, None if it doesn't exist
+def location(id, getConn):
+    def load():
+        rows = locationsQuery(getConn, "select * from locations where id = %s", [id])
+        return rows[0] if rows else False
+
+    row = cached('locations', 'id:{}'.format(id), load)
+    return row if row is not False else None
@@ -0,0 +1,261 @@
+# Import libraries
+import itertools
+import os
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+import psycopg2.pool
+from flask import g
+from dotenv import load_dotenv
+
+import metrics
+
+# Initialize some environmental variables
+load_dotenv()
+DBNAME = os.getenv('DBNAME')
+DBUSER = os.getenv('DBUSER')
+DBPASS = os.getenv('DBPASS')
+DBHOST = os.getenv('DBHOST') or None  # Optional, defaults to the local socket
+DBPORT = os.getenv('DBPORT') or None
+
+# Pool sizing, checkout timeout (seconds) and idle time (seconds) after which a connection is pinged before reuse
+POOLMIN = int(os.getenv('POOLMIN', 2))
+POOLMAX = int(os.getenv('POOLMAX', 20))
+POOLTIMEOUT = float(os.getenv('POOLTIMEOUT', 10))
+POOLPING = float(os.getenv('POOLPING', 30))
+
+# Rows fetched per round trip by server side (streaming) cursors
+STREAMSIZE = int(os.getenv('STREAMSIZE', 2000))
+
+# Errors that indicate the connection itself (not the statement) is unusable
+BROKEN = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+
+# Connection Pool
+# Thread safe pool of PostgreSQL connections. Callers block (up to POOLTIMEOUT seconds) when all connections
+# are checked out instead of failing immediately like psycopg2's ThreadedConnectionPool does
+# Connections are health checked on checkout and replaced if the socket was dropped by the server
+class ConnectionPool:
+    def __init__(self, minconn=POOLMIN, maxconn=POOLMAX, timeout=POOLTIMEOUT, ping=POOLPING, **kwargs):
+        self.timeout = timeout
+        self.ping = ping
+        self.kwargs = kwargs
+        self._pool = psycopg2.pool.ThreadedConnectionPool(minconn, maxconn, **kwargs)
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._lastUsed = {}
+
+    # Checks out a connection, replacing it if it fails the health check
+    def getconn(self):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise psycopg2.pool.PoolError('Timed out waiting for a database connection')
+
+        try:
+            # One retry per pooled connection is enough to flush every dead socket after a server restart
+            for attempt in range(self._pool.maxconn + 1):
+                conn = self._pool.getconn()
+                if self._healthy(conn):
+                    return conn
+                self._pool.putconn(conn, close=True)
+                self._lastUsed.pop(id(conn), None)
+            raise psycopg2.OperationalError('Unable to obtain a healthy database connection')
+        except Exception:
+            self._slots.release()
+            raise
+
+    # Returns a connection to the pool. Any open transaction is rolled back so the next request starts clean
+    # Broken connections are closed and will be replaced by a fresh one on a later checkout
+    def putconn(self, conn, broken=False):
+        try:
+            if not broken and not conn.closed:
+                status = conn.get_transaction_status()
+                if status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    try:
+                        conn.rollback()
+                    except BROKEN:
+                        broken = True
+            broken = broken or bool(conn.closed)
+            if broken:
+                self._lastUsed.pop(id(conn), None)
+            else:
+                self._lastUsed[id(conn)] = time.monotonic()
+            self._pool.putconn(conn, close=broken)
+        finally:
+            self._slots.release()
+
+    # Closes every connection held by the pool
+    def closeall(self):
+        self._pool.closeall()
+        self._lastUsed.clear()
+
+    # Called in a forked child on the pool it inherited. The child's copies of the connections share their sockets
+    # with the parent's, closing them (explicitly or when garbage collected) would send the server a terminate
+    # message ending the parent's sessions. Each socket is swapped for /dev/null first, so closing only closes that
+    def detach(self):
+        devnull = os.open(os.devnull, os.O_RDWR)
+        try:
+            for conn in itertools.chain(self._pool._pool, self._pool._used.values()):
+                if not conn.closed:
+                    os.dup2(devnull, conn.fileno())
+        finally:
+            os.close(devnull)
+
+    # Health Check
+    # Cheap checks first (closed flag, transaction status). Connections idle longer than self.ping seconds
+    # are additionally pinged with a round trip, since that is when firewalls/servers drop sockets
+    def _healthy(self, conn):
+        if conn.closed:
+            return False
+        if conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+
+        lastUsed = self._lastUsed.get(id(conn))
+        if lastUsed is not None and time.monotonic() - lastUsed < self.ping:
+            return True
+
+        try:
+            cur = conn.cursor()
+            cur.execute('select 1')
+            cur.close()
+            conn.rollback()
+        except BROKEN:
+            return False
+        return True
+
+
+# Module level pool, created lazily so that forked worker processes each open their own connections
+pool = None
+poolLock = threading.Lock()
+
+
+# A child forked after the pool was opened (e.g. by a preloading server) drops the parent's pool, its first
+# getPool() opens connections of its own
+def afterFork():
+    global pool, poolLock
+    poolLock = threading.Lock()
+    if pool is not None:
+        pool.detach()
+        pool = None
+
+
+os.register_at_fork(after_in_child=afterFork)
+
+
+# Returns the process wide pool, creating it on first use
+# Pooled connections time every statement for the per request metrics (see metrics.py)
+def getPool():
+    global pool
+    if pool is None:
+        with poolLock:
+            if pool is None:
+                pool = ConnectionPool(dbname=DBNAME, user=DBUSER, password=DBPASS, host=DBHOST, port=DBPORT,
+                                      connection_factory=metrics.InstrumentedConnection)
+    return pool
+
+
+# Closes the process wide pool, the next getPool() opens a new one. Used before forking worker processes so the
+# parent doesn't hold connections it no longer needs
+def closePool():
+    global pool
+    with poolLock:
+        if pool is not None:
+            pool.closeall()
+            pool = None
+
+
+# Get Connection
+# Returns the connection checked out for the current Flask app context, checking one out on first use
+# The connection is returned to the pool by closeConn when the app context is torn down
+def getConn():
+    if 'dbConn' not in g:
+        g.dbConn = getPool().getconn()
+    return g.dbConn
+
+
+# Close Connection
+# Teardown handler, returns the request's connection to the pool. Connections that raised a connection level
+# error are discarded so the next checkout reconnects
+def closeConn(exception=None):
+    conn = g.pop('dbConn', None)
+    if conn is not None:
+        getPool().putconn(conn, broken=isinstance(exception, BROKEN))
+
+
+# Unique names for server side cursors
+cursorNames = itertools.count()
+
+
+# Stream Query
+# Runs query on a named (server side) cursor and returns an iterator over its rows, fetched itersize rows
+# per round trip (FETCH FORWARD itersize), so memory use stays flat however many rows the query returns
+# The iterator holds its own pooled connection until it is exhausted or closed, since streamed responses are
+# still being generated after the request's app context (and its connection) has been torn down
+# Returns None if the query returned no rows
+def streamQuery(query, params=None, itersize=STREAMSIZE):
+    connPool = getPool()
+    conn = connPool.getconn()
+    try:
+        cur = conn.cursor(name='stream{}'.format(next(cursorNames)), cursor_factory=psycopg2.extras.DictCursor)
+        cur.execute(query, params)
+        rows = cur.fetchmany(itersize)
+    except Exception as e:
+        connPool.putconn(conn, broken=isinstance(e, BROKEN))
+        raise
+
+    if not rows:
+        cur.close()
+        connPool.putconn(conn)
+        return None
+    return StreamRows(connPool, conn, cur, rows, itersize)
+
+
+# Stream Rows
+# Iterator behind streamQuery. Returns its connection to the pool once exhausted, on error, when closed or
+# when garbage collected (a client disconnecting before the first row is sent never starts iteration)
+class StreamRows:
+    def __init__(self, connPool, conn, cur, rows, itersize):
+        self.connPool = connPool
+        self.conn = conn
+        self.cur = cur
+        self.itersize = itersize
+        self.rows = iter(rows)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        row = next(self.rows, None)
+        if row is not None:
+            return row
+        if self.conn is None:
+            raise StopIteration
+
+        # Current batch used up, fetch the next one
+        try:
+            rows = self.cur.fetchmany(self.itersize)
+        except BROKEN:
+            self.close(broken=True)
+            raise
+        if not rows:
+            self.close()
+            raise StopIteration
+        self.rows = iter(rows)
+        return next(self.rows)
+
+    def close(self, broken=False):
+        if self.conn is None:
+            return
+        conn, self.conn = self.conn, None
+        if not broken and not conn.closed:
+            self.cur.close()
+        self.connPool.putconn(conn, broken=broken)
+
+    def __del__(self):
+        self.close()
+
+
+# Registers the pool teardown with a Flask app
+def initApp(app):
+    app.teardown_appcontext(closeConn)
@@ -1,5 +1,10 @@
+import argparse
+import bisect
+import io
 import random as rm
 import string
+import time
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 
 import json
@@ -16,53 +21,150 @@ DBNAME = os.getenv('DBNAME')
 DBUSER = os.getenv('DBUSER')
 DBPASS = os.getenv('DBPASS')
 
+# Data files live next to this module
+DATADIR = os.path.dirname(os.path.abspath(__file__))
+
+# Password every generated account gets, and how many rows are sent per COPY
+DEFAULTPASSWORD = '0000'
+BATCHSIZE = 10000
+
+# Employees are generated in shards of this many rows, each with its own seeded random stream, so the data
+# generated for a seed is the same whatever the number of worker processes
+SHARDSIZE = 50000
+
+# Generated employee emails are 10 lowercase letters. Index i is mapped to (i * EMAILSTEP + offset) mod 26^10,
+# a bijection since EMAILSTEP is coprime with 26, so emails look random but never collide within a run
+EMAILSPACE = 26 ** 10
+EMAILSTEP = 7777777777777
+
+
+# Name Sampler
+# Draws names from the same frequency tables (and with the same distribution) as names.get_full_name,
+# but loads the tables once and bisects them instead of rescanning a file for every name
+class NameSampler:
+    def __init__(self, rng):
+        self.rng = rng
+        self.tables = {key: self.load(path) for key, path in names.FILES.items()}
+
+    @staticmethod
+    def load(path):
+        entries, cumulative = [], []
+        with open(path) as f:
+            for line in f:
+                name, _, total, _ = line.split()
+                entries.append(name.capitalize())
+                cumulative.append(float(total))
+        return entries, cumulative
+
+    def get(self, key):
+        entries, cumulative = self.tables[key]
+        index = bisect.bisect_right(cumulative, self.rng.random() * 90)
+        return entries[index] if index < len(entries) else ''
+
+    def lastName(self):
+        return self.get('last')
+
+    def fullName(self):
+        gender = self.rng.choice(('male', 'female'))
+        return "{0} {1}".format(self.get('first:' + gender), self.get('last'))
+
+
+# Hashes the default password count times. A small pool keeps generated hashes from all being identical
+# without paying the (deliberately slow) hash cost for every row
+def passwordHashes(count=1):
+    return [sha256_crypt.hash(DEFAULTPASSWORD) for i in range(max(1, count))]
+
+
+# Employee homes are scattered this many degrees (standard deviation) around a random address
+HOMESPREAD = 0.25
+
+
+# Returns the (latitude, longitude) of every address in the address data
+def addressCoordinates():
+    with open(os.path.join(DATADIR, 'addresses-us-500.min.json'), 'r') as f:
+        addresses = json.loads(f.read())
+    return [(a['coordinates']['lat'], a['coordinates']['lng']) for a in addresses['addresses'] if a.get('coordinates')]
+
+
+# Returns the unique employee email for index i (see EMAILSTEP)
+def employeeEmail(i, offset):
+    n = (i * EMAILSTEP + offset) % EMAILSPACE
+    letters = []
+    for j in range(10):
+        n, r = divmod(n, 26)
+        letters.append(string.ascii_lowercase[r])
+    return ''.join(letters) + "@gmail.com"
+
+
+# Writes rows (tuples) to table with COPY FROM an in-memory buffer
+def copyRows(cur, table, columns, rows):
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write('\t'.join(str(value) for value in row))
+        buffer.write('\n')
+    buffer.seek(0)
+    cur.copy_from(buffer, table, columns=columns)
+
+
+# Recomputes every location's numemployees with one aggregate UPDATE, after loads that skipped the count triggers
+def updateCounts(cur):
+    cur.execute("""update locations set numemployees = coalesce(c.n, 0)
+                   from locations l left join (select assignedto, count(*) as n from employees group by 1) c
+                   on c.assignedto = l.id
+                   where locations.id = l.id""")
+
 
 # Fills employees table with random data, satisfies foreign key constraint
-def employeeData(num, conn):
+# Rows are generated and COPY'd in batches, users first. Location counts are kept by the employees triggers, or
+# with counts False left to the caller (concurrent shards would otherwise queue on the same location rows)
+# Emails are generated for indexes [start, start + num), so separate calls with disjoint ranges never collide
+# Every employee gets a home coordinate near one of the address data's addresses
+def employeeData(num, conn, rng=rm, hashes=None, start=0, batch=BATCHSIZE, offset=None, counts=True):
     cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
 
     # Get valid assignedto values
-    cur.execute("select id from locations")
-    ids = cur.fetchall()
-    ids.append([0])  # Allow unassigned to be a possible assignment
+    cur.execute("select id from locations order by id")
+    ids = [row[0] for row in cur.fetchall()]
+    ids.append(0)  # Allow unassigned to be a possible assignment
     cap = len(ids)
 
+    hashes = hashes or passwordHashes()
+    sampler = NameSampler(rng)
+    homes = addressCoordinates()
+    if offset is None:
+        offset = rng.randrange(EMAILSPACE)
     currentTime = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
-    for i in range(num):
-        name = names.get_full_name()
-        email = ''.join(rm.choice(string.ascii_letters) for x in range(10)).lower() + "@gmail.com"
-        assignedto = ids[rm.randrange(cap)][0]
-
-        # Add to users table first, to satisfy foreign key constraint
-        try:
-            cur.execute("insert into users(email, password, usertype) values(%s, %s, %s)",
-                        (email, sha256_crypt.hash('0000'), 2))
-        except psycopg2.DatabaseError:
-            print("Error adding row")
-            continue
+    if not counts:
+        cur.execute("set local eas.employee_counts = off")
 
-        cur.execute('insert into employees values(%s, %s, %s, %s)',
-                    (email, name, assignedto, currentTime))
+    for first in range(start, start + num, batch):
+        users, employees = [], []
+        for i in range(first, min(first + batch, start + num)):
+            email = employeeEmail(i, offset)
+            users.append((email, hashes[i % len(hashes)], 2))
+            lat, lng = homes[rng.randrange(len(homes))]
+            employees.append((email, sampler.fullName(), ids[rng.randrange(cap)], currentTime,
+                              round(lat + rng.gauss(0, HOMESPREAD), 6), round(lng + rng.gauss(0, HOMESPREAD), 6)))
 
-        if assignedto != 0:
-            cur.execute("update locations set numemployees = numemployees + 1 where id = %s", [assignedto])
-        print(name, "--", email, "--", assignedto, "--", currentTime)
+        # Add to users table first, to satisfy foreign key constraint
+        copyRows(cur, 'users', ('email', 'password', 'usertype'), users)
+        copyRows(cur, 'employees', ('email', 'name', 'assignedto', 'lastupdate', 'latitude', 'longitude'), employees)
 
     conn.commit()
     cur.close()
 
 
 # Fills locations table with random data
-def locationData(num, conn):
+def locationData(num, conn, rng=rm, hashes=None):
     cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
 
     # Read address data from JSON files
-    with open('gendata/addresses-us-500.min.json', 'r') as f:
+    with open(os.path.join(DATADIR, 'addresses-us-500.min.json'), 'r') as f:
         data = f.read()
     addresses = json.loads(data)
 
-    with open('gendata/vegetables.json', 'r') as f:
+    with open(os.path.join(DATADIR, 'vegetables.json'), 'r') as f:
         data = f.read()
     vegetables = json.loads(data)
 
@@ -70,31 +172,38 @@ def locationData(num, conn):
     vlen = len(vegetables["vegetables"])
     alen = len(addresses["addresses"])
 
+    # Owner last names repeat, so existing and already generated emails are tracked and numbered when reused
+    cur.execute("select email from users")
+    used = {row[0] for row in cur.fetchall()}
+
+    hashes = hashes or passwordHashes()
+    sampler = NameSampler(rng)
     currentTime = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
+    users, locations = [], []
     for i in range(num):
         # Create farm name
-        vegetable = vegetables["vegetables"][rm.randrange(vlen)].title()  # Random vegetable
-        suffix = 'Farm' if rm.randint(0, 1) else 'Greenhouse'  # Random type of grower (Farm|Greenhouse)
-        lname = names.get_last_name()  # Random owner
+        vegetable = vegetables["vegetables"][rng.randrange(vlen)].title()  # Random vegetable
+        suffix = 'Farm' if rng.randint(0, 1) else 'Greenhouse'  # Random type of grower (Farm|Greenhouse)
+        lname = sampler.lastName()  # Random owner
         prefix = lname + "'s"
 
         name = prefix + " " + vegetable + " " + suffix
-        address = addresses["addresses"][rm.randrange(alen)]["address1"]
+        address = addresses["addresses"][rng.randrange(alen)]["address1"]
         email = lname + "@gmail.com"
+        n = 1
+        while email in used:
+            n += 1
+            email = "{}{}@gmail.com".format(lname, n)
+        used.add(email)
 
-        try:
-            # Create user corresponding to the new location
-            cur.execute("insert into users(email, password, usertype) values(%s, %s, 3)",
-                        (email, sha256_crypt.hash('0000')))
-        except psycopg2.DatabaseError:
-            print("Error adding row")
-            continue
+        users.append((email, hashes[i % len(hashes)], 3))
+        locations.append((address, name, email, currentTime))
 
-        # Insert location
-        cur.execute("insert into locations(address, name, email, lastupdate) values(%s, %s, %s, %s)",
-                    (address, name, email, currentTime))
-        # print(name, "--", email, "--", currentTime)
+    # Create users corresponding to the new locations, then the locations
+    for first in range(0, num, BATCHSIZE):
+        copyRows(cur, 'users', ('email', 'password', 'usertype'), users[first:first + BATCHSIZE])
+        copyRows(cur, 'locations', ('address', 'name', 'email', 'lastupdate'), locations[first:first + BATCHSIZE])
 
     conn.commit()
     cur.close()
@@ -126,21 +235,74 @@ def clearDB(conn):
     cur.close()
 
 
+# Employee Shard
+# Worker entry point: generates employees [start, start + num) on its own connection
+# Location counts are left to the caller, which updates them once after every shard is in
+def employeeShard(start, num, seed, offset, hashes):
+    shardStart = time.perf_counter()
+    rng = rm.Random('{}-{}'.format(seed, start)) if seed is not None else rm.Random()
+    conn = psycopg2.connect(dbname=DBNAME, user=DBUSER, password=DBPASS)
+    try:
+        employeeData(num, conn, rng, hashes, start=start, offset=offset, counts=False)
+    finally:
+        conn.close()
+    return num, time.perf_counter() - shardStart
+
+
+# Generates numEmp employees in SHARDSIZE shards, spread over workers processes (in process if workers is 1)
+def parallelEmployeeData(numEmp, conn, rng, seed, hashes, workers):
+    offset = rng.randrange(EMAILSPACE)
+    shards = [(start, min(SHARDSIZE, numEmp - start)) for start in range(0, numEmp, SHARDSIZE)]
+
+    if workers > 1 and len(shards) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(employeeShard, start, num, seed, offset, hashes) for start, num in shards]
+            results = [future.result() for future in futures]
+    else:
+        results = [employeeShard(start, num, seed, offset, hashes) for start, num in shards]
+
+    if results:
+        busy = sum(seconds for num, seconds in results)
+        print("  {} shards, {:.2f}s of generation across {} worker(s)".format(len(results), busy, workers))
+
+    cur = conn.cursor()
+    updateCounts(cur)
+    conn.commit()
+    cur.close()
+
+
 # Customizable Populate Option
-def populate(numEmp, numLoc):
+# seed makes the generated data reproducible, hashes is the number of distinct password hashes to precompute
+# and workers the number of processes employees are generated with
+# Locations are created first so every shard can assign employees to them
+def populate(numEmp, numLoc, seed=None, hashes=1, workers=1):
+    rng = rm.Random(seed)
     conn = psycopg2.connect(dbname=DBNAME, user=DBUSER, password=DBPASS)
-    clearDB(conn)
-    addRoot(conn)
-    locationData(int(numEmp), conn)
-    employeeData(int(numLoc), conn)
+    pool = passwordHashes(hashes)
+
+    phases = [
+        ('clear', lambda: clearDB(conn)),
+        ('root', lambda: addRoot(conn)),
+        ('locations', lambda: locationData(int(numLoc), conn, rng, pool)),
+        ('employees', lambda: parallelEmployeeData(int(numEmp), conn, rng, seed, pool, max(1, int(workers)))),
+    ]
+    total = time.perf_counter()
+    for phase, fn in phases:
+        start = time.perf_counter()
+        fn()
+        print("{:<10} {:>8.2f}s".format(phase, time.perf_counter() - start))
+    print("{:<10} {:>8.2f}s".format('total', time.perf_counter() - total))
+
     conn.close()
 
 
 if __name__ == "__main__":
-    pass
-    # conn = psycopg2.connect(dbname='postgres', user='postgres', password='root')
-    # clearDB(conn)
-    # addRoot(conn)
-    # locationData(18, conn)
-    # employeeData(50, conn)
-    # conn.close()
+    parser = argparse.ArgumentParser(description='Clear the DB and fill it with generated data')
+    parser.add_argument('--rows', type=int, default=int(os.getenv('EMPLOYEES', 50)), help='employees to create')
+    parser.add_argument('--locations', type=int, default=int(os.getenv('LOCATIONS', 18)))
+    parser.add_argument('--seed', type=int, default=None, help='seed for reproducible datasets')
+    parser.add_argument('--hashes', type=int, default=1, help='distinct password hashes to precompute')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='processes generating employees')
+    args = parser.parse_args()
+
+    populate(args.rows, args.locations, args.seed, args.hashes, args.workers)
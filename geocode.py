@@ -0,0 +1,55 @@
+# Import libraries
+import json
+import os
+
+import psycopg2
+import psycopg2.extras
+from dotenv import load_dotenv
+
+# Offline address data the geocodes table is loaded from (the addresses gendata draws locations from)
+load_dotenv()
+GEOCODES = os.getenv('GEOCODES') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gendata',
+                                                 'addresses-us-500.min.json')
+
+
+# Reads (address, latitude, longitude) tuples from an addresses JSON file, one per distinct address
+def readAddresses(path=GEOCODES):
+    with open(path, 'r') as f:
+        data = json.loads(f.read())
+
+    coordinates = {}
+    for entry in data['addresses']:
+        if entry.get('address1') and entry.get('coordinates'):
+            coordinates[entry['address1']] = (entry['coordinates']['lat'], entry['coordinates']['lng'])
+    return [(address, lat, lng) for address, (lat, lng) in coordinates.items()]
+
+
+# Load
+# Upserts the geocodes table from the addresses file, then geocodes every location that has no coordinate yet
+# (new and re-addressed locations are geocoded by a trigger, see PostgreSQL/migrations/0003_coordinates.sql)
+# Returns (addresses loaded, locations geocoded)
+def load(conn, path=GEOCODES):
+    addresses = readAddresses(path)
+    cur = conn.cursor()
+    psycopg2.extras.execute_values(cur, """insert into geocodes(address, latitude, longitude) values %s
+                                           on conflict (address) do update
+                                           set latitude = excluded.latitude, longitude = excluded.longitude""",
+                                   addresses)
+    cur.execute("""update locations set latitude = g.latitude, longitude = g.longitude
+                   from geocodes g
+                   where g.address = locations.address and locations.latitude is null""")
+    geocoded = cur.rowcount
+    conn.commit()
+    cur.close()
+    return len(addresses), geocoded
+
+
+def main():
+    conn = psycopg2.connect(dbname=os.getenv('DBNAME'), user=os.getenv('DBUSER'), password=os.getenv('DBPASS'))
+    addresses, geocoded = load(conn)
+    conn.close()
+    print("Loaded {} addresses, geocoded {} locations".format(addresses, geocoded))
+
+
+if __name__ == '__main__':
+    main()
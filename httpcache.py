@@ -0,0 +1,84 @@
+# Import libraries
+import hashlib
+import os
+
+from flask import make_response, request, session
+from markupsafe import Markup
+from dotenv import load_dotenv
+
+import cache
+
+# Largest rendered fragment kept in the cache, in characters. Bigger fragments are rendered on every request
+load_dotenv()
+FRAGMENTMAXBYTES = int(os.getenv('FRAGMENTMAXBYTES', 262144))
+
+TEMPLATES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+
+
+# Hash of every template's content. A deploy that changes the HTML without changing any table still has to
+# change the ETags, and content (unlike modification times) is the same for every worker of a deploy
+def templateStamp():
+    digest = hashlib.sha1()
+    for root, dirs, files in os.walk(TEMPLATES):
+        dirs.sort()
+        for filename in sorted(files):
+            path = os.path.join(root, filename)
+            digest.update(os.path.relpath(path, TEMPLATES).encode())
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+    return digest.hexdigest()
+
+
+TEMPLATESTAMP = templateStamp()
+
+
+# Page Stamp
+# Version stamp of a page built from the given tables, read with one query from table_versions (kept up to date
+# by triggers, see PostgreSQL/migrations/0002_table_versions.sql)
+# The ETag covers the templates, the view and its query string, the table versions and the logged in user,
+# Last-Modified is the last time any of the tables changed, sent for information only (see fresh)
+class PageStamp:
+    def __init__(self, tables, getConn):
+        cur = getConn().cursor()
+        cur.execute("select name, version, changed from table_versions where name = any(%s) order by name",
+                    [list(tables)])
+        rows = cur.fetchall()
+        cur.close()
+
+        versions = ','.join('{}:{}'.format(name, version) for name, version, changed in rows)
+        self.lastModified = max((changed for name, version, changed in rows), default=None)
+
+        page = '|'.join([TEMPLATESTAMP, request.endpoint, request.query_string.decode('utf-8', 'replace'), versions])
+        self.fragmentKey = hashlib.sha1(page.encode()).hexdigest()
+        self.etag = hashlib.sha1('{}|{}'.format(page, session.get('username', '')).encode()).hexdigest()
+
+    # True if the client's copy is current. Never while flash messages are waiting, they have to be rendered
+    # Only If-None-Match is honoured: Last-Modified is the same for every user (and deploy) while the pages aren't,
+    # so If-Modified-Since could match a copy rendered for someone else
+    def fresh(self):
+        if '_flashes' in session:
+            return False
+        if request.if_none_match:
+            return request.if_none_match.contains(self.etag)
+        return False
+
+    # Adds the validators to a response (or anything make_response accepts). Clients revalidate every time
+    def finish(self, body):
+        response = make_response(body)
+        response.set_etag(self.etag)
+        if self.lastModified:
+            response.last_modified = self.lastModified
+        response.headers['Cache-Control'] = 'private, no-cache'
+        response.vary.add('Cookie')
+        return response
+
+    def notModified(self):
+        return self.finish(('', 304))
+
+    # Fragment
+    # Returns the HTML render() produces for this page, cached under the table versions so an unchanged table is
+    # neither queried nor rendered again. render may return None for pages that can't be cached (not stored)
+    def fragment(self, render):
+        html = cache.cached('fragments', self.fragmentKey, render,
+                            keep=lambda html: html is not None and len(html) <= FRAGMENTMAXBYTES)
+        return Markup(html) if html is not None else None
@@ -0,0 +1,119 @@
+# Import libraries
+import os
+import threading
+
+import psycopg2.extras
+from dotenv import load_dotenv
+
+import cache
+
+# Seconds a cached identity stays valid, and identities kept per process
+# Identities are kept in the CACHEURL backend when it is set, so an invalidation reaches every worker process.
+# Otherwise each process keeps its own and invalidations only reach the process making them, IDENTITYTTL then
+# bounds how long another worker can serve a stale assignment
+load_dotenv()
+IDENTITYTTL = float(os.getenv('IDENTITYTTL', 300))
+IDENTITYSIZE = int(os.getenv('IDENTITYSIZE', 10000))
+
+# One query resolving everything the home pages need to know about an account: its user row, its employee
+# placement (and the placed location's name) and, for location users, the location it owns
+QUERY = """select u.email, u.password, u.usertype,
+                  e.assignedto, e.lastupdate, al.name as assignedname,
+                  l.id as locationid, l.name as locationname
+           from users u
+           left join employees e on e.email = u.email
+           left join locations al on al.id = e.assignedto
+           left join locations l on l.email = u.email
+           where u.email = %s
+           order by l.id asc
+           limit 1"""
+
+# Backend is created on first use: the shared cache backend with CACHEURL, else an LRU of IDENTITYSIZE
+# identities of this process' own
+backend = None
+backendLock = threading.Lock()
+
+
+def getBackend():
+    global backend
+    if backend is None:
+        with backendLock:
+            if backend is None:
+                backend = cache.getBackend() if cache.CACHEURL else cache.MemoryBackend(IDENTITYSIZE)
+    return backend
+
+
+# Keys: 'identity:EMAIL' -> (identity, versions of the locations it refers to). A location's version is bumped to
+# invalidate every identity referring to it, without having to find them
+def key(email):
+    return 'identity:' + email
+
+
+def locationVersions(cacheBackend, identity):
+    return tuple(cacheBackend.version('identitylocation:{}'.format(id)) if id else 0
+                 for id in (identity['assignedto'], identity['locationid']))
+
+
+# Builds the cached identity from a QUERY row. Passwords are never cached
+def fromRow(row):
+    return {
+        'email': row['email'],
+        'usertype': row['usertype'],
+        'assignedto': row['assignedto'],
+        'lastupdate': row['lastupdate'],
+        'assignedname': row['assignedname'],
+        'locationid': row['locationid'],
+        'locationname': row['locationname'],
+    }
+
+
+# Fetches the QUERY row for email (including the password hash, for login), None if there is no such user
+def fetch(conn, email):
+    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    cur.execute(QUERY, [email])
+    row = cur.fetchone()
+    cur.close()
+    return row
+
+
+# Stores an identity, called by login and on cache misses
+def remember(email, identity):
+    cacheBackend = getBackend()
+    cacheBackend.set(key(email), (identity, locationVersions(cacheBackend, identity)), IDENTITYTTL)
+
+
+# Get Identity
+# Returns the cached identity for email, loading it with one query on a miss. getConn is only called on a miss,
+# so cache hits don't touch the DB or the connection pool
+# Returns None if the user doesn't exist
+def get(email, getConn):
+    cacheBackend = getBackend()
+    entry = cacheBackend.get(key(email))
+    if entry is not None and entry[1] == locationVersions(cacheBackend, entry[0]):
+        return entry[0]
+
+    row = fetch(getConn(), email)
+    if row is None:
+        return None
+    identity = fromRow(row)
+    remember(email, identity)
+    return identity
+
+
+# Invalidation hooks
+# Drop identities for the given emails, e.g. after employees are reassigned or an account's email changes
+def invalidate(*emails):
+    cacheBackend = getBackend()
+    for email in emails:
+        if email:
+            cacheBackend.delete(key(email))
+
+
+# Drop the identities of a location's owner and of every employee assigned to it, e.g. after it is renamed
+def invalidateLocation(id):
+    getBackend().bump('identitylocation:{}'.format(id))
+
+
+# Drop every cached identity. With CACHEURL this clears the whole shared cache
+def clear():
+    getBackend().clear()
@@ -0,0 +1,333 @@
+# Import libraries
+import argparse
+import logging
+import os
+import select
+import socket
+import threading
+import time
+from datetime import datetime
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+from dotenv import load_dotenv
+
+import assignment
+import cache
+import db
+import identity
+
+log = logging.getLogger(__name__)
+
+# Items handled per transaction (progress is committed with each batch), seconds an idle worker waits for a
+# notification before checking the queue again, and seconds without a heartbeat after which a running job is
+# assumed to have lost its worker and is queued again
+load_dotenv()
+JOBBATCH = int(os.getenv('JOBBATCH', 10000))
+JOBPOLL = float(os.getenv('JOBPOLL', 5))
+JOBSTALE = float(os.getenv('JOBSTALE', 300))
+
+# Worker threads app.py starts alongside the development server, 0 leaves jobs to 'python jobs.py' processes
+JOBWORKERS = int(os.getenv('JOBWORKERS', 1))
+
+# Jobs attempted this many times (the worker died each time) are failed instead of requeued
+MAXATTEMPTS = 3
+
+# Channel workers LISTEN on, enqueue NOTIFYs it so an idle worker starts straight away
+CHANNEL = 'jobs'
+
+
+# Enqueue
+# Queues a job of the given kind (see HANDLERS) and returns its id. total is the number of items the job will
+# report progress against
+# Does not commit, the caller owns the transaction (the job only becomes visible to workers once it commits)
+def enqueue(cur, kind, params, total, owner=None):
+    cur.execute("""insert into jobs(kind, params, total, owner) values (%s, %s, %s, %s) returning id""",
+                (kind, psycopg2.extras.Json(params), total, owner))
+    id = cur.fetchone()[0]
+    cur.execute("notify " + CHANNEL)
+    return id
+
+
+# Job Status
+# Returns a job's row as a dict, None if it doesn't exist
+def status(cur, id):
+    cur.execute("""select id, kind, status, progress, total, result, error, owner, created, started, finished
+                   from jobs where id = %s""", [id])
+    row = cur.fetchone()
+    return dict(row) if row is not None else None
+
+
+# Claim
+# Marks the oldest queued job as running and returns it, None if the queue is empty. Jobs being claimed by another
+# worker are skipped (FOR UPDATE SKIP LOCKED), so any number of workers can poll the same queue
+def claim(conn, worker):
+    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    cur.execute("""update jobs set status = 'running', worker = %s, attempts = attempts + 1,
+                                   started = now(), heartbeat = now()
+                   where id = (select id from jobs where status = 'queued' order by id limit 1
+                               for update skip locked)
+                   returning *""", [worker])
+    job = cur.fetchone()
+    conn.commit()
+    cur.close()
+    return job
+
+
+# Requeue Stale
+# Queues running jobs whose heartbeat is older than JOBSTALE seconds again, or fails them after MAXATTEMPTS
+# Handlers commit their progress with each batch, so a requeued job resumes after the last committed batch
+def requeueStale(conn):
+    cur = conn.cursor()
+    cur.execute("""update jobs set status = case when attempts >= %s then 'failed' else 'queued' end,
+                                   error = case when attempts >= %s then 'Worker lost' end,
+                                   finished = case when attempts >= %s then now() end
+                   where status = 'running' and heartbeat < now() - %s * interval '1 second'""",
+                (MAXATTEMPTS, MAXATTEMPTS, MAXATTEMPTS, JOBSTALE))
+    requeued = cur.rowcount
+    conn.commit()
+    cur.close()
+    return requeued
+
+
+# Batches
+# Runs work(cur, batch, totals) over items JOBBATCH at a time, one transaction per batch, starting after the
+# progress already committed by an earlier attempt. The job's progress and heartbeat are updated in the same
+# transaction as the batch, so a batch is never applied twice
+# work returns a list of what it changed, and may add its own counts to totals (a dict). The number changed and the
+# totals are checkpointed in the job's result with each batch, so a resumed job reports what every attempt did
+# Returns the changed items, the number changed and the totals. The items an earlier attempt got through are
+# returned as changed too, since which of them were isn't recorded, so their caches are dropped as well
+def batches(conn, job, items, work):
+    checkpoint = job['result'] or {}
+    changed = list(items[:job['progress']])
+    count = checkpoint.get('changed', 0)
+    totals = dict(checkpoint.get('totals', {}))
+
+    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    for start in range(job['progress'], len(items), JOBBATCH):
+        batch = items[start:start + JOBBATCH]
+        done = work(cur, batch, totals)
+        changed += done
+        count += len(done)
+        cur.execute("update jobs set progress = %s, heartbeat = now(), result = %s where id = %s",
+                    (start + len(batch), psycopg2.extras.Json({'changed': count, 'totals': totals}), job['id']))
+        conn.commit()
+    cur.close()
+    return changed, count, totals
+
+
+###########################################
+############### HANDLERS ##################
+###########################################
+
+# Each handler runs one claimed job and returns its result: a message for the status page, plus the emails and
+# location ids whose cached identities must be dropped (see invalidate)
+
+
+# Delete Employees
+# Drops the employees in params['emails'] with their user accounts (see assignment.deleteEmployees)
+def deleteEmployees(conn, job):
+    emails, count, totals = batches(conn, job, job['params']['emails'],
+                                    lambda cur, batch, totals: assignment.deleteEmployees(cur, batch))
+    return {'message': 'Deleted {} employees'.format(count), 'emails': emails, 'locations': []}
+
+
+# Delete Locations
+# Drops the locations in params['ids'] with their requests and user accounts, unassigning their employees
+# (see assignment.deleteLocations)
+def deleteLocations(conn, job):
+    currentTime = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+    def work(cur, batch, totals):
+        deleted, unassigned = assignment.deleteLocations(cur, batch, currentTime)
+        totals['unassigned'] = totals.get('unassigned', 0) + unassigned
+        return deleted
+
+    ids, count, totals = batches(conn, job, job['params']['ids'], work)
+    message = 'Deleted {} location(s), {} employees unassigned'.format(count, totals.get('unassigned', 0))
+    return {'message': message, 'emails': [], 'locations': ids}
+
+
+# Fulfil All
+# Fulfils every open request in one transaction (see assignment.fulfilAll)
+def fulfilAll(conn, job):
+    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    currentTime = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+    closed, partial, emails = assignment.fulfilAll(cur, currentTime)
+    cur.execute("update jobs set progress = 1, heartbeat = now() where id = %s", [job['id']])
+    conn.commit()
+    cur.close()
+
+    message = 'Assigned {} employees, fulfilled {} requests, partially fulfilled {}'.format(
+        len(emails), closed, partial)
+    return {'message': message, 'emails': emails, 'locations': []}
+
+
+HANDLERS = {
+    'deleteEmployees': deleteEmployees,
+    'deleteLocations': deleteLocations,
+    'fulfilAll': fulfilAll,
+}
+
+
+# Invalidate
+# Drops the caches a finished job's changes made stale. Called by the worker that ran it once the job is done, the
+# in-process caches of other processes can't be reached (they expire after IDENTITYTTL/CACHETTL, or share a
+# CACHEURL backend)
+def invalidate(result):
+    identity.invalidate(*result.get('emails', []))
+    for id in result.get('locations', []):
+        identity.invalidateLocation(id)
+    cache.invalidate('locations')
+
+
+# Heartbeat
+# Refreshes a running job's heartbeat every JOBSTALE / 3 seconds until stopped, so a job that runs longer than
+# JOBSTALE between commits (fulfilAll runs in one transaction) isn't requeued and run a second time. Uses a pooled
+# connection of its own, the job's is inside its transaction. Stops with its process, so a job whose worker died
+# still goes stale
+def heartbeat(job, stop):
+    while not stop.wait(JOBSTALE / 3):
+        try:
+            conn = db.getPool().getconn()
+        except Exception:
+            log.exception('Heartbeat of job %s failed', job['id'])
+            continue
+        broken = False
+        try:
+            cur = conn.cursor()
+            cur.execute("update jobs set heartbeat = now() where id = %s and worker = %s and status = 'running'",
+                        (job['id'], job['worker']))
+            conn.commit()
+            cur.close()
+        except Exception as e:
+            broken = isinstance(e, db.BROKEN)
+            log.exception('Heartbeat of job %s failed', job['id'])
+        finally:
+            db.getPool().putconn(conn, broken=broken)
+
+
+# Run Job
+# Runs a claimed job to completion (see runHandler), keeping its heartbeat fresh meanwhile
+def runJob(conn, job):
+    stop = threading.Event()
+    threading.Thread(target=heartbeat, args=(job, stop), name='heartbeat{}'.format(job['id']), daemon=True).start()
+    try:
+        return runHandler(conn, job)
+    finally:
+        stop.set()
+
+
+# Runs a job's handler, recording its result, or its error if the handler raised
+def runHandler(conn, job):
+    handler = HANDLERS.get(job['kind'])
+    try:
+        if handler is None:
+            raise ValueError('Unknown job kind {}'.format(job['kind']))
+        result = handler(conn, job)
+    except Exception as e:
+        conn.rollback()
+        cur = conn.cursor()
+        cur.execute("update jobs set status = 'failed', error = %s, finished = now() where id = %s",
+                    ('{}: {}'.format(type(e).__name__, e), job['id']))
+        conn.commit()
+        cur.close()
+        return False
+
+    cur = conn.cursor()
+    cur.execute("""update jobs set status = 'done', progress = total, result = %s, finished = now()
+                   where id = %s""", (psycopg2.extras.Json(result), job['id']))
+    conn.commit()
+    cur.close()
+    invalidate(result)
+    return True
+
+
+# Listen Connection
+# Separate autocommit connection the worker waits for NOTIFYs on
+def listenConn():
+    conn = psycopg2.connect(dbname=db.DBNAME, user=db.DBUSER, password=db.DBPASS, host=db.DBHOST, port=db.DBPORT)
+    conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    cur = conn.cursor()
+    cur.execute("listen " + CHANNEL)
+    cur.close()
+    return conn
+
+
+# Worker
+# Claims and runs jobs until stopped. When the queue is empty it sleeps until a job is enqueued (NOTIFY) or
+# JOBPOLL seconds pass, so idle workers cost one wakeup per JOBPOLL seconds. Stale jobs are requeued on every wakeup
+# A database error (connection dropped, server restarting) drops both connections, and the worker waits JOBPOLL
+# seconds before checking out fresh ones. A job it was running when the error hit is requeued once stale
+# With once, returns as soon as the queue is empty instead, and raises errors
+# Returns the number of jobs run
+def runWorker(once=False, stop=None):
+    worker = '{}:{}:{}'.format(socket.gethostname(), os.getpid(), threading.get_ident())
+    listener = None
+    conn = None
+    ran = 0
+    try:
+        while stop is None or not stop.is_set():
+            try:
+                if listener is None and not once:
+                    listener = listenConn()
+                if conn is None:
+                    conn = db.getPool().getconn()
+                requeueStale(conn)
+                job = claim(conn, worker)
+                if job is not None:
+                    runJob(conn, job)
+                    ran += 1
+                    continue
+                if once:
+                    break
+
+                if select.select([listener], [], [], JOBPOLL) != ([], [], []):
+                    listener.poll()
+                    listener.notifies.clear()
+            except Exception:
+                if once:
+                    raise
+                log.exception('Jobs worker %s failed, retrying in %s seconds', worker, JOBPOLL)
+                if conn is not None:
+                    db.getPool().putconn(conn, broken=True)
+                    conn = None
+                if listener is not None:
+                    listener.close()
+                    listener = None
+                if stop is None:
+                    time.sleep(JOBPOLL)
+                else:
+                    stop.wait(JOBPOLL)
+    finally:
+        if conn is not None:
+            db.getPool().putconn(conn)
+        if listener is not None:
+            listener.close()
+    return ran
+
+
+# Starts count worker threads in the current process, e.g. alongside the development server
+# Returns the event that stops them
+def startWorkers(count=JOBWORKERS):
+    stop = threading.Event()
+    for i in range(count):
+        threading.Thread(target=runWorker, kwargs={'stop': stop}, name='jobs{}'.format(i), daemon=True).start()
+    return stop
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run background jobs queued by the app')
+    parser.add_argument('--once', action='store_true', help='run the queued jobs, then exit')
+    args = parser.parse_args()
+
+    ran = runWorker(once=args.once)
+    if args.once:
+        print('Ran {} jobs'.format(ran))
+
+
+if __name__ == '__main__':
+    main()
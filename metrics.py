@@ -0,0 +1,362 @@
+# Import libraries
+import bisect
+import glob
+import os
+import pickle
+import threading
+import time
+
+import psycopg2.extensions
+from flask import g, has_app_context, request, template_rendered, before_render_template
+from dotenv import load_dotenv
+
+# Requests slower than SLOWREQUEST milliseconds are logged with their DB breakdown (0 disables the log)
+# With several worker processes, each writes its metrics to a file in METRICSDIR every METRICSFLUSH seconds and
+# /metrics adds up every process' file, whichever worker answers the scrape. serve.py sets it up by itself, set
+# METRICSDIR (a directory only the app writes to, emptied before each start) for gunicorn workers
+load_dotenv()
+SLOWREQUEST = float(os.getenv('SLOWREQUEST', 0))
+METRICSDIR = os.getenv('METRICSDIR') or None
+METRICSFLUSH = float(os.getenv('METRICSFLUSH', 5))
+
+# Histogram bucket upper bounds, seconds for timings and statement counts for queries per request
+TIMEBUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNTBUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 500, 1000)
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+# Histogram
+# Fixed bucket histogram. Quantiles are estimated by linear interpolation inside the bucket they fall in,
+# the same way Prometheus' histogram_quantile does, so memory is constant however many requests are observed
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.sum += other.sum
+        self.count += other.count
+
+    def quantile(self, q):
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if seen + n >= rank and n:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                low = self.buckets[i - 1] if i else 0.0
+                return low + (self.buckets[i] - low) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+
+
+# Metrics for one route: wall, DB and render time, and statements per request
+class RouteMetrics:
+    def __init__(self):
+        self.wall = Histogram(TIMEBUCKETS)
+        self.db = Histogram(TIMEBUCKETS)
+        self.render = Histogram(TIMEBUCKETS)
+        self.queries = Histogram(COUNTBUCKETS)
+
+    def merge(self, other):
+        for attr in ('wall', 'db', 'render', 'queries'):
+            getattr(self, attr).merge(getattr(other, attr))
+
+
+# Process wide registry, keyed by endpoint name
+routes = {}
+counters = {}
+lock = threading.Lock()
+
+
+# Increment
+# Bumps a named counter (e.g. cache hits), labels is a tuple of (name, value) pairs
+def increment(name, labels=(), amount=1):
+    with lock:
+        key = (name, tuple(labels))
+        counters[key] = counters.get(key, 0) + amount
+
+
+# Per request statistics, kept on flask.g. Outside an app context (worker threads, scripts) nothing is recorded
+def requestStats():
+    if not has_app_context():
+        return None
+    if 'requestStats' not in g:
+        g.requestStats = {'queries': 0, 'db': 0.0, 'render': 0.0, 'slowest': (0.0, None), 'start': None}
+    return g.requestStats
+
+
+# Records one statement's execution time against the current request
+# Only the slowest statement's text is kept, composed (psycopg2.sql) statements are rendered with the cursor
+def recordQuery(cursor, query, elapsed):
+    stats = requestStats()
+    if stats is None:
+        return
+    stats['queries'] += 1
+    stats['db'] += elapsed
+    if elapsed > stats['slowest'][0]:
+        if isinstance(query, bytes):
+            query = query.decode('utf-8', 'replace')
+        elif not isinstance(query, str):
+            query = query.as_string(cursor)
+        stats['slowest'] = (elapsed, query)
+
+
+# Timed Cursor
+# Mixin timing execute/executemany/copy calls. Combined with whichever cursor class a caller asks for
+class TimedCursor:
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            recordQuery(self, query, time.perf_counter() - start)
+
+    def executemany(self, query, vars_list):
+        start = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            recordQuery(self, query, time.perf_counter() - start)
+
+    def copy_expert(self, sql, file, size=8192):
+        start = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            recordQuery(self, sql, time.perf_counter() - start)
+
+
+# Timed subclasses are built once per cursor class
+timedClasses = {}
+
+
+def timedCursorClass(cursorClass):
+    timed = timedClasses.get(cursorClass)
+    if timed is None:
+        timed = type('Timed' + cursorClass.__name__, (TimedCursor, cursorClass), {})
+        timedClasses[cursorClass] = timed
+    return timed
+
+
+# Instrumented Connection
+# Connection class for the pool whose cursors time every statement, e.g. conn.cursor(cursor_factory=DictCursor)
+# returns a TimedDictCursor
+class InstrumentedConnection(psycopg2.extensions.connection):
+    def cursor(self, *args, **kwargs):
+        factory = kwargs.get('cursor_factory') or self.cursor_factory or psycopg2.extensions.cursor
+        kwargs['cursor_factory'] = timedCursorClass(factory)
+        return super().cursor(*args, **kwargs)
+
+
+# Request/render hooks, wall time starts before the view runs and render time covers every template rendered
+def beforeRequest():
+    requestStats()['start'] = time.perf_counter()
+
+
+def beforeRender(sender, template, context, **extra):
+    stats = requestStats()
+    if stats is not None:
+        stats['renderStart'] = time.perf_counter()
+
+
+def afterRender(sender, template, context, **extra):
+    stats = requestStats()
+    if stats is not None and 'renderStart' in stats:
+        stats['render'] += time.perf_counter() - stats.pop('renderStart')
+
+
+# Folds the finished request's statistics into its route's histograms and writes the slow request log
+def teardownRequest(app, exception=None):
+    stats = g.pop('requestStats', None)
+    if stats is None or stats['start'] is None:
+        return
+    wall = time.perf_counter() - stats['start']
+    endpoint = request.endpoint or 'unmatched'
+    if METRICSDIR and flusherPid != os.getpid():
+        startFlusher()
+
+    with lock:
+        route = routes.get(endpoint)
+        if route is None:
+            route = routes[endpoint] = RouteMetrics()
+        route.wall.observe(wall)
+        route.db.observe(stats['db'])
+        route.render.observe(stats['render'])
+        route.queries.observe(stats['queries'])
+
+    if SLOWREQUEST and wall * 1000 >= SLOWREQUEST:
+        slowest, query = stats['slowest']
+        app.logger.warning('Slow request %s %s: %.1f ms total, %d queries in %.1f ms, render %.1f ms, '
+                           'slowest statement %.1f ms: %s', request.method, request.path, wall * 1000,
+                           stats['queries'], stats['db'] * 1000, stats['render'] * 1000, slowest * 1000,
+                           query or '-')
+
+
+###########################################
+########### SHARED METRICS DIR ############
+###########################################
+
+# Process whose flusher thread is running. A forked worker inherits the value but not the thread, so it starts its
+# own on its first request
+flusherPid = None
+flusherLock = threading.Lock()
+processStart = int(time.time() * 1000)
+
+
+# This process' file in METRICSDIR, named by pid and start time so a later process reusing the pid never
+# overwrites it
+def processFile():
+    return os.path.join(METRICSDIR, '{}-{}.pickle'.format(os.getpid(), processStart))
+
+
+# Copy of this process' registry, taken under the lock
+def snapshot():
+    with lock:
+        return pickle.loads(pickle.dumps((routes, counters)))
+
+
+# Adds a snapshot's routes and counters into the given ones
+def mergeInto(intoRoutes, intoCounters, snap):
+    snapRoutes, snapCounters = snap
+    for endpoint, route in snapRoutes.items():
+        if endpoint in intoRoutes:
+            intoRoutes[endpoint].merge(route)
+        else:
+            intoRoutes[endpoint] = route
+    for key, value in snapCounters.items():
+        intoCounters[key] = intoCounters.get(key, 0) + value
+
+
+# Writes a snapshot to path, through a temporary file so readers never see half of one
+def writeSnapshot(path, snap):
+    temp = path + '.tmp'
+    with open(temp, 'wb') as f:
+        pickle.dump(snap, f)
+    os.replace(temp, path)
+
+
+# Returns a file's snapshot, None if it disappeared (archived) in the meantime
+def readSnapshot(path):
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+
+
+# Writes this process' metrics to its file, e.g. before it exits
+def flush():
+    if METRICSDIR:
+        writeSnapshot(processFile(), snapshot())
+
+
+def runFlusher():
+    while True:
+        time.sleep(METRICSFLUSH)
+        flush()
+
+
+def startFlusher():
+    global flusherPid, processStart
+    with flusherLock:
+        if flusherPid == os.getpid():
+            return
+        flusherPid = os.getpid()
+        processStart = int(time.time() * 1000)
+        os.makedirs(METRICSDIR, exist_ok=True)
+        threading.Thread(target=runFlusher, name='metricsFlusher', daemon=True).start()
+
+
+# Archive
+# Folds the files of a process that exited into archived.pickle and deletes them, so a server replacing its
+# workers keeps one file per live worker and its totals keep counting what the old workers served
+# Called by serve.py's master, the only writer of the archive
+def archive(pid):
+    archived = os.path.join(METRICSDIR, 'archived.pickle')
+    paths = glob.glob(os.path.join(METRICSDIR, '{}-*.pickle'.format(pid)))
+    if not paths:
+        return
+    totalRoutes, totalCounters = readSnapshot(archived) or ({}, {})
+    for path in paths:
+        mergeInto(totalRoutes, totalCounters, readSnapshot(path) or ({}, {}))
+    writeSnapshot(archived, (totalRoutes, totalCounters))
+    for path in paths:
+        os.remove(path)
+
+
+# Routes and counters to report: this process' own, plus every other process' last flushed file with METRICSDIR
+def collect():
+    if not METRICSDIR:
+        return snapshot()
+    totalRoutes, totalCounters = snapshot()
+    own = processFile()
+    for path in glob.glob(os.path.join(METRICSDIR, '*.pickle')):
+        if path != own:
+            snap = readSnapshot(path)
+            if snap is not None:
+                mergeInto(totalRoutes, totalCounters, snap)
+    return totalRoutes, totalCounters
+
+
+# Prometheus Text
+# Renders every route's histograms, estimated quantiles and the counters in the Prometheus text format
+# With METRICSDIR these add up every worker process (see collect)
+def prometheusText():
+    families = [
+        ('eas_request_seconds', 'Wall time per request', 'wall'),
+        ('eas_request_db_seconds', 'Time spent executing SQL per request', 'db'),
+        ('eas_request_render_seconds', 'Template render time per request', 'render'),
+        ('eas_request_queries', 'SQL statements per request', 'queries'),
+    ]
+
+    allRoutes, allCounters = collect()
+    lines = []
+    for name, help, attr in families:
+        lines.append('# HELP {} {}'.format(name, help))
+        lines.append('# TYPE {} histogram'.format(name))
+        for endpoint in sorted(allRoutes):
+            hist = getattr(allRoutes[endpoint], attr)
+            cumulative = 0
+            for bound, n in zip(hist.buckets, hist.counts):
+                cumulative += n
+                lines.append('{}_bucket{{route="{}",le="{}"}} {}'.format(name, endpoint, bound, cumulative))
+            lines.append('{}_bucket{{route="{}",le="+Inf"}} {}'.format(name, endpoint, hist.count))
+            lines.append('{}_sum{{route="{}"}} {}'.format(name, endpoint, hist.sum))
+            lines.append('{}_count{{route="{}"}} {}'.format(name, endpoint, hist.count))
+
+        lines.append('# HELP {}_quantile {} (p50/p95/p99 estimated from the histogram)'.format(name, help))
+        lines.append('# TYPE {}_quantile gauge'.format(name))
+        for endpoint in sorted(allRoutes):
+            hist = getattr(allRoutes[endpoint], attr)
+            for q in QUANTILES:
+                lines.append('{}_quantile{{route="{}",quantile="{}"}} {}'.format(
+                    name, endpoint, q, hist.quantile(q)))
+
+    names = sorted({name for name, labels in allCounters})
+    for name in names:
+        lines.append('# TYPE {} counter'.format(name))
+        for (counterName, labels), value in sorted(allCounters.items()):
+            if counterName == name:
+                labelText = ','.join('{}="{}"'.format(k, v) for k, v in labels)
+                lines.append('{}{} {}'.format(name, '{' + labelText + '}' if labelText else '', value))
+
+    return '\n'.join(lines) + '\n'
+
+
+# Registers the request hooks and template signals with a Flask app
+def initApp(app):
+    app.before_request(beforeRequest)
+    app.teardown_request(lambda exception=None: teardownRequest(app, exception))
+    before_render_template.connect(beforeRender, app)
+    template_rendered.connect(afterRender, app)
@@ -0,0 +1,83 @@
+# Import libraries
+import os
+import re
+
+import psycopg2
+from dotenv import load_dotenv
+
+# Directory holding the numbered migration files, applied in version order (NNNN_description.sql)
+MIGRATIONS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'PostgreSQL', 'migrations')
+FILENAME = re.compile(r'^(\d+)_(\w+)\.sql$')
+
+
+# Lists (version, name, path) of every migration file, sorted by version
+def available():
+    migrations = []
+    for filename in os.listdir(MIGRATIONS):
+        match = FILENAME.match(filename)
+        if match:
+            migrations.append((int(match.group(1)), match.group(2), os.path.join(MIGRATIONS, filename)))
+    migrations.sort()
+
+    versions = [m[0] for m in migrations]
+    if len(versions) != len(set(versions)):
+        raise ValueError('Duplicate migration version in {}'.format(MIGRATIONS))
+    return migrations
+
+
+# Returns the set of versions already applied to the DB, creating the tracking table if needed
+def applied(conn):
+    cur = conn.cursor()
+    cur.execute("""create table if not exists public.schema_migrations (
+                       version integer primary key,
+                       name character varying(100),
+                       applied timestamp without time zone default now())""")
+    conn.commit()
+    cur.execute("select version from public.schema_migrations")
+    versions = {row[0] for row in cur.fetchall()}
+    cur.close()
+    return versions
+
+
+# Migrate
+# Applies every pending migration in version order, each in its own transaction together with its
+# schema_migrations row, so a failed migration leaves the DB at the previous version
+# Returns the list of (version, name) applied
+def migrate(conn):
+    done = applied(conn)
+    ran = []
+
+    for version, name, path in available():
+        if version in done:
+            continue
+
+        cur = conn.cursor()
+        try:
+            with open(path, 'r') as f:
+                cur.execute(f.read())
+            cur.execute("insert into public.schema_migrations(version, name) values(%s, %s)", (version, name))
+            conn.commit()
+        except psycopg2.DatabaseError:
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
+
+        print("Applied migration {:04d} {}".format(version, name))
+        ran.append((version, name))
+
+    return ran
+
+
+def main():
+    load_dotenv()
+    conn = psycopg2.connect(dbname=os.getenv('DBNAME'), user=os.getenv('DBUSER'), password=os.getenv('DBPASS'))
+    ran = migrate(conn)
+    conn.close()
+
+    if not ran:
+        print("Schema up to date")
+
+
+if __name__ == '__main__':
+    main()
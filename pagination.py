@@ -0,0 +1,150 @@
+# Import libraries
+import base64
+import json
+import os
+
+from flask import request, url_for
+from psycopg2 import sql
+from dotenv import load_dotenv
+
+# Default and maximum number of rows per page
+load_dotenv()
+PAGESIZE = int(os.getenv('PAGESIZE', 50))
+MAXPAGESIZE = int(os.getenv('MAXPAGESIZE', 500))
+
+# Columns employee tables may be sorted by. email is unique, so (column, email) is always a total order
+EMPLOYEESORTS = ('name', 'email', 'assignedto')
+
+# Sort columns that may be NULL, and the value their NULLs sort as. A NULL in the keyset comparison would match no
+# rows, so these are sorted and compared by coalesce(column, value) (indexed, see
+# PostgreSQL/migrations/0010_keyset_sort_indexes.sql). A cursor's sort value must have the same type
+NULLSORTS = {'name': '', 'assignedto': 0}
+
+
+# Page
+# One page of a keyset paginated listing, along with the cursors and settings needed to build links
+class Page:
+    def __init__(self, rows, nextCursor, prevCursor, sort, desc, q, size):
+        self.rows = rows
+        self.nextCursor = nextCursor
+        self.prevCursor = prevCursor
+        self.sort = sort
+        self.desc = desc
+        self.q = q
+        self.size = size
+
+    # Query string arguments shared by every link on the page (sort, direction, filter, size)
+    def args(self, **overrides):
+        args = {'sort': self.sort, 'dir': 'desc' if self.desc else 'asc', 'size': self.size}
+        if self.q:
+            args['q'] = self.q
+        args.update(overrides)
+        return args
+
+    # URL of the current view with the given overrides, None values are left out of the query string
+    def url(self, **overrides):
+        values = dict(request.view_args or {})
+        values.update(self.args(**overrides))
+        return url_for(request.endpoint, **values)
+
+
+# Cursors are the sort key of a boundary row, encoded so they survive a round trip through a URL
+def encodeCursor(key):
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+
+def decodeCursor(cursor):
+    if not cursor:
+        return None
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except ValueError:
+        return None
+    return key if isinstance(key, list) and len(key) == 2 else None
+
+
+# Decodes a cursor for a listing sorted by sort, None unless it holds a value of the sort column's type and an email
+# (a tampered cursor, or one from a listing sorted by another column, starts from the first page instead)
+def sortCursor(cursor, sort):
+    key = decodeCursor(cursor)
+    if key is None:
+        return None
+    value, email = key
+    valueType = type(NULLSORTS.get(sort, ''))
+    if type(value) is not valueType or not isinstance(email, str):
+        return None
+    return key
+
+
+# Sort key of a row as a cursor holds it, NULLs replaced like the query sorts them
+def rowKey(row, sort):
+    value = row[sort]
+    return [NULLSORTS.get(sort) if value is None else value, row['email']]
+
+
+# Escapes LIKE wildcards (and the escape character) so q matches literally
+def likeEscape(q):
+    return q.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+# Reads sort, dir, q, size, after and before from the request args, falling back to defaults on bad input
+def pageArgs(args, sorts=EMPLOYEESORTS):
+    sort = args.get('sort') if args.get('sort') in sorts else sorts[0]
+    desc = args.get('dir') == 'desc'
+    q = (args.get('q') or '').strip()
+    try:
+        size = max(1, min(int(args.get('size', PAGESIZE)), MAXPAGESIZE))
+    except ValueError:
+        size = PAGESIZE
+    return sort, desc, q, size, sortCursor(args.get('after'), sort), sortCursor(args.get('before'), sort)
+
+
+# Keyset Page
+# Fetches one page of table ordered by (sort, email), starting after or ending before a cursor
+# where/params restrict the rows (a psycopg2.sql.Composable and its parameters), q filters on name/email
+# Only fetches size + 1 rows, so cost is independent of how deep into the listing the page is
+def keysetPage(cur, table, where, params, args, sorts=EMPLOYEESORTS):
+    sort, desc, q, size, after, before = pageArgs(args, sorts)
+
+    conditions = [where]
+    params = list(params)
+    if q:
+        conditions.append(sql.SQL("(name ilike %s escape '\\' or email ilike %s escape '\\')"))
+        params += ['%' + likeEscape(q) + '%', '%' + likeEscape(q) + '%']
+
+    sortKey = sql.Identifier(sort)
+    if sort in NULLSORTS:
+        sortKey = sql.SQL("coalesce({}, {})").format(sortKey, sql.Literal(NULLSORTS[sort]))
+
+    # Paging backwards walks the index in the opposite direction, then the rows are flipped back
+    backwards = before is not None and after is None
+    cursor = before if backwards else after
+    forward = desc == backwards
+    if cursor is not None:
+        comparison = '>' if forward else '<'
+        conditions.append(sql.SQL("({}, email) {} (%s, %s)").format(sortKey, sql.SQL(comparison)))
+        params += cursor
+
+    direction = sql.SQL('asc' if forward else 'desc')
+    query = sql.SQL("select * from {} where {} order by {} {}, email {} limit %s").format(
+        sql.Identifier(table), sql.SQL(' and ').join(conditions), sortKey, direction, direction)
+    cur.execute(query, params + [size + 1])
+
+    rows = cur.fetchall()
+    more = len(rows) > size
+    rows = rows[:size]
+    if backwards:
+        rows.reverse()
+
+    nextCursor = prevCursor = None
+    if rows:
+        first = encodeCursor(rowKey(rows[0], sort))
+        last = encodeCursor(rowKey(rows[-1], sort))
+        if backwards:
+            nextCursor = last
+            prevCursor = first if more else None
+        else:
+            nextCursor = last if more else None
+            prevCursor = first if cursor is not None else None
+
+    return Page(rows, nextCursor, prevCursor, sort, desc, q, size)
@@ -0,0 +1,140 @@
+# Import libraries
+import concurrent.futures
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from passlib.context import CryptContext
+from dotenv import load_dotenv
+
+# Hash scheme and rounds new hashes are made with. Stored hashes made with another scheme or rounds still verify
+# and are rehashed with the current settings on the next successful login (see verify)
+# HASHROUNDS empty keeps passlib's default for the scheme
+load_dotenv()
+HASHSCHEME = os.getenv('HASHSCHEME', 'sha256_crypt')
+HASHROUNDS = int(os.getenv('HASHROUNDS') or 0) or None
+
+# Processes hashing runs in (0 hashes on the calling thread), how many hashes may be queued or running before
+# new ones are refused straight away, and seconds a request waits for its hash before giving up
+HASHWORKERS = int(os.getenv('HASHWORKERS', os.cpu_count() or 1))
+HASHQUEUE = int(os.getenv('HASHQUEUE', 64))
+HASHTIMEOUT = float(os.getenv('HASHTIMEOUT', 10))
+
+# Schemes stored hashes may be in. Anything other than HASHSCHEME is deprecated, so it gets rehashed
+SCHEMES = ['sha256_crypt', 'sha512_crypt', 'pbkdf2_sha256', 'bcrypt']
+
+
+# Builds the passlib context for the settings above. With HASHROUNDS set, hashes using any other number of rounds
+# are flagged for rehashing too
+def makeContext():
+    schemes = [HASHSCHEME] + [s for s in SCHEMES if s != HASHSCHEME]
+    settings = {}
+    if HASHROUNDS:
+        settings = {
+            HASHSCHEME + '__default_rounds': HASHROUNDS,
+            HASHSCHEME + '__min_rounds': HASHROUNDS,
+            HASHSCHEME + '__max_rounds': HASHROUNDS,
+        }
+    return CryptContext(schemes=schemes, default=HASHSCHEME, deprecated='auto', **settings)
+
+
+context = makeContext()
+
+
+# Jobs run in the worker processes, module level so they can be pickled
+def hashJob(secret):
+    return context.hash(secret)
+
+
+def verifyJob(secret, stored):
+    try:
+        return context.verify_and_update(secret, stored)
+    except ValueError:
+        # Unrecognised or malformed stored hash
+        return False, None
+
+
+# Raised when HASHQUEUE hashes are already queued (or one doesn't finish in time), callers should ask the user
+# to retry
+class HashBusy(Exception):
+    pass
+
+
+# Pool is started on first use. Workers are spawned rather than forked so they don't inherit the app's threads
+# or DB connections
+executor = None
+executorLock = threading.Lock()
+slots = threading.BoundedSemaphore(HASHQUEUE)
+
+
+def getExecutor():
+    global executor
+    if executor is None:
+        with executorLock:
+            if executor is None:
+                executor = ProcessPoolExecutor(max_workers=HASHWORKERS, mp_context=multiprocessing.get_context('spawn'))
+    return executor
+
+
+# Drops a pool that broke (one of its processes died, e.g. killed for memory), unless another thread already
+# replaced it. The next getExecutor() starts a fresh one
+def resetExecutor(broken):
+    global executor
+    with executorLock:
+        if executor is broken:
+            executor = None
+    broken.shutdown(wait=False)
+
+
+# Runs a job in pool, holding one of the HASHQUEUE slots until it finishes
+# The calling thread only waits on the result, so other requests keep running while hashes are computed
+def runIn(pool, job, args):
+    if not slots.acquire(blocking=False):
+        raise HashBusy('Too many password hashes queued')
+    try:
+        future = pool.submit(job, *args)
+    except Exception:
+        slots.release()
+        raise
+    future.add_done_callback(lambda f: slots.release())
+    try:
+        return future.result(timeout=HASHTIMEOUT)
+    except concurrent.futures.TimeoutError:
+        raise HashBusy('Timed out waiting for a password hash')
+
+
+# Runs a job in the pool. A broken pool refuses every job after, so it is replaced and the job tried once more
+def run(job, *args):
+    if HASHWORKERS < 1:
+        return job(*args)
+
+    pool = getExecutor()
+    try:
+        return runIn(pool, job, args)
+    except BrokenProcessPool:
+        resetExecutor(pool)
+    return runIn(getExecutor(), job, args)
+
+
+# Hash
+# Hashes a new password with the current scheme and rounds
+def hash(secret):
+    return run(hashJob, secret)
+
+
+# Verify
+# Checks secret against a stored hash. Returns (valid, newHash), newHash is set when the password was right but
+# the stored hash uses outdated settings, and should replace it
+def verify(secret, stored):
+    return run(verifyJob, secret, stored)
+
+
+# Stops the worker processes
+def shutdown():
+    global executor
+    with executorLock:
+        if executor is not None:
+            executor.shutdown()
+            executor = None
@@ -0,0 +1,215 @@
+# Import libraries
+import argparse
+import logging
+import math
+import os
+import threading
+import time
+
+import psycopg2
+import psycopg2.errors
+from limits.storage import SlidingWindowCounterSupport, Storage
+from dotenv import load_dotenv
+
+import db
+
+log = logging.getLogger(__name__)
+
+# Where the login limiter keeps its counters: postgres:// (the ratelimits table, shared by every app process),
+# a Redis URL (redis://host:port/db, needs the redis package) or memory:// (per process, so limits multiply with
+# the number of processes), the counting strategy, and how often (seconds) and in batches of how many rows
+# expired counters are deleted from the table
+load_dotenv()
+LIMITURL = os.getenv('LIMITURL') or 'postgres://'
+LIMITSTRATEGY = os.getenv('LIMITSTRATEGY') or 'sliding-window-counter'
+LIMITSWEEP = float(os.getenv('LIMITSWEEP', 300))
+LIMITSWEEPBATCH = int(os.getenv('LIMITSWEEPBATCH', 1000))
+
+# Counts a hit if the weighted count of the previous and current window leaves room for it, in one statement
+# The row lock taken by the upsert serializes concurrent hits on the same key across processes, and a refused hit
+# writes nothing. A row whose window is older than the previous one counts as empty
+# Prepared once per pooled connection, parsing and planning it took half the time of a hit
+PREPAREACQUIRE = """prepare ratelimitacquire(varchar, bigint, integer, float8, float8, integer) as
+                    insert into ratelimits as r (key, win, count, previous, expires) values ($1, $2, $3, 0, $4)
+                    on conflict (key) do update set
+                        previous = case when r.win >= excluded.win then r.previous
+                                        when r.win = excluded.win - 1 then r.count else 0 end,
+                        count = case when r.win >= excluded.win then r.count else 0 end + excluded.count,
+                        win = greatest(r.win, excluded.win),
+                        expires = excluded.expires
+                    where floor(case when r.win >= excluded.win then r.previous
+                                     when r.win = excluded.win - 1 then r.count else 0 end * $5
+                                + case when r.win >= excluded.win then r.count else 0 end) + excluded.count <= $6
+                    returning 1"""
+ACQUIRE = "execute ratelimitacquire(%(key)s, %(win)s, %(amount)s, %(expires)s, %(weight)s, %(limit)s)"
+
+# Fixed window counting (LIMITSTRATEGY=fixed-window): the count restarts once the row expired
+INCR = """insert into ratelimits as r (key, win, count, previous, expires)
+              values (%(key)s, 0, %(amount)s, 0, %(expires)s)
+          on conflict (key) do update set
+              count = case when r.expires <= %(now)s then 0 else r.count end + excluded.count,
+              expires = case when r.expires <= %(now)s then excluded.expires else r.expires end
+          returning count"""
+
+
+# Postgres Storage
+# limits storage keeping counters in the ratelimits table (PostgreSQL/migrations/0009_rate_limits.sql), so a limit
+# holds across every app process and host instead of per process, and app processes keep nothing per client
+# Each call runs on a pooled connection of its own in autocommit, never touching the request's transaction
+# Windows are numbered from the app host's clock, hosts sharing the table need their clocks synced
+class PostgresStorage(Storage, SlidingWindowCounterSupport):
+    STORAGE_SCHEME = ['postgres']
+
+    @property
+    def base_exceptions(self):
+        return psycopg2.Error
+
+    # Runs query in autocommit (one round trip, no separate commit), returns the first row (None if there was none)
+    # A query executing a prepared statement gets prepare run first on connections that haven't prepared it yet
+    # The connection always goes back to the pool, as broken if the error was, so a failing database can't use up
+    # the pool's slots
+    def run(self, query, params, prepare=None):
+        conn = db.getPool().getconn()
+        broken = False
+        try:
+            conn.autocommit = True
+            cur = conn.cursor()
+            try:
+                cur.execute(query, params)
+            except psycopg2.errors.InvalidSqlStatementName:
+                if prepare is None:
+                    raise
+                cur.execute(prepare)
+                cur.execute(query, params)
+            row = cur.fetchone() if cur.description else None
+            cur.close()
+            return row
+        except Exception as e:
+            broken = isinstance(e, db.BROKEN)
+            raise
+        finally:
+            try:
+                if not conn.closed:
+                    conn.autocommit = False
+            except db.BROKEN:
+                broken = True
+            finally:
+                db.getPool().putconn(conn, broken=broken)
+
+    def acquire_sliding_window_entry(self, key, limit, expiry, amount=1):
+        if amount > limit:
+            return False
+        now = time.time()
+        win = math.floor(now / expiry)
+        # Share of the previous window still inside the sliding window
+        weight = (win + 1) - now / expiry
+        row = self.run(ACQUIRE, {'key': key, 'win': win, 'amount': amount, 'expires': (win + 2) * expiry,
+                                 'weight': weight, 'limit': limit}, PREPAREACQUIRE)
+        return row is not None
+
+    # Returns (previous count, seconds until the previous window slid out, current count, seconds until the
+    # current window slides out)
+    def get_sliding_window(self, key, expiry):
+        now = time.time()
+        win = math.floor(now / expiry)
+        row = self.run("select win, count, previous from ratelimits where key = %s and win >= %s",
+                       [key, win - 1])
+        previous, current = 0, 0
+        if row is not None:
+            previous, current = (row[2], row[1]) if row[0] >= win else (row[1], 0)
+        previousTTL = ((win + 1) * expiry - now) if previous else 0.0
+        return previous, previousTTL, current, (win + 2) * expiry - now
+
+    def clear_sliding_window(self, key, expiry):
+        self.clear(key)
+
+    # elastic_expiry is passed by limits 4.x and ignored, a window's expiry is set when it is created
+    def incr(self, key, expiry, elastic_expiry=False, amount=1):
+        now = time.time()
+        return self.run(INCR, {'key': key, 'amount': amount, 'expires': now + expiry, 'now': now})[0]
+
+    def get(self, key):
+        row = self.run("select count from ratelimits where key = %s and expires > %s", [key, time.time()])
+        return row[0] if row else 0
+
+    def get_expiry(self, key):
+        row = self.run("select expires from ratelimits where key = %s", [key])
+        return row[0] if row else time.time()
+
+    def check(self):
+        try:
+            self.run("select 1", [])
+            return True
+        except psycopg2.Error:
+            return False
+
+    def reset(self):
+        self.run("delete from ratelimits", [])
+        return None
+
+    def clear(self, key):
+        self.run("delete from ratelimits where key = %s", [key])
+
+    # Deletes expired counters LIMITSWEEPBATCH at a time, one short transaction per batch. Rows another sweeper is
+    # deleting are skipped, so every app process can run one. Returns the number deleted
+    def sweep(self, conn):
+        swept = 0
+        cur = conn.cursor()
+        while True:
+            cur.execute("""delete from ratelimits where key in (
+                               select key from ratelimits where expires < %s limit %s
+                               for update skip locked)""", [time.time(), LIMITSWEEPBATCH])
+            conn.commit()
+            swept += cur.rowcount
+            if cur.rowcount < LIMITSWEEPBATCH:
+                break
+        cur.close()
+        return swept
+
+
+# Sweeper
+# Deletes expired counters every LIMITSWEEP seconds until stopped (see PostgresStorage.sweep)
+# A failed sweep (database restarting, pool timeout) is logged and retried on the next round
+def runSweeper(storage, stop):
+    while not stop.wait(LIMITSWEEP):
+        try:
+            conn = db.getPool().getconn()
+        except Exception:
+            log.exception('Rate limit sweep failed')
+            continue
+        broken = False
+        try:
+            storage.sweep(conn)
+        except Exception as e:
+            broken = isinstance(e, db.BROKEN)
+            log.exception('Rate limit sweep failed')
+        finally:
+            db.getPool().putconn(conn, broken=broken)
+
+
+# Starts the sweeper thread in the current process if the counters are kept in the table (Redis and memory
+# storage expire them themselves), returns the event that stops it
+def startSweeper(storage):
+    if not isinstance(storage, PostgresStorage):
+        return None
+    stop = threading.Event()
+    threading.Thread(target=runSweeper, args=(storage, stop), name='limitSweeper', daemon=True).start()
+    return stop
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Delete expired rate limit counters from the ratelimits table')
+    parser.parse_args()
+
+    start = time.perf_counter()
+    conn = db.getPool().getconn()
+    try:
+        swept = PostgresStorage().sweep(conn)
+    finally:
+        db.getPool().putconn(conn)
+        db.getPool().closeall()
+    print('Deleted {} expired rate limit counters in {:.2f}s'.format(swept, time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+# Import libraries
+import argparse
+import os
+import sys
+
+import psycopg2
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Recomputes every location's employee count from the employees table in one pass, and lists the locations whose
+# stored locations.numemployees differed. The employees triggers keep the counts current (see
+# PostgreSQL/migrations/0005_employee_counts.sql), so any mismatch means they were bypassed (e.g. triggers
+# disabled, or a load that set eas.employee_counts off and never reconciled)
+QUERY = """with actual as (select l.id, l.numemployees as stored, count(e.email)::int as actual
+                           from locations l left join employees e on e.assignedto = l.id
+                           group by l.id),
+             fixed as (update locations set numemployees = a.actual
+                       from actual a
+                       where locations.id = a.id and a.stored is distinct from a.actual and %(fix)s
+                       returning locations.id)
+           select id, stored, actual from actual where stored is distinct from actual order by id"""
+
+# Locks every location in id order, the order the employees triggers lock them in. Taken in its own statement before
+# QUERY when fixing: it waits for transactions whose triggers already adjusted a count to commit, and holds back
+# those yet to adjust one until this transaction commits, so QUERY's snapshot sees every committed adjustment and
+# none is overwritten with a stale count. A single snapshot is consistent on its own, checking needs no lock
+LOCK = "select count(*) from (select 1 from locations order by id for update) l"
+
+
+# Reconcile
+# Returns a list of (location id, stored count, actual count) for every location whose count was wrong, and
+# with fix corrects them in the same statement
+# Does not commit, the caller owns the transaction
+def reconcile(cur, fix=True):
+    if fix:
+        cur.execute(LOCK)
+    cur.execute(QUERY, {'fix': fix})
+    return cur.fetchall()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Verify (and fix) every location employee count')
+    parser.add_argument('--check', action='store_true', help="only report mismatches, exit 1 if there are any")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(dbname=os.getenv('DBNAME'), user=os.getenv('DBUSER'), password=os.getenv('DBPASS'))
+    cur = conn.cursor()
+    mismatches = reconcile(cur, fix=not args.check)
+    conn.commit()
+    cur.close()
+    conn.close()
+
+    for id, stored, actual in mismatches:
+        print('Location {}: stored {}, actual {}'.format(id, stored, actual))
+    if args.check:
+        print('{} location counts wrong'.format(len(mismatches)))
+        if mismatches:
+            sys.exit(1)
+    else:
+        print('Fixed {} location counts'.format(len(mismatches)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+# Import libraries
+import os
+import re
+
+from psycopg2 import sql
+from dotenv import load_dotenv
+
+import pagination
+
+# Results returned when the client doesn't ask for a limit, and the most it may ask for
+load_dotenv()
+SEARCHLIMIT = int(os.getenv('SEARCHLIMIT', 20))
+MAXSEARCHLIMIT = int(os.getenv('MAXSEARCHLIMIT', 100))
+
+# Searchable tables: the columns returned, the unique key results are ordered and deduplicated by, the two
+# columns matched by prefix and the expression matched word by word. The expressions must stay identical to the
+# ones indexed in PostgreSQL/migrations/0006_search.sql, or the planner can't use the indexes
+TABLES = {
+    'employees': {
+        'columns': ('name', 'email', 'assignedto'),
+        'key': 'email',
+        'prefixes': ('name', 'email'),
+        'words': "to_tsvector('simple', name)",
+    },
+    'locations': {
+        'columns': ('id', 'name', 'address', 'numemployees'),
+        'key': 'id',
+        'prefixes': ('name', 'address'),
+        'words': "to_tsvector('simple', name || ' ' || address)",
+    },
+}
+
+# Characters that end a word in a query, as in to_tsvector's parser (which also splits on underscores)
+WORDBREAK = re.compile(r'[\W_]+')
+
+
+# Full text queries matching every word of q as a prefix ('jo sm' -> 'jo:* & sm:*'): one of the words of at
+# least two characters, which the index can narrow down cheaply, and one of every word, which is only checked
+# against the rows the first matched (a one letter prefix expands to most of the index). None if q has no word of
+# two characters
+def wordsQuery(q):
+    words = [word for word in WORDBREAK.split(q) if word]
+    indexed = [word for word in words if len(word) >= 2]
+    if not indexed:
+        return None
+    return ' & '.join(word + ':*' for word in indexed), ' & '.join(word + ':*' for word in words)
+
+
+# Search
+# Returns up to limit rows of table matching q, best match first: an exact name (rank 0), then names starting
+# with q (1), then the second prefix column (email or address) starting with q (2), then rows with a name word
+# (or address word, for locations) starting with each word of q (3, see wordsQuery). Ties are ordered by name, word matches are
+# the first found rather than the first by name
+# Each kind of match is its own limited, index ordered scan, so the cost depends on limit rather than on how many
+# rows match. Word matches, the costliest scan (every row containing a word starting with q is read from the
+# index), are only looked for when the prefix matches don't fill the limit
+# where narrows the rows (a psycopg2.sql.Composable), written the same way as a partial index's predicate so
+# that index is used, e.g. sql.SQL("assignedto = 0")
+def search(cur, table, q, limit=SEARCHLIMIT, where=None):
+    spec = TABLES[table]
+    q = q.strip().lower()
+    if not q:
+        return []
+    limit = max(1, min(limit, MAXSEARCHLIMIT))
+
+    columns = sql.SQL(', ').join(sql.Identifier(column) for column in spec['columns'])
+    key = spec['key']
+    extra = sql.SQL(' and {}').format(where) if where is not None else sql.SQL('')
+    params = {'q': q, 'prefix': pagination.likeEscape(q) + '%', 'limit': limit}
+
+    # Prefix scans walk the text_pattern_ops index in its own (byte) order, so an exact match comes first
+    first, second = spec['prefixes']
+    query = sql.SQL("""(select {columns}, case when lower({first}) = %(q)s then 0 else 1 end as rank from {table}
+                        where lower({first}) like %(prefix)s{extra} order by lower({first}) using ~<~ limit %(limit)s)
+                       union all
+                       (select {columns}, 2 as rank from {table}
+                        where lower({second}) like %(prefix)s{extra} order by lower({second}) using ~<~
+                        limit %(limit)s)""").format(
+        columns=columns, first=sql.Identifier(first), second=sql.Identifier(second), table=sql.Identifier(table),
+        extra=extra)
+    cur.execute(query, params)
+    rows = cur.fetchall()
+
+    # A row found by both scans keeps its best rank
+    found = {}
+    for row in rows:
+        if row[key] not in found or row['rank'] < found[row[key]]['rank']:
+            found[row[key]] = dict(row)
+
+    words = wordsQuery(q)
+    if words is not None and len(found) < limit:
+        params['indexed'], params['words'] = words
+
+        # ts_match_vq is the function behind @@, called directly so the planner leaves it out of the index scan
+        query = sql.SQL("""select {columns}, 3 as rank from {table}
+                           where {words} @@ to_tsquery('simple', %(indexed)s)
+                             and ts_match_vq({words}, to_tsquery('simple', %(words)s)){extra}
+                           limit %(limit)s""").format(
+            columns=columns, table=sql.Identifier(table), words=sql.SQL(spec['words']), extra=extra)
+        cur.execute(query, params)
+        for row in cur.fetchall():
+            found.setdefault(row[key], dict(row))
+
+    return sorted(found.values(), key=lambda row: (row['rank'], row['name'] or '', row[key]))[:limit]
+
+
+# Search Employees
+# Employees matching q by name or email (see search), only unassigned ones with unassigned
+def searchEmployees(cur, q, limit=SEARCHLIMIT, unassigned=False):
+    return search(cur, 'employees', q, limit, sql.SQL("assignedto = 0") if unassigned else None)
+
+
+# Search Locations
+# Locations matching q by name or address (see search)
+def searchLocations(cur, q, limit=SEARCHLIMIT):
+    return search(cur, 'locations', q, limit)
@@ -0,0 +1,240 @@
+# Import libraries
+import argparse
+import os
+import random
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+from dotenv import load_dotenv
+
+import cache
+import identity
+import metrics
+import passwords
+
+# Every worker is a process of its own, with its own memory:
+# - /metrics adds up every worker's metrics, each worker writes its own to METRICSDIR (a temporary directory made
+#   for this server unless set) every METRICSFLUSH seconds, so a scrape trails the other workers by that much
+# - the locations and identity caches are per worker unless CACHEURL is set. A write only drops the cached entries of
+#   the worker that made it (and a finished job's only in the worker that polls its status), the other workers serve
+#   the old entries until they expire after CACHETTL / IDENTITYTTL seconds. main() warns when that is the case
+#
+# Address to listen on, worker processes and request threads per worker, requests a worker serves before it is
+# replaced by a fresh one (0 never), and seconds a connection may sit idle (between keep-alive requests, or
+# mid request) before it is closed
+# Every worker has its own DB pool: SERVEWORKERS x POOLMAX connections must fit the server's max_connections
+load_dotenv()
+SERVEHOST = os.getenv('SERVEHOST', '127.0.0.1')
+SERVEPORT = int(os.getenv('SERVEPORT', 5000))
+SERVEWORKERS = int(os.getenv('SERVEWORKERS') or os.cpu_count() or 1)
+SERVETHREADS = int(os.getenv('SERVETHREADS', 8))
+SERVEMAXREQUESTS = int(os.getenv('SERVEMAXREQUESTS', 10000))
+SERVETIMEOUT = float(os.getenv('SERVETIMEOUT', 5))
+
+# A worker that exits sooner than this many seconds after starting is replaced only after a pause, so a worker
+# failing at startup doesn't turn into a fork loop
+RESPAWNDELAY = 1.0
+
+
+# Request handler with an idle timeout, and access logging only when asked for (--access-log)
+class Handler(WSGIRequestHandler):
+    timeout = SERVETIMEOUT
+    accessLog = False
+
+    def log_request(self, *args, **kwargs):
+        if self.accessLog:
+            super().log_request(*args, **kwargs)
+
+
+# Pooled Server
+# WSGI server on the listening socket inherited from the master, handing each connection to one of a fixed number
+# of threads. A worker only accepts a connection when it has a free thread, so connections it can't serve yet are
+# left to the other workers instead of queueing behind busy threads
+class PooledServer(BaseWSGIServer):
+    multithread = True
+
+    def __init__(self, listener, app, threads):
+        host, port = listener.getsockname()[:2]
+        super().__init__(host, port, app, handler=Handler, fd=listener.fileno())
+        # handle_request() waits for the shorter of the socket's timeout and self.timeout, a non-blocking socket
+        # (timeout 0) would make it poll in a busy loop. A worker losing the race for a connection gives up on
+        # accept() after the same second
+        self.socket.settimeout(1.0)
+        self.timeout = 1.0
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix='request')
+        self.slots = threading.BoundedSemaphore(threads)
+        self.handled = 0
+        self.accepted = False
+
+    def process_request(self, request, clientAddress):
+        self.accepted = True
+        self.handled += 1
+        self.executor.submit(self.processRequestThread, request, clientAddress)
+
+    def processRequestThread(self, request, clientAddress):
+        try:
+            self.finish_request(request, clientAddress)
+        except Exception:
+            self.handle_error(request, clientAddress)
+        finally:
+            self.shutdown_request(request)
+            self.slots.release()
+
+    # Accepts connections until stop is set or maxRequests connections were handled, then lets the ones in
+    # flight finish
+    def serveUntil(self, stop, maxRequests):
+        while not stop.is_set() and not (maxRequests and self.handled >= maxRequests):
+            self.slots.acquire()
+            self.accepted = False
+            # Waits up to self.timeout for a connection. Other workers wake up for the same one, those that lose
+            # the race to accept it return without one
+            self.handle_request()
+            if not self.accepted:
+                self.slots.release()
+        self.executor.shutdown(wait=True)
+
+
+# Worker
+# Runs in a forked child: serves the preloaded app until told to stop (SIGTERM/SIGINT) or until it reached its
+# request limit. The limit is spread by up to 10% per worker so workers aren't all replaced at once
+def runWorker(listener, app, threads, maxRequests):
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *args: stop.set())
+    signal.signal(signal.SIGINT, lambda *args: stop.set())
+    if maxRequests:
+        maxRequests += random.randint(0, maxRequests // 10)
+
+    server = PooledServer(listener, app, threads)
+    try:
+        server.serveUntil(stop, maxRequests)
+    finally:
+        # The password hashing processes this worker started (see passwords.py) would outlive it
+        passwords.shutdown()
+        metrics.flush()
+
+
+# Background
+# Runs in a forked child of its own: the jobs workers and the session and rate limit sweepers, once for the whole
+# server instead of once per worker
+def runBackground(startBackground):
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *args: stop.set())
+    signal.signal(signal.SIGINT, lambda *args: stop.set())
+    startBackground()
+    stop.wait()
+
+
+# Forks a child running target(*args), returns its pid. The child never returns into the master's code
+def forkChild(target, *args):
+    pid = os.fork()
+    if pid != 0:
+        return pid
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    status = 0
+    try:
+        target(*args)
+    except BaseException:
+        status = 1
+        import traceback
+        traceback.print_exc()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(status)
+
+
+# Master
+# Binds the socket, imports and warms the app once (templates compiled, locations cached), closes its DB
+# connections and forks the workers and the background process, which inherit the warmed app. Then replaces any
+# child that exits (recycled or crashed) until SIGTERM/SIGINT, which is passed on to the children
+# POSIX only (os.fork), on Windows use create_app() with waitress instead
+def main():
+    parser = argparse.ArgumentParser(description='Serve app.py with several worker processes')
+    parser.add_argument('--host', default=SERVEHOST)
+    parser.add_argument('--port', type=int, default=SERVEPORT)
+    parser.add_argument('--workers', type=int, default=SERVEWORKERS)
+    parser.add_argument('--threads', type=int, default=SERVETHREADS)
+    parser.add_argument('--max-requests', type=int, default=SERVEMAXREQUESTS,
+                        help='requests a worker serves before it is replaced (0 never)')
+    parser.add_argument('--no-background', action='store_true',
+                        help="don't run jobs and sweepers (run 'python jobs.py' etc. separately)")
+    parser.add_argument('--access-log', action='store_true')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    listener = socket.create_server((args.host, args.port), backlog=2048)
+    listener.setblocking(False)
+
+    if args.workers > 1 and not cache.CACHEURL:
+        print('Warning: CACHEURL is not set, each worker caches on its own and may serve locations up to {:.0f}s and '
+              'identities up to {:.0f}s old after another worker changed them'.format(cache.CACHETTL,
+                                                                                   identity.IDENTITYTTL),
+              file=sys.stderr, flush=True)
+
+    # Workers' metrics files, a directory made here is removed on exit. One given is emptied, files left from an
+    # earlier run would be added to this one's
+    metricsDir = None
+    if metrics.METRICSDIR:
+        os.makedirs(metrics.METRICSDIR, exist_ok=True)
+        for name in os.listdir(metrics.METRICSDIR):
+            if name.endswith('.pickle'):
+                os.remove(os.path.join(metrics.METRICSDIR, name))
+    else:
+        metricsDir = metrics.METRICSDIR = tempfile.mkdtemp(prefix='eas-metrics-')
+
+    import app
+    import db
+    app.create_app(background=False)
+    db.closePool()
+    Handler.accessLog = args.access_log
+
+    stopping = []
+
+    def stop(signum, frame):
+        if not stopping:
+            stopping.append(signum)
+            for pid in children:
+                os.kill(pid, signal.SIGTERM)
+
+    # children maps pid -> (started, target, args), so a child that exits is replaced by the same kind
+    children = {}
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    def spawn(target, *targetArgs):
+        children[forkChild(target, *targetArgs)] = (time.monotonic(), target, targetArgs)
+
+    for i in range(args.workers):
+        spawn(runWorker, listener, app.app, args.threads, args.max_requests)
+    if not args.no_background:
+        spawn(runBackground, app.startBackground)
+
+    print('Serving on http://{}:{} with {} workers x {} threads (started in {:.2f}s)'.format(
+        args.host, listener.getsockname()[1], args.workers, args.threads, time.perf_counter() - start),
+        flush=True)
+
+    while children:
+        pid, status = os.wait()
+        started, target, targetArgs = children.pop(pid)
+        metrics.archive(pid)
+        if stopping:
+            continue
+        if time.monotonic() - started < RESPAWNDELAY:
+            time.sleep(RESPAWNDELAY)
+        if not stopping:
+            spawn(target, *targetArgs)
+    listener.close()
+    if metricsDir is not None:
+        shutil.rmtree(metricsDir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
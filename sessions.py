@@ -0,0 +1,241 @@
+# Import libraries
+import argparse
+import logging
+import os
+import secrets
+import threading
+import time
+
+from flask.sessions import SessionInterface, SessionMixin, session_json_serializer
+from werkzeug.datastructures import CallbackDict
+from dotenv import load_dotenv
+
+import db
+
+log = logging.getLogger(__name__)
+
+# Seconds a session lives without being used (every request a session is used on extends it), an optional shared
+# Redis URL (redis://host:port/db) to keep sessions in instead of the sessions table, and how often (seconds) and in
+# batches of how many rows expired sessions are deleted from the table
+load_dotenv()
+SESSIONLIFETIME = float(os.getenv('SESSIONLIFETIME', 8 * 60 * 60))
+SESSIONURL = os.getenv('SESSIONURL') or None
+SESSIONSWEEP = float(os.getenv('SESSIONSWEEP', 300))
+SESSIONSWEEPBATCH = int(os.getenv('SESSIONSWEEPBATCH', 1000))
+
+# A session unchanged by a request is only written back to extend it once less than this fraction of its lifetime
+# is left, so browsing costs one read per request instead of a read and a write
+REFRESHAFTER = 0.5
+
+
+# Server Session
+# Session dict that remembers its id, whether it changed, and how many seconds it had left when loaded
+class ServerSession(CallbackDict, SessionMixin):
+    def __init__(self, data=None, sid=None, remaining=None):
+        def onUpdate(self):
+            self.modified = True
+
+        super().__init__(data, onUpdate)
+        self.sid = sid
+        self.remaining = remaining
+        self.modified = False
+        self.stale = None
+
+    # Gives the session a new id, dropping the old one, so an id handed out before login is worthless after it
+    # (session fixation). Called by login
+    def regenerate(self):
+        if self.sid is not None and self.stale is None:
+            self.stale = self.sid
+        self.sid = None
+        self.modified = True
+
+
+# Postgres Store
+# Sessions kept in the sessions table (PostgreSQL/migrations/0008_sessions.sql). Reads go through the request's
+# pooled connection, writes through a connection of their own, so a write never commits the request's open work
+class PostgresStore:
+    # Returns (data, seconds left), None if the session doesn't exist or has expired
+    def load(self, sid):
+        cur = db.getConn().cursor()
+        cur.execute("""select data, extract(epoch from expires - now()) from sessions
+                       where id = %s and expires > now()""", [sid])
+        row = cur.fetchone()
+        cur.close()
+        if row is None:
+            return None
+        return session_json_serializer.loads(row[0]), float(row[1])
+
+    def write(self, query, params):
+        conn = db.getPool().getconn()
+        try:
+            cur = conn.cursor()
+            cur.execute(query, params)
+            conn.commit()
+            cur.close()
+        finally:
+            db.getPool().putconn(conn)
+
+    def save(self, sid, data, lifetime):
+        self.write("""insert into sessions(id, data, expires) values (%s, %s, now() + %s * interval '1 second')
+                      on conflict (id) do update set data = excluded.data, expires = excluded.expires""",
+                   (sid, session_json_serializer.dumps(data), lifetime))
+
+    def touch(self, sid, lifetime):
+        self.write("update sessions set expires = now() + %s * interval '1 second' where id = %s", (lifetime, sid))
+
+    def delete(self, sid):
+        self.write("delete from sessions where id = %s", [sid])
+
+    # Deletes expired sessions SESSIONSWEEPBATCH at a time, one short transaction per batch so the table is never
+    # locked for long. Rows another sweeper is deleting are skipped, so every app process can run one
+    # Returns the number deleted
+    def sweep(self, conn):
+        swept = 0
+        cur = conn.cursor()
+        while True:
+            cur.execute("""delete from sessions where id in (
+                               select id from sessions where expires < now() order by expires limit %s
+                               for update skip locked)""", [SESSIONSWEEPBATCH])
+            conn.commit()
+            swept += cur.rowcount
+            if cur.rowcount < SESSIONSWEEPBATCH:
+                break
+        cur.close()
+        return swept
+
+
+# Redis Store
+# Sessions kept in Redis, which expires them itself (nothing to sweep)
+# redis is an optional dependency, only needed when SESSIONURL is set
+class RedisStore:
+    def __init__(self, url):
+        import redis
+        self.client = redis.Redis.from_url(url)
+
+    def load(self, sid):
+        pipe = self.client.pipeline()
+        pipe.get('session:' + sid)
+        pipe.ttl('session:' + sid)
+        data, ttl = pipe.execute()
+        if data is None:
+            return None
+        return session_json_serializer.loads(data.decode()), float(ttl)
+
+    def save(self, sid, data, lifetime):
+        self.client.set('session:' + sid, session_json_serializer.dumps(data), ex=max(1, int(lifetime)))
+
+    def touch(self, sid, lifetime):
+        self.client.expire('session:' + sid, max(1, int(lifetime)))
+
+    def delete(self, sid):
+        self.client.delete('session:' + sid)
+
+    def sweep(self, conn):
+        return 0
+
+
+# Server Session Interface
+# Flask session interface keeping session data in a store, the cookie only holds a random id (no signing, so
+# nothing to verify or re-sign per request, and nothing in it a client can read). Sessions are shared by every
+# app process and survive restarts. Requests whose path starts with one of skip (static files, the token
+# authenticated API) get no session and never touch the store
+class ServerSessionInterface(SessionInterface):
+    def __init__(self, store=None, lifetime=SESSIONLIFETIME, skip=()):
+        self.store = store or (RedisStore(SESSIONURL) if SESSIONURL else PostgresStore())
+        self.lifetime = lifetime
+        self.skip = tuple(skip)
+
+    def open_session(self, app, request):
+        if self.skip and request.path.startswith(self.skip):
+            return None
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            loaded = self.store.load(sid)
+            if loaded is not None:
+                return ServerSession(loaded[0], sid, loaded[1])
+        return ServerSession()
+
+    def save_session(self, app, session, response):
+        if session.stale is not None:
+            self.store.delete(session.stale)
+            session.stale = None
+
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        # Emptied (logout), or never held anything: nothing to store
+        if not session:
+            if session.sid is not None:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        response.vary.add('Cookie')
+        if session.sid is None:
+            session.sid = newId()
+            self.store.save(session.sid, dict(session), self.lifetime)
+            response.set_cookie(name, session.sid, domain=domain, path=path,
+                                httponly=self.get_cookie_httponly(app), secure=self.get_cookie_secure(app),
+                                samesite=self.get_cookie_samesite(app))
+        elif session.modified:
+            self.store.save(session.sid, dict(session), self.lifetime)
+        elif session.remaining is not None and session.remaining < self.lifetime * REFRESHAFTER:
+            self.store.touch(session.sid, self.lifetime)
+
+    # Creates a session holding data without a request, returns its id (the cookie value). Used by the
+    # benchmarks to log clients in without going through /login
+    def create(self, data):
+        sid = newId()
+        self.store.save(sid, data, self.lifetime)
+        return sid
+
+
+# 256 random bits, URL safe
+def newId():
+    return secrets.token_urlsafe(32)
+
+
+# Sweeper
+# Deletes expired sessions every SESSIONSWEEP seconds until stopped (see PostgresStore.sweep)
+# A failed sweep (database restarting, pool timeout) is logged and retried on the next round
+def runSweeper(store, stop):
+    while not stop.wait(SESSIONSWEEP):
+        try:
+            conn = db.getPool().getconn()
+        except Exception:
+            log.exception('Session sweep failed')
+            continue
+        broken = False
+        try:
+            store.sweep(conn)
+        except Exception as e:
+            broken = isinstance(e, db.BROKEN)
+            log.exception('Session sweep failed')
+        finally:
+            db.getPool().putconn(conn, broken=broken)
+
+
+# Starts the sweeper thread in the current process, returns the event that stops it
+def startSweeper(store):
+    stop = threading.Event()
+    threading.Thread(target=runSweeper, args=(store, stop), name='sessionSweeper', daemon=True).start()
+    return stop
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Delete expired sessions from the sessions table')
+    parser.parse_args()
+
+    start = time.perf_counter()
+    conn = db.getPool().getconn()
+    try:
+        swept = PostgresStore().sweep(conn)
+    finally:
+        db.getPool().putconn(conn)
+        db.getPool().closeall()
+    print('Deleted {} expired sessions in {:.2f}s'.format(swept, time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()
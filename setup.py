@@ -1,6 +1,8 @@
 import os
 import psycopg2
 import psycopg2.extensions
+import geocode
+import migrate
 from gendata import gendata
 from psycopg2.extensions import AsIs
 from dotenv import load_dotenv
@@ -68,6 +70,20 @@ def main():
     except Exception as e:
         print("Error in creation of schema:", e)
 
+    # Apply versioned migrations (indexes etc.) on top of the base schema, each in its own transaction
+    migrateConn = psycopg2.connect(dbname=DBNAME, user=DBUSER, password=DBPASS)
+    try:
+        migrate.migrate(migrateConn)
+    except psycopg2.DatabaseError as e:
+        print("Error applying migrations:", e)
+
+    # Load the offline geocodes locations get their coordinates from
+    try:
+        print("Loaded {} geocoded addresses".format(geocode.load(migrateConn)[0]))
+    except psycopg2.DatabaseError as e:
+        print("Error loading geocodes:", e)
+    migrateConn.close()
+
     # Populate DB
     print("Populating {}...".format(DBNAME))
     gendata.populate(os.getenv('EMPLOYEES'), os.getenv('LOCATIONS'))
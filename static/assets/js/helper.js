@@ -50,77 +50,139 @@ function selectRow(pkey, col){
 
 /*
 Will sort the passed table by column n, on click of column n. Subsequent clicks will change sort order
+Rows are sorted with one Array.sort and re-appended, so large tables sort in O(n log n)
  */
 function sortTable(tablename, n, num=false) {
-  var table, rows, switching, i, x, y, shouldSwitch, dir, switchcount = 0;
-  table = document.getElementById(tablename);
-  switching = true;
-  // Set the sorting direction to ascending:
-  dir = "asc";
-  /* Make a loop that will continue until
-  no switching has been done: */
-  while (switching) {
-    // Start by saying: no switching is done:
-    switching = false;
-    rows = table.rows;
-    /* Loop through all table rows (except the
-    first, which contains table headers): */
-    for (i = 1; i < (rows.length - 1); i++) {
-      // Start by saying there should be no switching:
-      shouldSwitch = false;
-      /* Get the two elements you want to compare,
-      one from current row and one from the next: */
-      x = rows[i].getElementsByTagName("TD")[n];
-      y = rows[i + 1].getElementsByTagName("TD")[n];
-      /* Check if the two rows should switch place,
-      based on the direction, asc or desc: */
-      if (dir == "asc") {
-          if(num){
-            if (Number(x.innerHTML) > Number(y.innerHTML)) {
-              // If so, mark as a switch and break the loop:
-              shouldSwitch = true;
-              break;
+  var table = document.getElementById(tablename);
+  var tbody = table.tBodies[0];
+  var rows = Array.prototype.slice.call(tbody.rows);
+
+  // Cell values are read once, not on every comparison
+  var keys = rows.map(function(row, i) {
+    var text = row.getElementsByTagName("TD")[n].innerHTML;
+    return {row: row, index: i, value: num ? Number(text) : text.toLowerCase()};
+  });
+  var compare = function(a, b) {
+    return a.value < b.value ? -1 : (a.value > b.value ? 1 : a.index - b.index);
+  };
+
+  // Sort ascending, or descending if the table was already in ascending order
+  keys.sort(compare);
+  var ascending = keys.every(function(key, i) { return key.index == i; });
+  if (ascending) {
+    keys.sort(function(a, b) { return compare(b, a); });
+  }
+
+  keys.forEach(function(key) { tbody.appendChild(key.row); });
+}
+
+/*
+Search box over a table: once typing pauses, fetches url with the box's text as ?q= and replaces the rows
+of the table body with one per result, built by row(result). Clearing the box brings back the original rows
+Responses to earlier queries that arrive late are ignored
+*/
+function typeahead(inputID, url, tbodyID, row){
+    var input = document.getElementById(inputID);
+    var tbody = document.getElementById(tbodyID);
+    var original = Array.prototype.slice.call(tbody.rows);
+    var timer = null;
+    var latest = 0;
+
+    input.addEventListener("input", function(){
+        clearTimeout(timer);
+        timer = setTimeout(function(){
+            var q = input.value.trim();
+            var sent = ++latest;
+            if (!q){
+                showRows(tbody, original);
+                return;
             }
-          }
-          else{
-              if (x.innerHTML.toLowerCase() > y.innerHTML.toLowerCase()) {
-              // If so, mark as a switch and break the loop:
-              shouldSwitch = true;
-              break;
+            fetch(url + (url.indexOf("?") < 0 ? "?" : "&") + "q=" + encodeURIComponent(q), {credentials: "same-origin"})
+                .then(function(response){ return response.json(); })
+                .then(function(data){
+                    if (sent == latest){
+                        showRows(tbody, data.results.map(row));
+                    }
+                });
+        }, 250);
+    });
+}
+
+/*
+Replaces the rows of a table body
+*/
+function showRows(tbody, rows){
+    while (tbody.firstChild){
+        tbody.removeChild(tbody.firstChild);
+    }
+    rows.forEach(function(row){ tbody.appendChild(row); });
+}
+
+/*
+Builds a table row with one text cell per value
+*/
+function tableRow(values){
+    var row = document.createElement("tr");
+    values.forEach(function(value){
+        var cell = document.createElement("td");
+        cell.textContent = value;
+        row.appendChild(cell);
+    });
+    return row;
+}
+
+/*
+Builds a row selectable with selectRow: a hidden checkbox named inputName with value key is checked
+when the row is clicked. Rows are reused by key, so a selection survives the row leaving and coming back
+*/
+var selectableRows = {};
+function selectableRow(key, values, inputName){
+    if (!selectableRows[key]){
+        var row = tableRow(values);
+        row.id = key;
+        row.className = "unselectable";
+        row.onclick = function(){ selectRow(key, "green"); };
+
+        var cell = document.createElement("td");
+        cell.hidden = true;
+        var box = document.createElement("input");
+        box.id = key + "U";
+        box.type = "checkbox";
+        box.name = inputName;
+        box.value = key;
+        cell.appendChild(box);
+        row.appendChild(cell);
+        selectableRows[key] = row;
+    }
+    return selectableRows[key];
+}
+
+/*
+Polls a background job's status endpoint once a second, updating the progress bar and status text
+until the job is done or failed
+*/
+function pollJob(url, barID, statusID){
+    var bar = document.getElementById(barID);
+    var status = document.getElementById(statusID);
+
+    fetch(url, {credentials: "same-origin"})
+        .then(function(response){ return response.json(); })
+        .then(function(job){
+            bar.style.width = (job.total ? 100 * job.progress / job.total : 0) + "%";
+            if (job.status == "done"){
+                status.textContent = job.message;
             }
-          }
-      }
-      else if (dir == "desc") {
-          if(num){
-            if (Number(x.innerHTML) < Number(y.innerHTML)) {
-              // If so, mark as a switch and break the loop:
-              shouldSwitch = true;
-              break;
+            else if (job.status == "failed"){
+                status.textContent = "Failed: " + job.error;
+                bar.className += " progress-bar-danger";
             }
-          }
-          else{
-              if (x.innerHTML.toLowerCase() < y.innerHTML.toLowerCase()) {
-              // If so, mark as a switch and break the loop:
-              shouldSwitch = true;
-              break;
+            else{
+                status.textContent = job.status.charAt(0).toUpperCase() + job.status.slice(1) + ", " +
+                                     job.progress + " of " + job.total + " done";
+                setTimeout(function(){ pollJob(url, barID, statusID); }, 1000);
             }
-          }
-      }
-    }
-    if (shouldSwitch) {
-      /* If a switch has been marked, make the switch
-      and mark that a switch has been done: */
-      rows[i].parentNode.insertBefore(rows[i + 1], rows[i]);
-      switching = true;
-      // Each time a switch is done, increase this count by 1:
-      switchcount ++;
-    } else {
-      /* If no switching has been done AND the direction is "asc",
-      set the direction to "desc" and run the while loop again. */
-      if (switchcount == 0 && dir == "asc") {
-        dir = "desc";
-        switching = true;
-      }
-    }
-  }
-}
\ No newline at end of file
+        })
+        .catch(function(){
+            setTimeout(function(){ pollJob(url, barID, statusID); }, 1000);
+        });
+}
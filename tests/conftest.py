@@ -0,0 +1,5 @@
+# Allow the tests to import the app modules whatever directory pytest is run from
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
@@ -0,0 +1,160 @@
+# Tests for the DB-free logic: request allocation, pagination cursors, histogram quantiles and generated emails
+# Run with: python -m pytest tests
+from datetime import date
+
+import pytest
+
+import assignment
+import metrics
+import pagination
+from gendata import gendata
+
+
+###########################################
+############### ALLOCATE ##################
+###########################################
+
+def test_allocate_enough_supply():
+    requests = [(1, 5, date(2024, 1, 2), None), (2, 3, date(2024, 1, 1), None)]
+    assert assignment.allocate(requests, 100) == [(2, 3, 3), (1, 5, 5)]
+
+
+def test_allocate_priority_order():
+    # Earliest datereq first, undated last, then earliest datesubmit, then reqnum
+    requests = [(1, 1, None, date(2024, 1, 1)), (2, 1, date(2024, 2, 1), date(2024, 1, 3)),
+                (3, 1, date(2024, 2, 1), date(2024, 1, 2)), (4, 1, date(2024, 1, 1), None)]
+    assert [r[0] for r in assignment.allocate(requests, 10)] == [4, 3, 2, 1]
+
+
+def test_allocate_shortage_shared_proportionally():
+    # 10 employees for a group asking for 30 + 10 + 10: shares of 6, 2 and 2, later groups get nothing
+    requests = [(1, 30, date(2024, 1, 1), None), (2, 10, date(2024, 1, 1), None), (3, 10, date(2024, 1, 1), None),
+                (4, 5, date(2024, 1, 2), None)]
+    assert assignment.allocate(requests, 10) == [(1, 30, 6), (2, 10, 2), (3, 10, 2), (4, 5, 0)]
+
+
+def test_allocate_largest_remainder_ties_to_priority():
+    requests = [(1, 3, date(2024, 1, 1), date(2024, 1, 1)), (2, 1, date(2024, 1, 1), date(2024, 1, 2))]
+    assert assignment.allocate(requests, 2) == [(1, 3, 2), (2, 1, 0)]
+
+
+def test_allocate_never_exceeds_supply_or_quantity():
+    requests = [(i, q, date(2024, 1, 1 + i % 3), None) for i, q in enumerate([7, 3, 9, 1, 4, 4, 2, 8])]
+    for supply in range(0, 40):
+        allocation = assignment.allocate(requests, supply)
+        assert sum(allocated for reqnum, quantity, allocated in allocation) == min(supply, 38)
+        assert all(0 <= allocated <= quantity for reqnum, quantity, allocated in allocation)
+
+
+def test_allocate_missing_or_negative_quantity():
+    # Counted as asking for nobody
+    requests = [(1, None, None, None), (2, -4, None, None), (3, 2, None, None)]
+    assert assignment.allocate(requests, 5) == [(1, 0, 0), (2, 0, 0), (3, 2, 2)]
+
+
+###########################################
+############## PAGINATION #################
+###########################################
+
+@pytest.mark.parametrize('key', [['Smith, Ann', 'ann@example.com'], ['', 'x@example.com'], [0, 'y@example.com'],
+                                 ['Zoë ✓', 'z@example.com']])
+def test_cursor_round_trip(key):
+    assert pagination.decodeCursor(pagination.encodeCursor(key)) == key
+
+
+@pytest.mark.parametrize('cursor', [None, '', 'not base64!', pagination.encodeCursor({'a': 1}),
+                                    pagination.encodeCursor(['only one']), pagination.encodeCursor([1, 2, 3])])
+def test_decode_rejects_malformed(cursor):
+    assert pagination.decodeCursor(cursor) is None
+
+
+@pytest.mark.parametrize('sort, key', [('name', [1, 'a@example.com']), ('name', [None, 'a@example.com']),
+                                       ('assignedto', ['3', 'a@example.com']), ('assignedto', [True, 'a@example.com']),
+                                       ('assignedto', [1.5, 'a@example.com']), ('email', ['a', 7]),
+                                       ('email', [['nested'], 'a@example.com'])])
+def test_sort_cursor_rejects_wrong_types(sort, key):
+    assert pagination.sortCursor(pagination.encodeCursor(key), sort) is None
+
+
+@pytest.mark.parametrize('sort, key', [('name', ['Ann', 'a@example.com']), ('assignedto', [3, 'a@example.com']),
+                                       ('email', ['a@example.com', 'a@example.com'])])
+def test_sort_cursor_accepts_sort_type(sort, key):
+    assert pagination.sortCursor(pagination.encodeCursor(key), sort) == key
+
+
+def test_row_key_replaces_nulls():
+    assert pagination.rowKey({'name': None, 'email': 'a@example.com'}, 'name') == ['', 'a@example.com']
+    assert pagination.rowKey({'assignedto': None, 'email': 'a@example.com'}, 'assignedto') == [0, 'a@example.com']
+
+
+def test_like_escape():
+    assert pagination.likeEscape('100%_a\\b') == '100\\%\\_a\\\\b'
+
+
+###########################################
+############### METRICS ###################
+###########################################
+
+def test_quantile_empty():
+    assert metrics.Histogram((1, 2, 3)).quantile(0.5) == 0.0
+
+
+def test_quantile_interpolates_inside_bucket():
+    hist = metrics.Histogram((1.0, 2.0, 3.0))
+    for value in (0.5, 0.5, 1.5, 1.5):
+        hist.observe(value)
+    assert hist.quantile(0.5) == pytest.approx(1.0)
+    assert hist.quantile(0.75) == pytest.approx(1.5)
+    assert hist.quantile(1.0) == pytest.approx(2.0)
+
+
+def test_quantile_overflow_bucket_reports_last_bound():
+    hist = metrics.Histogram((1.0, 2.0))
+    for value in (5.0, 6.0, 7.0):
+        hist.observe(value)
+    assert hist.quantile(0.99) == 2.0
+
+
+def test_quantile_bucket_bounds_are_inclusive():
+    hist = metrics.Histogram((1.0, 2.0))
+    hist.observe(1.0)
+    assert hist.counts == [1, 0, 0]
+
+
+def test_histogram_merge():
+    a, b = metrics.Histogram((1.0, 2.0)), metrics.Histogram((1.0, 2.0))
+    a.observe(0.5)
+    b.observe(1.5)
+    b.observe(3.0)
+    a.merge(b)
+    assert (a.counts, a.count, a.sum) == ([1, 1, 1], 3, 5.0)
+
+
+###########################################
+################ GENDATA ##################
+###########################################
+
+def test_email_step_coprime():
+    # A step coprime with 26 is invertible modulo 26^10, which makes the mapping a bijection
+    assert gendata.EMAILSTEP % 2 and gendata.EMAILSTEP % 13
+
+
+def test_email_format():
+    email = gendata.employeeEmail(12345, 678)
+    assert email.endswith('@gmail.com')
+    local = email[:-len('@gmail.com')]
+    assert len(local) == 10 and local.isalpha() and local.islower()
+
+
+def test_email_unique_and_invertible():
+    offset = 424242
+    inverse = pow(gendata.EMAILSTEP, -1, gendata.EMAILSPACE)
+    indexes = list(range(20000)) + [gendata.EMAILSPACE - 1, gendata.EMAILSPACE // 2]
+    emails = [gendata.employeeEmail(i, offset) for i in indexes]
+    assert len(set(emails)) == len(emails)
+
+    for i, email in zip(indexes, emails):
+        n = 0
+        for letter in reversed(email[:10]):
+            n = n * 26 + ord(letter) - ord('a')
+        assert (n - offset) * inverse % gendata.EMAILSPACE == i